@@ -1,17 +1,37 @@
-import qrcode
 import os
-import uuid
+import json
+import click
+import time
 from io import BytesIO
-from flask import Flask, Blueprint, render_template, request, redirect, url_for, flash, jsonify, send_file
+from flask import Flask, Blueprint, Response, render_template, request, redirect, url_for, flash, jsonify, send_file, g
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from flask_migrate import Migrate
-from PIL import Image
+from flask_jwt_extended import JWTManager, decode_token
 from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
 from config import Config
-from database.chroma_db import chroma_db
-from auth.models import db, User
+from chromadb.api.types import validate_where, validate_where_document
+from chromadb.errors import InvalidArgumentError
+from database.chroma_db import chroma_db, SEARCH_INCLUDE, DOCUMENTS_ONLY
+from database.token_store import create_token_store
+from database.job_queue import JobQueue, QUEUED, RUNNING, FAILED, DEAD
+from database.compact_index import recall_report
+from services.qr_cache import QRCache, ERROR_CORRECTION_LEVELS, MIMETYPES as QR_MIMETYPES
+from services.qr_sheet import render_many, build_sheet
+from services.file_server import serve_stored_file, resolve_stored_path
+from services.thumbnails import ThumbnailCache
+from services.json_provider import create_json_provider
+from services.ingest_worker import run_workers
+from services.metrics import metrics
+from services.profiler import SlowRequestProfiler
+from services.pdf_ingest import iter_pdf_pages
+from services.storage_gc import collect_garbage, GarbageCollectionRefused
+from services.uploads import (
+    store_upload, discard_upload, read_upload, check_image_header, check_pdf_header, stored_file_fields,
+    UploadRejected
+)
+from auth.models import db, User, hash_password
+from auth.user_cache import AuthUser, user_cache
 from auth.auth_routes import auth
 
 # Load environment variables from .env
@@ -23,6 +43,7 @@ from cryptography.fernet import Fernet
 
 app = Flask(__name__)
 app.config.from_object(Config)
+app.json = create_json_provider(app)
 app.register_blueprint(auth)
 
 db.init_app(app)
@@ -30,6 +51,8 @@ with app.app_context():
     db.create_all()
 
 migrate = Migrate(app, db)
+jwt = JWTManager(app)
+user_cache.init_app(app)
 
 login_manager = LoginManager()
 login_manager.login_view = "auth.login"
@@ -45,25 +68,147 @@ def create_default_admin():
             raise Exception("Missing ENCRYPTION_KEY or DEFAULT_ADMIN_PASSWORD_ENC in .env file!")
         fernet = Fernet(encryption_key)
         default_admin_password = fernet.decrypt(encrypted_password.encode()).decode()
-        hashed_password = generate_password_hash(default_admin_password, method='pbkdf2:sha256')
-        admin_user = User(username='admin', password=hashed_password, is_admin=True)
+        admin_user = User(username='admin', password=hash_password(default_admin_password), is_admin=True)
         db.session.add(admin_user)
         db.session.commit()
         print("Default admin user created: username='admin'")
 
+def _load_auth_user(user_id):
+    user = db.session.get(User, user_id)
+    return AuthUser.from_model(user) if user else None
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
-
-# In-memory dict: token -> file_id
-# For real usage, store tokens in a database or table for persistence
-token_map = {}
+    # Session users come from a short-TTL cache instead of one query per request
+    return user_cache.get(int(user_id), _load_auth_user)
+
+@login_manager.request_loader
+def load_user_from_token(request):
+    # API clients: a Bearer token from /api/token carries the user in its signed claims
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        return None
+    try:
+        claims = decode_token(header[len('Bearer '):])
+    except Exception:
+        return None
+    if claims.get('type') != 'access':
+        return None
+    return AuthUser(int(claims['sub']), claims.get('username'), claims.get('is_admin', False))
+
+# Token store: token -> file_id, shared across workers and persisted across restarts
+token_store = create_token_store(app.config)
+job_queue = JobQueue(
+    app.config['JOB_DB_PATH'],
+    max_attempts=app.config['JOB_MAX_ATTEMPTS'],
+    lease_seconds=app.config['JOB_LEASE_SECONDS'],
+    retry_delay=app.config['JOB_RETRY_DELAY'],
+    retention_seconds=app.config['JOB_RETENTION_SECONDS']
+)
+thumbnails = ThumbnailCache(
+    app.config['THUMBNAIL_DIR'],
+    app.config['THUMBNAIL_SIZES'],
+    quota_bytes=app.config['THUMBNAIL_QUOTA_MB'] * 1024 * 1024,
+    fmt=app.config['THUMBNAIL_FORMAT'],
+    quality=app.config['THUMBNAIL_QUALITY']
+)
+qr_cache = QRCache(
+    max_items=app.config['QR_CACHE_SIZE'],
+    disk_dir=app.config['QR_CACHE_DIR'] or None,
+    disk_quota_bytes=app.config['QR_CACHE_QUOTA_MB'] * 1024 * 1024
+)
+
+# Request and stage timings, summed over all workers at /metrics
+metrics.configure(
+    app.config['METRICS_DIR'] if app.config['METRICS_ENABLED'] else None,
+    flush_interval=app.config['METRICS_FLUSH_INTERVAL'],
+    enabled=app.config['METRICS_ENABLED']
+)
+metrics.describe("qrapp_request_seconds", "Request latency by endpoint, method and status.")
+metrics.describe("qrapp_stage_seconds", "Time spent per processing stage (decode, embed, vector query...).")
+metrics.describe("qrapp_slow_requests_total", "Requests slower than SLOW_REQUEST_MS.")
+metrics.describe("qrapp_cache_hits_total", "Cache hits per cache.")
+metrics.describe("qrapp_cache_misses_total", "Cache misses per cache.")
+metrics.describe("qrapp_cache_hit_ratio", "Hits / (hits + misses) per cache, over all workers.")
+metrics.describe("qrapp_collection_records", "Records in the active vector collection.")
+metrics.describe("qrapp_jobs", "Ingestion jobs per status (queued = queue depth).")
+
+def _cache_counters():
+    caches = {
+        "query_embeddings": chroma_db.embedding_cache,
+        "search_results": chroma_db.result_cache,
+        "qr": qr_cache,
+        "users": user_cache
+    }
+    for name, cache in caches.items():
+        yield "qrapp_cache_hits_total", {"cache": name}, cache.hits
+        yield "qrapp_cache_misses_total", {"cache": name}, cache.misses
+
+metrics.add_collector(_cache_counters)
+
+profiler = None
+if app.config['PROFILE_SLOW_REQUESTS']:
+    profiler = SlowRequestProfiler(
+        app.config['PROFILE_DIR'],
+        threshold=app.config['SLOW_REQUEST_MS'] / 1000,
+        interval=app.config['PROFILE_INTERVAL_MS'] / 1000,
+        max_files=app.config['PROFILE_MAX_FILES']
+    )
+
+@app.before_request
+def _start_request_timer():
+    g.request_start = time.perf_counter()
+    metrics.begin_trace()
+    if profiler is not None:
+        profiler.start()
+
+def _finish_request_timing(status):
+    start = g.pop('request_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    endpoint = request.endpoint or "unmatched"
+    metrics.observe("qrapp_request_seconds", elapsed, endpoint=endpoint, method=request.method, status=status)
+    trace = metrics.end_trace()
+    profile = profiler.stop(elapsed, endpoint) if profiler is not None else None
+    if elapsed * 1000 >= app.config['SLOW_REQUEST_MS']:
+        metrics.inc("qrapp_slow_requests_total", endpoint=endpoint)
+        stages = ", ".join(f"{stage} {seconds * 1000:.0f} ms" for stage, seconds in trace) or "no spans"
+        print(f"[WARN] Slow request {request.method} {request.path}: {elapsed * 1000:.0f} ms ({stages})"
+              + (f", profile saved to {profile}" if profile else ""))
+
+@app.after_request
+def _record_request(response):
+    _finish_request_timing(str(response.status_code))
+    return response
+
+@app.teardown_request
+def _record_failed_request(exc):
+    # after_request is skipped when an exception propagates (debug mode, or a
+    # failing after_request hook): count the request as a 500 here instead
+    if 'request_start' in g:
+        _finish_request_timing("500")
 
 @app.route('/')
 @login_required
 def index():
-    files = chroma_db.get_all_files()
-    return render_template('index.html', files=files)
+    page = _list_files_page()
+    return render_template('index.html', files=page["files"], page=page)
+
+@app.route('/files')
+@login_required
+def list_files():
+    return jsonify(_list_files_page())
+
+def _list_files_page():
+    limit = min(max(1, request.args.get('limit', app.config['FILES_PAGE_SIZE'], type=int)), app.config['FILES_PAGE_MAX'])
+    offset = max(0, request.args.get('offset', 0, type=int))
+    return chroma_db.list_files(
+        limit=limit,
+        offset=offset,
+        file_type=request.args.get('type') or None,
+        filename=request.args.get('filename') or None
+    )
 
 @app.route("/dashboard")
 @login_required
@@ -73,6 +218,10 @@ def dashboard():
     users = User.query.all()
     return render_template("dashboard.html", users=users)
 
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({"error": "File too large", "details": e.description}), 413
+
 @app.route('/upload_text', methods=['POST'])
 def upload_text():
     text = request.form.get('text')
@@ -83,6 +232,22 @@ def upload_text():
     doc_id = chroma_db.add_text_document(text, metadata)
     return jsonify({"message": "Text stored successfully", "document_id": doc_id})
 
+def _add_duplicate(source_id, metadata, filepath, is_new):
+    """
+    Index an upload whose bytes are already stored as `source_id` by reusing
+    its embedding. Returns the new id, or None when the hash index is stale
+    (the source record is gone) and the upload has to be ingested normally.
+    """
+    try:
+        img_id, path = chroma_db.add_image_reference(source_id, metadata)
+    except KeyError as e:
+        print(f"[WARN] Stale hash index entry, indexing the upload again: {e}")
+        return None
+    # The reference points at the existing copy (e.g. a pre-content-addressing path)
+    if os.path.abspath(path) != os.path.abspath(filepath):
+        discard_upload(filepath, is_new, chroma_db)
+    return img_id
+
 @app.route('/upload_image', methods=['POST'])
 def upload_image():
     if 'file' not in request.files:
@@ -93,99 +258,469 @@ def upload_image():
 
     filename = secure_filename(file.filename)
     upload_folder = os.path.abspath(app.config['UPLOAD_FOLDER'])
-    os.makedirs(upload_folder, exist_ok=True)
-    filepath = os.path.join(upload_folder, filename)
-
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    is_pdf = extension in app.config['PDF_EXTENSIONS']
     try:
-        file.save(filepath)
-        with Image.open(filepath) as img:
-            img.verify()
-    except Exception as e:
-        os.remove(filepath)
-        return jsonify({"error": "Invalid image file", "details": str(e)}), 400
+        # The header is checked on the first chunk, before the rest is written
+        filepath, sha256, is_new = store_upload(
+            file, upload_folder, extension, validate=check_pdf_header if is_pdf else check_image_header
+        )
+    except UploadRejected as e:
+        error = "Invalid PDF file" if is_pdf else "Invalid image file"
+        return jsonify({"error": error, "details": str(e)}), 400
+
+    if is_pdf:
+        return _upload_pdf(filename, filepath, sha256, is_new)
 
-    relative_path = os.path.relpath(filepath, os.getcwd())
     metadata = {
         "type": "image",
         "filename": filename,
-        "path": relative_path,
-        "description": filename  # Para que se pueda buscar como texto tambin
+        "path": os.path.relpath(filepath, os.getcwd()),
+        "description": filename,  # Para que se pueda buscar como texto tambin
+        **stored_file_fields(filepath, sha256)
     }
 
-    # Guarda tanto el texto como la imagen
-    img_id = chroma_db.add_image_with_text(filepath, description=filename, metadata=metadata)
+    # Same bytes already indexed: reuse the stored file and its embedding
+    duplicate_of = chroma_db.find_duplicate(sha256)
+    img_id = _add_duplicate(duplicate_of, metadata, filepath, is_new) if duplicate_of else None
+    if img_id:
+        return jsonify({"message": "Image stored successfully", "image_id": img_id, "duplicate_of": duplicate_of})
+
+    if app.config['INGEST_ASYNC']:
+        job_id = job_queue.enqueue("image", {"path": filepath, "description": filename, "metadata": metadata})
+        return jsonify({
+            "message": "Image queued for indexing",
+            "job_id": job_id,
+            "status_url": url_for('job_status', job_id=job_id)
+        }), 202
+
+    # Guarda tanto el texto como la imagen (add_images_bulk runs the full verify)
+    result = chroma_db.add_images_bulk([{"path": filepath, "description": filename, "metadata": metadata}])[0]
+    if "id" not in result:
+        discard_upload(filepath, is_new, chroma_db)
+        if result.get("invalid"):
+            return jsonify({"error": "Invalid image file", "details": result["error"]}), 400
+        return jsonify({"error": "Could not index image", "details": result.get("error")}), 500
+    img_id = result["id"]
+    if app.config['THUMBNAIL_ON_UPLOAD']:
+        _pregenerate_thumbnails(img_id)
     return jsonify({"message": "Image stored successfully", "image_id": img_id})
 
+def _pdf_options():
+    return {
+        "dpi": app.config['PDF_DPI'],
+        "max_px": app.config['PDF_MAX_PX'],
+        "workers": app.config['PDF_WORKERS'],
+        "window": app.config['PDF_PAGE_WINDOW']
+    }
+
+def _upload_pdf(filename, filepath, sha256, is_new):
+    metadata = {
+        "type": "pdf",
+        "filename": filename,
+        "path": os.path.relpath(filepath, os.getcwd()),
+        "description": filename,
+        **stored_file_fields(filepath, sha256)
+    }
+    if app.config['INGEST_ASYNC']:
+        job_id = job_queue.enqueue("pdf", {"path": filepath, "description": filename, "metadata": metadata})
+        return jsonify({
+            "message": "PDF queued for indexing",
+            "job_id": job_id,
+            "status_url": url_for('job_status', job_id=job_id)
+        }), 202
+
+    try:
+        doc_id = chroma_db.add_pdf(
+            filepath,
+            iter_pdf_pages(filepath, **_pdf_options()),
+            description=filename,
+            metadata=metadata,
+            batch_size=app.config['INGEST_BATCH_SIZE']
+        )
+    except Exception as e:
+        discard_upload(filepath, is_new, chroma_db)
+        return jsonify({"error": "Could not index PDF", "details": str(e)}), 400
+    return jsonify({"message": "PDF stored successfully", "document_id": doc_id})
+
+@app.route('/upload_images', methods=['POST'])
+def upload_images():
+    files = [f for f in request.files.getlist('files') if f.filename]
+    if not files:
+        return jsonify({"error": "No files provided"}), 400
+
+    upload_folder = os.path.abspath(app.config['UPLOAD_FOLDER'])
+
+    response = []
+    items = []
+    pending = []  # (response index, is_new) for each entry of `items`
+    for file in files:
+        filename = secure_filename(file.filename)
+        extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+        entry = {"filename": filename}
+        response.append(entry)
+        try:
+            filepath, sha256, is_new = store_upload(file, upload_folder, extension, validate=check_image_header)
+        except UploadRejected as e:
+            entry["error"] = str(e)
+            continue
+        metadata = {
+            "type": "image",
+            "filename": filename,
+            "path": os.path.relpath(filepath, os.getcwd()),
+            "description": filename,
+            **stored_file_fields(filepath, sha256)
+        }
+
+        duplicate_of = chroma_db.find_duplicate(sha256)
+        img_id = _add_duplicate(duplicate_of, metadata, filepath, is_new) if duplicate_of else None
+        if img_id:
+            entry["image_id"] = img_id
+            entry["duplicate_of"] = duplicate_of
+            continue
+        items.append({"path": filepath, "description": filename, "metadata": metadata})
+        pending.append((len(response) - 1, is_new))
+
+    if app.config['INGEST_ASYNC']:
+        for item, (index, _) in zip(items, pending):
+            job_id = job_queue.enqueue("image", item)
+            response[index].update({
+                "job_id": job_id,
+                "status_url": url_for('job_status', job_id=job_id)
+            })
+        return jsonify({"message": f"{len(items)} images queued for indexing", "results": response}), 202
+
+    results = chroma_db.add_images_bulk(items, batch_size=app.config['INGEST_BATCH_SIZE'])
+
+    for item, (index, is_new), result in zip(items, pending, results):
+        entry = response[index]
+        if "id" in result:
+            entry["image_id"] = result["id"]
+            if app.config['THUMBNAIL_ON_UPLOAD']:
+                _pregenerate_thumbnails(result["id"])
+        else:
+            entry["error"] = result.get("error", "Unknown error")
+            discard_upload(item["path"], is_new, chroma_db)
+
+    stored = sum(1 for entry in response if "image_id" in entry)
+    return jsonify({
+        "message": f"{stored} of {len(response)} images stored successfully",
+        "results": response
+    })
+
+def _pregenerate_thumbnails(file_id):
+    metadata = chroma_db.get_file_metadata(file_id)
+    full_path = resolve_stored_path(metadata)
+    if full_path:
+        thumbnails.pregenerate(full_path, sha256=metadata.get("sha256"))
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+def _json_param(value):
+    return json.loads(value) if isinstance(value, str) else value
+
+def _number_param(value, name, cast):
+    # Query args are strings; a JSON body may hold anything (null, lists...)
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise ValueError(f"{name} must be a number")
+    return cast(value)
+
+def _search_options(values):
+    """
+    Parse the shared search parameters (n_results, where, where_document,
+    type, max_distance, include, ef_search, mmr, format) from query args,
+    form fields or a JSON body.
+    Raises ValueError on invalid input.
+    """
+    n_results = _number_param(values.get('n_results', 5), 'n_results', int)
+    if not 1 <= n_results <= app.config['SEARCH_MAX_RESULTS']:
+        raise ValueError(f"n_results must be between 1 and {app.config['SEARCH_MAX_RESULTS']}")
+
+    where = _json_param(values.get('where')) or None
+    if values.get('type'):
+        where = {"$and": [where, {"type": values['type']}]} if where else {"type": values['type']}
+    where_document = _json_param(values.get('where_document')) or None
+    if where:
+        validate_where(where)
+    if where_document:
+        validate_where_document(where_document)
+
+    max_distance = values.get('max_distance')
+    max_distance = _number_param(max_distance, 'max_distance', float) if max_distance not in (None, '') else None
+    # mmr=<lambda> re-ranks for diversity; format=columnar returns columns instead of match dicts
+    mmr_lambda = values.get('mmr')
+    mmr_lambda = _number_param(mmr_lambda, 'mmr', float) if mmr_lambda not in (None, '') else None
+    if mmr_lambda is not None and not 0.0 <= mmr_lambda <= 1.0:
+        raise ValueError("mmr must be between 0 and 1")
+    result_format = values.get('format') or 'rows'
+    if result_format not in ('rows', 'columnar'):
+        raise ValueError("format must be rows or columnar")
+    columnar = result_format == 'columnar'
+    ef_search = values.get('ef_search')
+    ef_search = _number_param(ef_search, 'ef_search', int) if ef_search not in (None, '') else None
+    if ef_search is not None and not 1 <= ef_search <= app.config['HNSW_EF_SEARCH_MAX']:
+        raise ValueError(f"ef_search must be between 1 and {app.config['HNSW_EF_SEARCH_MAX']}")
+    include = values.get('include')
+    if isinstance(include, str):
+        include = [field.strip() for field in include.split(',') if field.strip()]
+    if include is not None and (not isinstance(include, list) or not all(isinstance(field, str) for field in include)):
+        raise ValueError("include must be a list of field names or a comma-separated string")
+    if include is not None and not set(include) <= set(SEARCH_INCLUDE):
+        raise ValueError(f"include must be a subset of {', '.join(SEARCH_INCLUDE)}")
+
+    return {
+        "n_results": n_results,
+        "where": where,
+        "where_document": where_document,
+        "max_distance": max_distance,
+        "include": include,
+        "ef_search": ef_search,
+        "mmr_lambda": mmr_lambda,
+        "columnar": columnar
+    }
+
 @app.route('/search_text', methods=['GET'])
 def search_text():
     query = request.args.get('q')
     if not query:
         return "Query text required", 400
-    results = chroma_db.search_by_text(query)
+    mode = request.args.get('mode', 'vector')
+    if mode not in ('vector', 'keyword', 'hybrid'):
+        return "Invalid search mode", 400
+    try:
+        options = _search_options(request.args)
+        if mode != 'vector' and (options['mmr_lambda'] is not None or options['columnar']):
+            raise ValueError("mmr and format=columnar only apply to mode=vector")
+    except ValueError as e:
+        return jsonify({"error": "Invalid search options", "details": str(e)}), 400
+    results = chroma_db.search_by_text(query, mode=mode, **options)
     return jsonify(results)
 
+@app.route('/search_batch', methods=['POST'])
+def search_batch():
+    """
+    Vector search for many texts in one call:
+    {"queries": [...], "n_results": 5, "where": {...}, ...} -> {"results": [[...], ...]}
+    """
+    body = request.get_json(silent=True) or {}
+    queries = body.get('queries')
+    if not isinstance(queries, list) or not queries or not all(isinstance(q, str) and q for q in queries):
+        return jsonify({"error": "queries must be a non-empty list of strings"}), 400
+    if len(queries) > app.config['SEARCH_BATCH_MAX_QUERIES']:
+        return jsonify({"error": f"At most {app.config['SEARCH_BATCH_MAX_QUERIES']} queries per call"}), 400
+    try:
+        options = _search_options(body)
+    except ValueError as e:
+        return jsonify({"error": "Invalid search options", "details": str(e)}), 400
+    return jsonify({"results": chroma_db.search_many(queries, **options)})
+
 @app.route('/search_image', methods=['POST'])
 def search_image():
     if 'file' not in request.files:
         return "No file provided", 400
     file = request.files['file']
-    filename = secure_filename(file.filename)
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(filepath)
-    results = chroma_db.search_by_image(filepath)
+    try:
+        options = _search_options(request.form)
+    except ValueError as e:
+        return jsonify({"error": "Invalid search options", "details": str(e)}), 400
+    # Query images are never persisted: read (size-limited) into memory and search
+    try:
+        content = read_upload(file, app.config['SEARCH_IMAGE_MAX_BYTES'], validate=check_image_header)
+    except UploadRejected as e:
+        return jsonify({"error": "Invalid image file", "details": str(e)}), 400
+    results = chroma_db.search_by_image_bytes(content, **options)
     return jsonify(results)
 
+@app.route('/cache_stats')
+@login_required
+def cache_stats():
+    return jsonify(chroma_db.cache_stats())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not app.config['METRICS_ENABLED']:
+        return "Metrics are disabled", 404
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        return "Unauthorized", 401
+
+    collected = metrics.collect()
+    counters = collected[1]
+    gauges = []
+    for (name, labels), hits in counters.items():
+        if name == "qrapp_cache_hits_total":
+            misses = counters.get(("qrapp_cache_misses_total", labels), 0)
+            gauges.append(("qrapp_cache_hit_ratio", dict(labels), hits / (hits + misses) if hits + misses else 0.0))
+    try:
+        gauges.append(("qrapp_collection_records", {}, chroma_db.collection.count()))
+    except Exception as e:
+        print(f"[WARN] Could not count collection records: {e}")
+    job_counts = job_queue.counts()
+    for status in (QUEUED, RUNNING, FAILED, DEAD):
+        gauges.append(("qrapp_jobs", {"status": status}, job_counts.get(status, 0)))
+    return metrics.render(gauges, collected), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 @app.route('/generate_qr/<file_id>')
 def generate_qr(file_id):
     file_metadata = chroma_db.get_file_metadata(file_id)
     if not file_metadata or "path" not in file_metadata:
         return "File not found", 404
 
-    token = str(uuid.uuid4())
-    token_map[token] = file_id
+    fmt = request.args.get('format', app.config['QR_FORMAT']).lower()
+    error_correction = request.args.get('ec', app.config['QR_ERROR_CORRECTION']).upper()
+    box_size = request.args.get('box_size', app.config['QR_BOX_SIZE'], type=int)
+    if fmt not in QR_MIMETYPES or error_correction not in ERROR_CORRECTION_LEVELS or not 1 <= box_size <= 50:
+        return "Invalid QR options", 400
+
+    ttl = app.config['QR_TOKEN_TTL']
+    max_uses = app.config['QR_TOKEN_MAX_USES']
+    active = None
+    with metrics.span("qr.token"):
+        if app.config['QR_REUSE_TOKENS'] and max_uses is None:
+            # Only reuse tokens with at least half their lifetime left
+            active = token_store.find_active(file_id, min_remaining=ttl // 2)
+        if active:
+            token, expires_at = active
+        else:
+            token = token_store.create(file_id, ttl=ttl, max_uses=max_uses)
+            expires_at = time.time() + ttl if ttl else None
     file_url = url_for('access_via_token', token=token, _external=True)
 
-    qr = qrcode.make(file_url)
-    img_io = BytesIO()
-    qr.save(img_io, 'PNG')
-    img_io.seek(0)
-    return send_file(img_io, mimetype='image/png')
+    etag, content = qr_cache.get_or_render(file_url, box_size, error_correction, fmt)
+    max_age = max(0, int(expires_at - time.time())) if expires_at else 86400
+    response = send_file(
+        BytesIO(content),
+        mimetype=QR_MIMETYPES[fmt],
+        etag=etag,
+        max_age=max_age,
+        conditional=True
+    )
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+@app.route('/generate_qr_sheet', methods=['POST'])
+def generate_qr_sheet():
+    data = request.get_json(silent=True) or {}
+    file_ids = data.get("file_ids")
+    where = data.get("where")
+    if file_ids is not None and (not isinstance(file_ids, list) or not all(isinstance(i, str) for i in file_ids)):
+        return jsonify({"error": "file_ids must be a list of ids"}), 400
+    if not file_ids and not where:
+        return jsonify({"error": "file_ids or where filter required"}), 400
+    if where:
+        try:
+            validate_where(where)
+        except ValueError as e:
+            return jsonify({"error": "Invalid where filter", "details": str(e)}), 400
+        # One code per document, not one per page record sharing its path
+        where = {"$and": [where, DOCUMENTS_ONLY]}
+
+    fmt = data.get("format", "pdf")
+    error_correction = data.get("ec", app.config['QR_ERROR_CORRECTION'])
+    if not isinstance(fmt, str) or not isinstance(error_correction, str):
+        return jsonify({"error": "format and ec must be strings"}), 400
+    fmt = fmt.lower()
+    error_correction = error_correction.upper()
+    try:
+        columns = int(data.get("columns", 4))
+        rows = int(data.get("rows", 5))
+    except (TypeError, ValueError):
+        return jsonify({"error": "columns and rows must be integers"}), 400
+    if fmt not in ("pdf", "png") or error_correction not in ERROR_CORRECTION_LEVELS \
+            or not 1 <= columns <= 10 or not 1 <= rows <= 20:
+        return jsonify({"error": "Invalid sheet options"}), 400
+
+    max_files = app.config['QR_SHEET_MAX_FILES'] if fmt == "pdf" else app.config['QR_SHEET_PNG_MAX_FILES']
+    too_many = {"error": f"Too many files for a {fmt} sheet (max {max_files})"}
+    if file_ids and len(file_ids) > max_files:
+        return jsonify(too_many), 400
+    try:
+        # One record past the cap is enough to refuse without loading every match
+        matches = chroma_db.get_files_metadata(file_ids=file_ids, where=where, limit=max_files + 1)
+    except InvalidArgumentError as e:
+        # validate_where only checks the shape; Chroma rejects unknown operators here
+        return jsonify({"error": "Invalid where filter", "details": str(e)}), 400
+    if len(matches) > max_files:
+        return jsonify(too_many), 400
+    files = [(file_id, metadata) for file_id, metadata in matches if metadata and "path" in metadata]
+    if not files:
+        return jsonify({"error": "No files found"}), 404
+
+    ttl = app.config['QR_TOKEN_TTL']
+    max_uses = app.config['QR_TOKEN_MAX_USES']
+    tokens = {}
+    if app.config['QR_REUSE_TOKENS'] and max_uses is None:
+        for file_id, _ in files:
+            active = token_store.find_active(file_id, min_remaining=ttl // 2)
+            if active:
+                tokens[file_id] = active[0]
+    new_ids = [file_id for file_id, _ in files if file_id not in tokens]
+    tokens.update(zip(new_ids, token_store.create_many(new_ids, ttl=ttl, max_uses=max_uses)))
+
+    urls = [url_for('access_via_token', token=tokens[file_id], _external=True) for file_id, _ in files]
+    images = render_many(urls, qr_cache, box_size=app.config['QR_BOX_SIZE'], error_correction=error_correction)
+    captions = [metadata.get("filename", file_id) for file_id, metadata in files]
+    # PDF pages are drawn and sent one at a time
+    sheet = build_sheet(list(zip(captions, images)), fmt=fmt, columns=columns, rows=rows)
+
+    return Response(
+        sheet,
+        mimetype="application/pdf" if fmt == "pdf" else "image/png",
+        headers={"Content-Disposition": f"attachment; filename=qr_sheet.{fmt}"}
+    )
 
 @app.route('/access/<token>')
 def access_via_token(token):
-    if token not in token_map:
+    file_id = token_store.resolve(token)
+    if file_id is None:
         return "Invalid or expired token", 404
 
-    file_id = token_map[token]
-    file_metadata = chroma_db.get_file_metadata(file_id)
-    if not file_metadata or "path" not in file_metadata:
-        return "File not found", 404
-
-    full_path = os.path.join(os.getcwd(), file_metadata["path"])
-    if not os.path.exists(full_path):
-        return "File not found on disk", 404
-
-    return send_file(full_path)
+    return serve_stored_file(chroma_db.get_file_metadata(file_id))
 
 @app.route('/view_file/<string:file_id>')
 def view_file(file_id):
+    return serve_stored_file(chroma_db.get_file_metadata(file_id))
+
+@app.route('/thumb/<string:file_id>/<size>')
+def thumbnail(file_id, size):
+    if size not in app.config['THUMBNAIL_SIZES']:
+        return "Unknown thumbnail size", 404
     file_metadata = chroma_db.get_file_metadata(file_id)
-    if not file_metadata or "path" not in file_metadata:
+    full_path = resolve_stored_path(file_metadata)
+    if full_path is None or file_metadata.get("type") != "image":
         return "File not found", 404
-
-    full_path = os.path.join(os.getcwd(), file_metadata["path"])
     if not os.path.exists(full_path):
         return "File not found on disk", 404
 
-    return send_file(full_path)
+    try:
+        thumb_path = thumbnails.get_or_create(full_path, size, sha256=file_metadata.get("sha256"))
+    except Exception as e:
+        return jsonify({"error": "Could not create preview", "details": str(e)}), 500
+
+    # Content-addressed: the bytes for this name never change
+    response = send_file(
+        thumb_path,
+        mimetype=thumbnails.mimetype,
+        conditional=True,
+        etag=os.path.splitext(os.path.basename(thumb_path))[0],
+        max_age=30 * 24 * 3600
+    )
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
 
 @app.route('/download_file/<string:file_id>')
 def download_file(file_id):
-    file_metadata = chroma_db.get_file_metadata(file_id)
-    full_path = os.path.join(os.getcwd(), file_metadata["path"])
-    return send_file(full_path, as_attachment=True)
+    return serve_stored_file(chroma_db.get_file_metadata(file_id), as_attachment=True)
 
 @app.route('/delete_file/<file_id>', methods=['POST'])
+@login_required
 def delete_file(file_id):
     try:
         chroma_db.delete_file(file_id)
@@ -193,6 +728,161 @@ def delete_file(file_id):
     except Exception as e:
         return jsonify({"error": "Failed to delete file", "details": str(e)}), 500
 
+@app.route('/delete_files', methods=['POST'])
+@login_required
+def delete_files():
+    data = request.get_json(silent=True) or {}
+    file_ids = data.get("file_ids")
+    where = data.get("where")
+    if file_ids is not None and (not isinstance(file_ids, list) or not all(isinstance(i, str) for i in file_ids)):
+        return jsonify({"error": "file_ids must be a list of ids"}), 400
+    if not file_ids and not where:
+        return jsonify({"error": "file_ids or where filter required"}), 400
+    if file_ids and len(file_ids) > app.config['DELETE_MAX_IDS']:
+        return jsonify({"error": f"Too many ids (max {app.config['DELETE_MAX_IDS']})"}), 400
+    if where:
+        try:
+            validate_where(where)
+        except ValueError as e:
+            return jsonify({"error": "Invalid where filter", "details": str(e)}), 400
+
+    try:
+        result = chroma_db.delete_files(file_ids=file_ids or None, where=where or None,
+                                        batch_size=app.config['DELETE_BATCH_SIZE'])
+    except InvalidArgumentError as e:
+        return jsonify({"error": "Invalid where filter", "details": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": "Failed to delete files", "details": str(e)}), 500
+    return jsonify({"message": "Files deleted successfully", **result})
+
+@app.cli.command("rebuild-metadata-index")
+def rebuild_metadata_index():
+    """Rebuild the local metadata index from the Chroma collection."""
+    if chroma_db.metadata_index is None:
+        print("Metadata index is disabled (METADATA_INDEX_PATH is empty).")
+        return
+    total = chroma_db.metadata_index.rebuild(chroma_db.collection)
+    print(f"Indexed {total} records.")
+
+@app.cli.command("rebuild-keyword-index")
+def rebuild_keyword_index():
+    """Rebuild the full-text keyword index from the Chroma collection."""
+    if chroma_db.keyword_index is None:
+        print("Keyword index is disabled (KEYWORD_INDEX_PATH is empty or FTS5 unavailable).")
+        return
+    total = chroma_db.keyword_index.rebuild(chroma_db.collection)
+    print(f"Indexed {total} records.")
+
+@app.cli.command("rebuild-index")
+@click.option("--space", type=click.Choice(["l2", "cosine", "ip"]), default=None, help="Default: HNSW_SPACE.")
+@click.option("--ef-construction", type=int, default=None, help="Default: HNSW_EF_CONSTRUCTION.")
+@click.option("--ef-search", type=int, default=None, help="Default: HNSW_EF_SEARCH.")
+@click.option("--m", "max_neighbors", type=int, default=None, help="Default: HNSW_M.")
+@click.option("--batch-size", default=500, show_default=True)
+@click.option("--drop-old", is_flag=True, help="Delete the previous collection after the swap.")
+@click.option("--full-vectors", is_flag=True, help="Turn a compact collection back into full vectors.")
+def rebuild_index(space, ef_construction, ef_search, max_neighbors, batch_size, drop_old, full_vectors):
+    """Copy the collection into one with new HNSW settings and swap it in."""
+    overrides = {
+        "space": space,
+        "ef_construction": ef_construction,
+        "ef_search": ef_search,
+        "max_neighbors": max_neighbors
+    }
+    hnsw = {key: value for key, value in overrides.items() if value is not None}
+    name, total = chroma_db.rebuild_index(
+        hnsw, batch_size=batch_size, drop_old=drop_old, compact_dims=0 if full_vectors else None
+    )
+    print(f"Copied {total} records into {name}; it is now the active collection.")
+
+@app.cli.command("build-compact-index")
+@click.option("--dims", default=None, type=int, help="Reduced dimensions (default: COMPACT_DIMS).")
+@click.option("--sample", default=20000, show_default=True, help="Vectors used to fit the PCA projection.")
+@click.option("--batch-size", default=500, show_default=True)
+@click.option("--drop-old", is_flag=True, help="Delete the previous collection after the swap.")
+def build_compact_index(dims, sample, batch_size, drop_old):
+    """Rebuild the collection with PCA-reduced vectors and swap it in."""
+    if chroma_db.compact_index is None:
+        print("Compact index is disabled (COMPACT_INDEX_DIR is empty).")
+        return
+    name, total = chroma_db.rebuild_index(
+        compact_dims=dims or app.config['COMPACT_DIMS'], sample_size=sample, batch_size=batch_size, drop_old=drop_old
+    )
+    print(f"Copied {total} records into {name}; it is now the active collection.")
+
+@app.cli.command("compact-recall-report")
+@click.option("--queries", default=100, show_default=True)
+@click.option("-k", default=10, show_default=True)
+def compact_recall_report(queries, k):
+    """Compare recall@k and latency of compact search against exact search."""
+    if chroma_db.compact_index is None:
+        print("Compact index is disabled (COMPACT_INDEX_DIR is empty).")
+        return
+    collection = chroma_db.collection
+    report = recall_report(collection, chroma_db.compact_index, queries=queries, k=k, space=chroma_db._space)
+    if report is None:
+        print("The collection is not compact or is empty; run `flask build-compact-index` first.")
+        return
+    print(f"{report['queries']} queries, recall@{report['k']}: {report['recall_at_k']:.3f}")
+    print(f"exact:   mean {report['exact_ms_mean']:.2f} ms, p95 {report['exact_ms_p95']:.2f} ms")
+    print(f"compact: mean {report['compact_ms_mean']:.2f} ms, p95 {report['compact_ms_p95']:.2f} ms")
+
+@app.cli.command("ingest-worker")
+@click.option("--processes", default=1, show_default=True, help="Number of worker processes.")
+@click.option("--poll-interval", default=1.0, show_default=True, help="Seconds to wait when the queue is empty.")
+def ingest_worker(processes, poll_interval):
+    """Embed and index queued uploads."""
+    # Load the model once before forking so the worker processes share it
+    chroma_db.embedding_function.warm_up()
+    on_stored = _pregenerate_thumbnails if app.config['THUMBNAIL_ON_UPLOAD'] else None
+    run_workers(
+        processes, job_queue, chroma_db,
+        batch_size=app.config['INGEST_BATCH_SIZE'],
+        poll_interval=poll_interval,
+        on_stored=on_stored,
+        pdf_options=_pdf_options()
+    )
+
+@app.cli.command("gc")
+@click.option("--apply", is_flag=True, help="Delete the orphans (the default only reports them).")
+@click.option("--force", is_flag=True, help="Delete even when most records or files look orphaned.")
+@click.option("--batch-size", default=500, show_default=True)
+@click.option("--min-age", default=3600, show_default=True, help="Never remove files modified this recently (s).")
+def garbage_collect(apply, force, batch_size, min_age):
+    """Delete records whose file is missing and files no record points at."""
+    def report(kind, item, detail):
+        if kind == "record":
+            print(f"Orphan record {item} (missing {detail})")
+        else:
+            print(f"Orphan file {item} ({detail} bytes)")
+
+    try:
+        stats = collect_garbage(
+            chroma_db, app.config['UPLOAD_FOLDER'],
+            base_dir=app.config['BASE_DIR'],
+            dry_run=not apply,
+            batch_size=batch_size,
+            min_age=min_age,
+            protected=job_queue.pending_paths(),
+            report=report,
+            max_ratio=None if force else 0.5
+        )
+    except GarbageCollectionRefused as e:
+        print(f"[ERROR] Nothing deleted: {e}. Check CHROMA_DB_DIR and UPLOAD_FOLDER, or pass --force.")
+        raise click.exceptions.Exit(1)
+    print(f"{stats['dangling_records']} dangling records ({stats['records_deleted']} deleted), "
+          f"{stats['orphan_files']} orphan files, {stats['orphan_bytes'] / 1024 / 1024:.1f} MB "
+          f"({stats['files_removed']} removed).")
+    if not apply:
+        if stats['refused']:
+            print(f"[WARN] --apply would refuse to delete: {stats['refused']}.")
+        print("Dry run: pass --apply to delete.")
+
+@app.cli.command("requeue-dead-jobs")
+def requeue_dead_jobs():
+    """Retry every job in the dead-letter state."""
+    print(f"Requeued {job_queue.requeue_dead()} jobs.")
+
 if __name__ == '__main__':
     with app.app_context():
         create_default_admin()
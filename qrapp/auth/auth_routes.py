@@ -1,7 +1,8 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, current_app
 from flask_login import login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
-from .models import db, User
+from flask_jwt_extended import create_access_token
+from .models import db, User, hash_password
+from .user_cache import AuthUser, user_cache
 
 auth = Blueprint('auth', __name__)
 
@@ -45,10 +46,10 @@ def create_user():
     if User.query.filter_by(username=username).first():
         return jsonify({"error": "User already exists"}), 400
 
-    hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
-    new_user = User(username=username, password=hashed_password, is_admin=is_admin)
+    new_user = User(username=username, password=hash_password(password), is_admin=is_admin)
     db.session.add(new_user)
     db.session.commit()
+    user_cache.invalidate()
 
     return jsonify({
         "message": "User created successfully",
@@ -73,6 +74,7 @@ def delete_user(user_id):
         return jsonify({"error": "User not found"}), 404
     db.session.delete(user)
     db.session.commit()
+    user_cache.invalidate()
     return jsonify({"message": "User deleted successfully", "user_id": user_id})
 
 
@@ -83,16 +85,42 @@ def login():
         password = request.form.get('password')
 
         user = User.query.filter_by(username=username).first()
-        if not user or not check_password_hash(user.password, password):
+        if not user or not user.check_password(password):
             flash("Invalid username or password", "danger")
             return redirect(url_for('auth.login'))
+        if db.session.dirty:
+            db.session.commit()  # weaker password hash replaced
 
         login_user(user)
+        user_cache.put(AuthUser.from_model(user))
         flash("Login successful!", "success")
         return redirect(url_for('index'))
 
     return render_template('login.html')
 
+@auth.route('/api/token', methods=['POST'])
+def api_token():
+    # API clients trade credentials for a signed access token once, then send
+    # "Authorization: Bearer <token>"; those requests never read the users table
+    data = request.get_json(silent=True) or {}
+    username = data.get("username")
+    password = data.get("password")
+    if not username or not password:
+        return jsonify({"error": "Missing username or password"}), 400
+
+    user = User.query.filter_by(username=username).first()
+    if not user or not user.check_password(password):
+        return jsonify({"error": "Invalid username or password"}), 401
+    if db.session.dirty:
+        db.session.commit()
+
+    token = create_access_token(
+        identity=str(user.id),
+        additional_claims={"username": user.username, "is_admin": bool(user.is_admin)}
+    )
+    expires = current_app.config['JWT_ACCESS_TOKEN_EXPIRES']
+    return jsonify({"access_token": token, "token_type": "Bearer", "expires_in": int(expires.total_seconds())})
+
 @auth.route('/logout')
 @login_required
 def logout():
@@ -1,11 +1,57 @@
+from functools import lru_cache
+
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from werkzeug.security import generate_password_hash, check_password_hash
 
 db = SQLAlchemy()
 
+def _method_options():
+    # An empty PASSWORD_HASH_METHOD means werkzeug's own default
+    method = current_app.config['PASSWORD_HASH_METHOD']
+    return {"method": method} if method else {}
+
+def hash_password(password):
+    return generate_password_hash(password, **_method_options())
+
+@lru_cache(maxsize=None)
+def _canonical_method(method):
+    # werkzeug fills in the defaults, e.g. "scrypt" -> "scrypt:32768:8:1"
+    options = {"method": method} if method else {}
+    return generate_password_hash("", **options).split("$", 1)[0]
+
+def password_needs_rehash(password_hash):
+    """
+    True when `password_hash` was made with another algorithm than
+    PASSWORD_HASH_METHOD, or with weaker parameters (fewer pbkdf2 iterations,
+    smaller scrypt costs). Stronger stored hashes are kept.
+    """
+    stored = password_hash.split("$", 1)[0].split(":")
+    target = _canonical_method(current_app.config['PASSWORD_HASH_METHOD']).split(":")
+    if stored[0] != target[0] or len(stored) != len(target):
+        return True
+    try:
+        if stored[0] == "pbkdf2":
+            return stored[1] != target[1] or int(stored[2]) < int(target[2])
+        return any(int(have) < int(want) for have, want in zip(stored[1:], target[1:]))
+    except ValueError:
+        return True
+
 class User(UserMixin, db.Model):
     __tablename__ = "users"
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(100), unique=True, nullable=False)
     password = db.Column(db.String(100), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
+
+    def check_password(self, password):
+        """
+        Verify `password`. A hash weaker than PASSWORD_HASH_METHOD is replaced
+        with a new one (the caller commits).
+        """
+        if not check_password_hash(self.password, password):
+            return False
+        if password_needs_rehash(self.password):
+            self.password = hash_password(password)
+        return True
@@ -0,0 +1,112 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask_login import UserMixin
+
+
+class AuthUser(UserMixin):
+    """
+    Detached snapshot of a User (id, username, is_admin) used as current_user.
+    Unlike the ORM instance it can be kept across requests, or rebuilt from
+    JWT claims, without touching the users table.
+    """
+
+    def __init__(self, id, username, is_admin=False):
+        self.id = id
+        self.username = username
+        self.is_admin = bool(is_admin)
+
+    @classmethod
+    def from_model(cls, user):
+        return cls(user.id, user.username, user.is_admin)
+
+
+class UserCache:
+    """
+    Short-TTL, size-bounded cache of AuthUser by user id for Flask-Login's
+    per-request user loader.
+
+    `invalidate` (after a user is created or deleted) clears this process's
+    entries and touches a version file that every worker checks on lookup,
+    so a deleted user is logged out everywhere on the next request instead
+    of after the TTL.
+    """
+
+    def __init__(self, ttl=60, max_items=1024, version_path=None):
+        self.configure(ttl, max_items, version_path)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._seen_version = None
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, ttl=60, max_items=1024, version_path=None):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.version_path = os.path.abspath(version_path) if version_path else None
+
+    def init_app(self, app):
+        self.configure(
+            app.config['USER_CACHE_TTL'],
+            app.config['USER_CACHE_SIZE'],
+            app.config['USER_CACHE_VERSION_PATH']
+        )
+
+    def _check_version(self):
+        if not self.version_path:
+            return
+        try:
+            version = os.stat(self.version_path).st_mtime_ns
+        except OSError:
+            version = 0
+        if version != self._seen_version:
+            self._seen_version = version
+            with self._lock:
+                self._items.clear()
+
+    def get(self, user_id, load):
+        """
+        Return the cached AuthUser for `user_id`, calling `load(user_id)` (which
+        returns an AuthUser or None) on a miss or once the entry is `ttl` old.
+        """
+        self._check_version()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._items.get(user_id)
+            if entry is not None and entry[1] > now:
+                self._items.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        user = load(user_id)
+        if user is not None:
+            self.put(user)
+        return user
+
+    def put(self, user):
+        if self.ttl <= 0 or self.max_items <= 0:
+            return
+        with self._lock:
+            self._items[user.id] = (user, time.monotonic() + self.ttl)
+            self._items.move_to_end(user.id)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._items.clear()
+        if not self.version_path:
+            return
+        try:
+            with open(self.version_path, "a"):
+                pass
+            os.utime(self.version_path, ns=(time.time_ns(), time.time_ns()))
+        except OSError as e:
+            print(f"[WARN] Could not update user cache version: {e}")
+
+
+# Configured by the app with `user_cache.init_app(app)`
+user_cache = UserCache()
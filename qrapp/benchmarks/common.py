@@ -0,0 +1,89 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+
+def summarize(timings, items_per_call=1):
+    """
+    Latency percentiles (ms) and throughput for a list of per-call durations (s).
+    """
+    values = np.asarray(timings, dtype=np.float64) * 1000
+    total = float(values.sum()) / 1000
+    return {
+        "n": len(values),
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "ops_per_s": len(values) * items_per_call / total if total else None
+    }
+
+
+def timed(fn, repeats):
+    """
+    Call `fn(i)` `repeats` times and return the per-call durations.
+    """
+    timings = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        fn(i)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def synthetic_image(seed, size=(640, 480), fmt="PNG"):
+    """
+    Encoded bytes of a small, seed-unique test image.
+    """
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 255, size=(size[1] // 8, size[0] // 8, 3), dtype=np.uint8)
+    img = Image.fromarray(pixels).resize(size, Image.NEAREST)
+    out = BytesIO()
+    img.save(out, fmt)
+    return out.getvalue()
+
+
+def run_metadata(**extra):
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        revision = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": revision,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        **extra
+    }
+
+
+def write_results(results, out):
+    """
+    Write results as JSON to `out` (a path, or "-" for stdout).
+    """
+    data = json.dumps(results, indent=2)
+    if out == "-":
+        print(data)
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        f.write(data)
+    print(f"Results written to {out}")
+
+
+def print_table(rows):
+    print(f"{'benchmark':<40} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ops/s':>10}")
+    for row in rows:
+        ops = f"{row['ops_per_s']:.1f}" if row.get("ops_per_s") else "-"
+        print(f"{row['name']:<40} {row['n']:>6} {row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} "
+              f"{row['p99_ms']:>9.2f} {ops:>10}")
@@ -0,0 +1,52 @@
+"""
+Compare two benchmark result files.
+
+    python -m benchmarks.compare bench_results/before.json bench_results/after.json
+
+Prints the p50/p95 change per benchmark; exits with status 1 when any p95
+regressed by more than --threshold percent.
+"""
+import argparse
+import json
+import sys
+
+
+def _load(path):
+    with open(path) as f:
+        return {row["name"]: row for row in json.load(f)["results"]}
+
+
+def _delta(old, new):
+    return (new - old) / old * 100 if old else 0.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Allowed p95 regression in percent.")
+    args = parser.parse_args(argv)
+
+    baseline, candidate = _load(args.baseline), _load(args.candidate)
+    regressions = []
+    print(f"{'benchmark':<40} {'p50 ms':>17} {'p95 ms':>17} {'delta p95':>10}")
+    for name, new in candidate.items():
+        old = baseline.get(name)
+        if old is None:
+            print(f"{name:<40} {'(new)':>17}")
+            continue
+        p95_delta = _delta(old["p95_ms"], new["p95_ms"])
+        flag = ""
+        if p95_delta > args.threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<40} {old['p50_ms']:>8.2f}->{new['p50_ms']:<7.2f} "
+              f"{old['p95_ms']:>8.2f}->{new['p95_ms']:<7.2f} {p95_delta:>+9.1f}%{flag}")
+
+    if regressions:
+        print(f"[WARN] {len(regressions)} benchmark(s) regressed more than {args.threshold:.0f}% at p95")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
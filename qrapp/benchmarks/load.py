@@ -0,0 +1,176 @@
+"""
+In-process concurrent load generator for the Flask endpoints.
+
+    python -m benchmarks.load --seed 200 --threads 8 --duration 10 --out bench_results/load.json
+
+The app runs in a throwaway working directory (its own vector store, indexes,
+uploads and token store) with the stub embedding function unless --model is
+given. Each worker thread drives its own test client through a weighted mix of
+requests; per-endpoint throughput and p50/p95/p99 latency are reported.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from benchmarks.common import summarize, synthetic_image, run_metadata, write_results, print_table
+
+# (name, weight) of the request mix
+SCENARIOS = [
+    ("search_text", 30),
+    ("search_text[hybrid]", 10),
+    ("search_image", 5),
+    ("generate_qr", 20),
+    ("view_file", 15),
+    ("download_file", 10),
+    ("upload_image", 10)
+]
+
+
+def _isolate(workdir, use_model):
+    """
+    Point every on-disk store at `workdir` before the app is imported.
+    """
+    if not use_model:
+        os.environ["EMBEDDING_MODE"] = "stub"
+    for name, path in [
+        ("CHROMA_DB_DIR", "chromadb_data"),
+        ("METADATA_INDEX_PATH", "metadata_index.db"),
+        ("KEYWORD_INDEX_PATH", "keyword_index.db"),
+        ("JOB_DB_PATH", "jobs.db"),
+        ("TOKEN_DB_PATH", "tokens.db"),
+        ("THUMBNAIL_DIR", "thumbnails"),
+        ("COMPACT_INDEX_DIR", "compact_index"),
+        ("METRICS_DIR", "metrics"),
+        ("PROFILE_DIR", "profiles")
+    ]:
+        os.environ[name] = os.path.join(workdir, path)
+    os.environ["INGEST_ASYNC"] = "0"
+    os.environ["TOKEN_STORE"] = "sqlite"
+    # Stored paths are relative to the cwd
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.chdir(workdir)
+
+
+def _upload(client, seed):
+    data = {"file": (BytesIO(synthetic_image(seed)), f"plano_{seed}.png")}
+    return client.post("/upload_image", data=data, content_type="multipart/form-data")
+
+
+def _request(client, scenario, ids, seed):
+    if scenario == "search_text":
+        return client.get("/search_text", query_string={"q": f"plano planta {seed % 500}"})
+    if scenario == "search_text[hybrid]":
+        return client.get("/search_text", query_string={"q": f"plano_{seed % 500}", "mode": "hybrid"})
+    if scenario == "search_image":
+        data = {"file": (BytesIO(synthetic_image(seed % 50)), "query.png")}
+        return client.post("/search_image", data=data, content_type="multipart/form-data")
+    if scenario == "generate_qr":
+        return client.get(f"/generate_qr/{ids[seed % len(ids)]}")
+    if scenario == "view_file":
+        return client.get(f"/view_file/{ids[seed % len(ids)]}")
+    if scenario == "download_file":
+        return client.get(f"/download_file/{ids[seed % len(ids)]}")
+    if scenario == "upload_image":
+        return _upload(client, 1_000_000 + seed)
+    raise ValueError(scenario)
+
+
+def run_load(app, ids, threads, duration, scenarios):
+    names = [name for name, _ in scenarios]
+    weights = [weight for _, weight in scenarios]
+    timings = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(n):
+        client = app.test_client()
+        rng = random.Random(n)
+        local = {name: [] for name in names}
+        local_errors = {name: 0 for name in names}
+        while time.perf_counter() < deadline:
+            scenario = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            response = _request(client, scenario, ids, rng.randrange(1 << 30))
+            response.get_data()
+            local[scenario].append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                local_errors[scenario] += 1
+        with lock:
+            for name in names:
+                timings[name].extend(local[name])
+                errors[name] += local_errors[name]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(worker, range(threads)))
+    elapsed = time.perf_counter() - start
+
+    rows = []
+    for name in names:
+        if not timings[name]:
+            continue
+        row = {"name": name, **summarize(timings[name]), "errors": errors[name]}
+        # Throughput under concurrency is requests over wall time, not over summed latency
+        row["ops_per_s"] = len(timings[name]) / elapsed
+        rows.append(row)
+    total = sum(len(t) for t in timings.values())
+    rows.append({
+        "name": "total",
+        **summarize([t for name in names for t in timings[name]]),
+        "errors": sum(errors.values()),
+        "ops_per_s": total / elapsed
+    })
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", type=int, default=200, help="Images uploaded before the run.")
+    parser.add_argument("--threads", type=int, default=8, help="Concurrent clients.")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of load per run.")
+    parser.add_argument("--scenario", action="append", help="Only run these scenarios (repeatable).")
+    parser.add_argument("--model", action="store_true", help="Use the configured model instead of the stub.")
+    parser.add_argument("--out", default="-", help="JSON output path, or - for stdout.")
+    args = parser.parse_args(argv)
+    out = os.path.abspath(args.out) if args.out != "-" else args.out
+
+    scenarios = [s for s in SCENARIOS if not args.scenario or s[0] in args.scenario]
+    if not scenarios:
+        parser.error(f"unknown scenario; choose from {', '.join(name for name, _ in SCENARIOS)}")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        _isolate(workdir, args.model)
+        from app import app
+
+        app.config["UPLOAD_FOLDER"] = os.path.join(workdir, "uploads")
+        client = app.test_client()
+        start = time.perf_counter()
+        ids = []
+        for seed in range(args.seed):
+            response = _upload(client, seed)
+            if response.status_code != 200:
+                print(f"[ERROR] Seeding failed: {response.status_code} {response.get_data(as_text=True)}")
+                sys.exit(1)
+            ids.append(response.get_json()["image_id"])
+        seed_rate = args.seed / (time.perf_counter() - start)
+        print(f"Seeded {args.seed} images ({seed_rate:.1f}/s)")
+
+        rows = run_load(app, ids, args.threads, args.duration, scenarios)
+
+    print_table(rows)
+    write_results({
+        "suite": "load",
+        "meta": run_metadata(seed=args.seed, threads=args.threads, duration=args.duration, model=args.model),
+        "results": rows
+    }, out)
+
+
+if __name__ == "__main__":
+    main()
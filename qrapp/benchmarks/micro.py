@@ -0,0 +1,138 @@
+"""
+Micro-benchmarks for ChromaDBUtility at several collection sizes.
+
+    python -m benchmarks.micro --sizes 1000,10000 --out bench_results/micro.json
+
+Each size runs against a fresh temporary store, populated with precomputed
+vectors. The embedding function is the deterministic stub unless --model is
+given, so the numbers isolate the vector store and the surrounding code.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from config import Config
+from database.chroma_db import ChromaDBUtility
+from database.embedding_service import StubEmbeddingFunction, create_embedding_function
+from benchmarks.common import summarize, timed, synthetic_image, run_metadata, write_results, print_table
+
+
+def populate(db, size, upload_dir, batch_size=2000):
+    """
+    Add `size` image records with stub vectors straight into the collection
+    (and the local indexes), without files or embedding calls.
+    """
+    dims = len(db.embedding_function(["probe"])[0])
+    ids = []
+    rng = np.random.default_rng(0)
+    for start in range(0, size, batch_size):
+        count = min(batch_size, size - start)
+        batch_ids = [f"bench-{start + i}" for i in range(count)]
+        vectors = rng.standard_normal((count, dims)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        metadatas = [
+            {
+                "type": "image",
+                "filename": f"plano_{start + i}.png",
+                "path": os.path.join(upload_dir, f"plano_{start + i}.png"),
+                "description": f"plano {start + i}"
+            }
+            for i in range(count)
+        ]
+        db.collection.add(
+            ids=batch_ids,
+            embeddings=vectors,
+            documents=[metadata["description"] for metadata in metadatas],
+            metadatas=metadatas
+        )
+        db._mark_write(upserted=list(zip(batch_ids, metadatas)))
+        ids.extend(batch_ids)
+    return ids
+
+
+def bench_size(size, repeats, use_model):
+    rows = []
+
+    def record(name, timings, items_per_call=1):
+        rows.append({"name": f"{name}@{size}", "size": size, **summarize(timings, items_per_call)})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        upload_dir = os.path.join(tmp, "uploads")
+        os.makedirs(upload_dir)
+        db = ChromaDBUtility(
+            db_dir=os.path.join(tmp, "chroma"),
+            embedding_function=create_embedding_function() if use_model else StubEmbeddingFunction(),
+            metadata_index_path=os.path.join(tmp, "metadata_index.db"),
+            keyword_index_path=os.path.join(tmp, "keyword_index.db"),
+            hnsw={"space": Config.HNSW_SPACE, "ef_construction": Config.HNSW_EF_CONSTRUCTION,
+                  "ef_search": Config.HNSW_EF_SEARCH, "max_neighbors": Config.HNSW_M}
+        )
+
+        start = time.perf_counter()
+        ids = populate(db, size, upload_dir)
+        record("populate", [time.perf_counter() - start], items_per_call=size)
+
+        images = []
+        for i in range(32):
+            path = os.path.join(upload_dir, f"bulk_{i}.png")
+            with open(path, "wb") as f:
+                f.write(synthetic_image(i))
+            images.append(path)
+        query_images = [synthetic_image(1000 + i) for i in range(repeats)]
+        rng = np.random.default_rng(1)
+        lookups = [ids[j] for j in rng.integers(0, len(ids), repeats)]
+
+        record("add_text_document", timed(
+            lambda i: db.add_text_document(f"nota de obra {i}", {"type": "document", "filename": f"nota_{i}"}),
+            repeats
+        ))
+        record("add_images_bulk[32]", timed(
+            lambda i: db.add_images_bulk([
+                {"path": path, "description": f"bulk {i}", "metadata": {"type": "image"}} for path in images
+            ]),
+            max(1, repeats // 10)
+        ), items_per_call=32)
+        record("search_by_text", timed(lambda i: db.search_by_text(f"plano planta {i}"), repeats))
+        record("search_by_text[cached]", timed(lambda i: db.search_by_text("plano planta 0"), repeats))
+        record("search_by_text[n=50,where]", timed(
+            lambda i: db.search_by_text(f"corte {i}", n_results=50, where={"type": "image"}), repeats
+        ))
+        record("search_many[16]", timed(
+            lambda i: db.search_many([f"fachada {i} {j}" for j in range(16)]), max(1, repeats // 10)
+        ), items_per_call=16)
+        record("search_by_image_bytes", timed(lambda i: db.search_by_image_bytes(query_images[i]), repeats))
+        record("get_file_metadata", timed(lambda i: db.get_file_metadata(lookups[i]), repeats))
+
+        raw = db.collection.query(
+            query_embeddings=db.embedding_function(["probe"]), n_results=min(100, size),
+            include=["metadatas", "documents", "distances"]
+        )
+        record("_format_results[100]", timed(lambda i: db._format_results(raw), repeats))
+        record("_format_results[100,columnar]", timed(lambda i: db._format_results(raw, columnar=True), repeats))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000", help="Comma-separated collection sizes.")
+    parser.add_argument("--repeats", type=int, default=200, help="Calls per benchmark.")
+    parser.add_argument("--model", action="store_true", help="Use the configured model instead of the stub.")
+    parser.add_argument("--out", default="-", help="JSON output path, or - for stdout.")
+    args = parser.parse_args(argv)
+
+    rows = []
+    for size in [int(size) for size in args.sizes.split(",") if size]:
+        rows.extend(bench_size(size, args.repeats, args.model))
+    print_table(rows)
+    write_results({
+        "suite": "micro",
+        "meta": run_metadata(sizes=args.sizes, repeats=args.repeats, model=args.model),
+        "results": rows
+    }, args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,13 +5,148 @@ class Config:
     SECRET_KEY = os.environ.get("SECRET_KEY") or "supersecretkey"  # Change this to a secure key
     BASE_DIR = os.path.abspath(os.path.dirname(__file__))
     UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
-    CHROMA_DB_DIR = "chromadb_data"
+    CHROMA_DB_DIR = os.environ.get("CHROMA_DB_DIR") or os.path.join(BASE_DIR, 'chromadb_data')
+    CHROMA_COLLECTION = os.environ.get("CHROMA_COLLECTION", "planos_multimodal")
+    # HNSW settings for new collections. ef_search is applied to the existing one
+    # at startup; the others take effect through `flask rebuild-index`.
+    HNSW_SPACE = os.environ.get("HNSW_SPACE", "l2")
+    HNSW_EF_CONSTRUCTION = int(os.environ.get("HNSW_EF_CONSTRUCTION", 100))
+    HNSW_EF_SEARCH = int(os.environ.get("HNSW_EF_SEARCH", 100))
+    HNSW_M = int(os.environ.get("HNSW_M", 16))
+    # Upper bound for the per-request ef_search search parameter
+    HNSW_EF_SEARCH_MAX = int(os.environ.get("HNSW_EF_SEARCH_MAX", 1000))
     ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'geopdf'}
+    # Whole request body limit (Flask answers 413 above it); search query images
+    # are kept in memory and have their own, smaller limit
+    MAX_CONTENT_LENGTH = int(os.environ.get("MAX_CONTENT_LENGTH_MB", "200")) * 1024 * 1024
+    SEARCH_IMAGE_MAX_BYTES = int(os.environ.get("SEARCH_IMAGE_MAX_MB", "10")) * 1024 * 1024
+    # Embedding model: "local" loads OpenCLIP lazily in each process (share it with
+    # `gunicorn --preload` + EMBEDDING_PRELOAD=1); "remote" talks to a single
+    # `python -m database.embedding_service` process over a Unix socket. The socket
+    # lives in a private (0700) directory and remote mode needs its own EMBEDDING_AUTHKEY.
+    EMBEDDING_MODE = os.environ.get("EMBEDDING_MODE", "local")
+    EMBEDDING_STUB_DIMS = int(os.environ.get("EMBEDDING_STUB_DIMS", 512))  # EMBEDDING_MODE=stub (benchmarks)
+    EMBEDDING_PRELOAD = os.environ.get("EMBEDDING_PRELOAD", "0") == "1"
+    EMBEDDING_SOCKET = os.environ.get("EMBEDDING_SOCKET") or os.path.join(BASE_DIR, 'run', 'embeddings.sock')
+    EMBEDDING_AUTHKEY = os.environ.get("EMBEDDING_AUTHKEY", "").encode()
+    EMBEDDING_DEVICE = os.environ.get("EMBEDDING_DEVICE", "cpu")
+    OPENCLIP_MODEL = os.environ.get("OPENCLIP_MODEL", "ViT-B-32")
+    OPENCLIP_CHECKPOINT = os.environ.get("OPENCLIP_CHECKPOINT", "laion2b_s34b_b79k")
+    # Images are decoded straight to this shortest side (CLIP's input is 224 px),
+    # batches on a thread pool of IMAGE_DECODE_WORKERS
+    EMBEDDING_IMAGE_MIN_SIDE = int(os.environ.get("EMBEDDING_IMAGE_MIN_SIDE", 224))
+    IMAGE_DECODE_WORKERS = int(os.environ.get("IMAGE_DECODE_WORKERS", 4))
+    # Concurrent search queries are combined into one forward pass within this window.
+    # Only worth it with threaded workers (gunicorn --threads): a sync worker serves
+    # one query at a time, which would just wait out the window. The remote
+    # embedding server always batches the queries of all workers.
+    EMBEDDING_BATCHING = os.environ.get("EMBEDDING_BATCHING", "0") == "1"
+    EMBEDDING_BATCH_WAIT_MS = float(os.environ.get("EMBEDDING_BATCH_WAIT_MS", 5))
+    EMBEDDING_BATCH_MAX = int(os.environ.get("EMBEDDING_BATCH_MAX", 32))
+    # Search caches (per process): query text/image hash -> embedding, and query -> results
+    QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", 1024))
+    SEARCH_RESULT_CACHE_SIZE = int(os.environ.get("SEARCH_RESULT_CACHE_SIZE", 512))
+    # Upper bounds for n_results and for the number of texts per /search_batch call
+    SEARCH_MAX_RESULTS = int(os.environ.get("SEARCH_MAX_RESULTS", 100))
+    SEARCH_BATCH_MAX_QUERIES = int(os.environ.get("SEARCH_BATCH_MAX_QUERIES", 64))
+    # Local id -> path/size/sha256 index used by the file-serving routes
+    METADATA_INDEX_PATH = os.environ.get("METADATA_INDEX_PATH") or os.path.join(BASE_DIR, 'metadata_index.db')
+    # Exact vectors of a compact collection (see `flask build-compact-index`), whose
+    # searches re-rank COMPACT_OVERSAMPLE x n_results candidates with them
+    COMPACT_INDEX_DIR = os.environ.get("COMPACT_INDEX_DIR") or os.path.join(BASE_DIR, 'compact_index')
+    COMPACT_DIMS = int(os.environ.get("COMPACT_DIMS", 128))
+    COMPACT_OVERSAMPLE = int(os.environ.get("COMPACT_OVERSAMPLE", 4))
+    # FTS5 index behind /search_text?mode=keyword|hybrid
+    KEYWORD_INDEX_PATH = os.environ.get("KEYWORD_INDEX_PATH") or os.path.join(BASE_DIR, 'keyword_index.db')
+    # Stored file delivery: "flask" streams from the worker (with Range/ETag support),
+    # "x-sendfile" (Apache/lighttpd) or "x-accel" (nginx) hand the bytes to the front proxy
+    FILE_SERVE_MODE = os.environ.get("FILE_SERVE_MODE", "flask")
+    USE_X_SENDFILE = FILE_SERVE_MODE == "x-sendfile"
+    X_ACCEL_PREFIX = os.environ.get("X_ACCEL_PREFIX", "/protected_uploads/")  # nginx internal location
+    FILE_CACHE_MAX_AGE = int(os.environ.get("FILE_CACHE_MAX_AGE", 3600))
+    # Downscaled previews served by /thumb/<file_id>/<size>
+    THUMBNAIL_DIR = os.environ.get("THUMBNAIL_DIR") or os.path.join(BASE_DIR, 'thumbnails')
+    THUMBNAIL_SIZES = {"small": 160, "medium": 480, "large": 1280}  # longest edge in px
+    THUMBNAIL_FORMAT = os.environ.get("THUMBNAIL_FORMAT", "webp")  # falls back to jpeg without WebP support
+    THUMBNAIL_QUALITY = int(os.environ.get("THUMBNAIL_QUALITY", 80))
+    THUMBNAIL_QUOTA_MB = int(os.environ.get("THUMBNAIL_QUOTA_MB", 512))
+    THUMBNAIL_ON_UPLOAD = os.environ.get("THUMBNAIL_ON_UPLOAD", "0") == "1"  # otherwise created on first request
+    # File listing page size (index page and /files)
+    FILES_PAGE_SIZE = int(os.environ.get("FILES_PAGE_SIZE", 50))
+    FILES_PAGE_MAX = int(os.environ.get("FILES_PAGE_MAX", 500))
+    # Number of images embedded per forward pass / collection.add in bulk uploads
+    INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 32))
+    # PDF / GeoPDF ingestion: pages are rasterized PDF_PAGE_WINDOW at a time, split
+    # across PDF_WORKERS pdftoppm processes (no Python process is forked)
+    PDF_DPI = int(os.environ.get("PDF_DPI", 100))
+    PDF_MAX_PX = int(os.environ.get("PDF_MAX_PX", 1024))  # longest edge of a rasterized page
+    PDF_WORKERS = int(os.environ.get("PDF_WORKERS", min(4, os.cpu_count() or 1)))
+    PDF_PAGE_WINDOW = int(os.environ.get("PDF_PAGE_WINDOW", 8))
+    PDF_EXTENSIONS = {'pdf', 'geopdf'}
+    # Bulk delete (POST /delete_files): ids per request, records per collection.delete
+    DELETE_MAX_IDS = int(os.environ.get("DELETE_MAX_IDS", 10000))
+    DELETE_BATCH_SIZE = int(os.environ.get("DELETE_BATCH_SIZE", 500))
+    # Background ingestion: with INGEST_ASYNC=1 uploads are queued and embedded by
+    # `flask ingest-worker` processes instead of inside the request
+    INGEST_ASYNC = os.environ.get("INGEST_ASYNC", "0") == "1"
+    JOB_DB_PATH = os.environ.get("JOB_DB_PATH") or os.path.join(BASE_DIR, 'jobs.db')
+    JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+    JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", 600))
+    JOB_RETRY_DELAY = int(os.environ.get("JOB_RETRY_DELAY", 10))  # seconds, doubled per attempt
+    JOB_RETENTION_SECONDS = int(os.environ.get("JOB_RETENTION_SECONDS", 86400))  # done jobs, for status polling
+    # Per-stage timing histograms at /metrics (Prometheus text format), summed over
+    # the per-worker snapshots written to METRICS_DIR
+    METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+    METRICS_DIR = os.environ.get("METRICS_DIR") or os.path.join(BASE_DIR, 'metrics')
+    METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 5))  # seconds
+    METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")  # bearer token required by /metrics; empty = open
+    # Requests slower than this are logged with their stage breakdown
+    SLOW_REQUEST_MS = int(os.environ.get("SLOW_REQUEST_MS", 1000))
+    # Opt-in sampling profiler: stacks of slow requests are saved to PROFILE_DIR
+    PROFILE_SLOW_REQUESTS = os.environ.get("PROFILE_SLOW_REQUESTS", "0") == "1"
+    PROFILE_DIR = os.environ.get("PROFILE_DIR") or os.path.join(BASE_DIR, 'profiles')
+    PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", 10))
+    PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", 200))
 
     # Flask-SQLAlchemy Configuration (Fixing the missing database URI)
     SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(BASE_DIR, 'flask_session.db')}"
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     PERMANENT_SESSION_LIFETIME = timedelta(hours=1)
+    # current_user is served from a per-process cache; creating/deleting a user
+    # touches USER_CACHE_VERSION_PATH so every worker drops its entries
+    USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", 60))  # seconds, 0 = no caching
+    USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 1024))
+    USER_CACHE_VERSION_PATH = os.environ.get("USER_CACHE_VERSION_PATH") or os.path.join(BASE_DIR, '.users_version')
+    # werkzeug method string ("scrypt", "pbkdf2:sha256:1000000"...); empty = werkzeug's default.
+    # Hashes made with another algorithm or weaker parameters are redone on the next login.
+    PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "")
+    # Stateless API auth: POST /api/token, then "Authorization: Bearer <token>"
+    JWT_SECRET_KEY = os.environ.get("JWT_SECRET_KEY") or SECRET_KEY
+    JWT_ACCESS_TOKEN_EXPIRES = timedelta(minutes=int(os.environ.get("JWT_ACCESS_MINUTES", 15)))
+    JWT_TOKEN_LOCATION = ["headers"]
+
+    # QR access tokens: "sqlite" is shared by all gunicorn workers, "memory" is per-process
+    TOKEN_STORE = os.environ.get("TOKEN_STORE", "sqlite")
+    TOKEN_DB_PATH = os.environ.get("TOKEN_DB_PATH") or os.path.join(BASE_DIR, 'tokens.db')
+    # Printed codes outlive any session, so tokens never expire unless a TTL is set
+    QR_TOKEN_TTL = int(os.environ.get("QR_TOKEN_TTL", 0))  # seconds, 0 = never expires
+    QR_TOKEN_MAX_USES = int(os.environ.get("QR_TOKEN_MAX_USES", 0)) or None  # 0 = unlimited
+    TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 1024))
+    TOKEN_EVICT_INTERVAL = int(os.environ.get("TOKEN_EVICT_INTERVAL", 300))  # seconds
+
+    # QR rendering: defaults can be overridden per request (?format=svg&ec=L&box_size=8)
+    QR_FORMAT = os.environ.get("QR_FORMAT", "png")
+    QR_ERROR_CORRECTION = os.environ.get("QR_ERROR_CORRECTION", "M")
+    QR_BOX_SIZE = int(os.environ.get("QR_BOX_SIZE", 10))
+    QR_CACHE_SIZE = int(os.environ.get("QR_CACHE_SIZE", 512))  # rendered images kept in memory
+    QR_CACHE_DIR = os.environ.get("QR_CACHE_DIR", "")  # empty = no on-disk tier
+    QR_CACHE_QUOTA_MB = int(os.environ.get("QR_CACHE_QUOTA_MB", 256))  # least recently used files go first
+    # Hand out an existing unexpired token for the same file so its QR comes from cache
+    QR_REUSE_TOKENS = os.environ.get("QR_REUSE_TOKENS", "1") == "1"
+    # Bulk QR sheets
+    QR_SHEET_MAX_FILES = int(os.environ.get("QR_SHEET_MAX_FILES", 1000))
+    # A PNG sheet is a single image holding every code (~100 KB of pixels each)
+    QR_SHEET_PNG_MAX_FILES = int(os.environ.get("QR_SHEET_PNG_MAX_FILES", 100))
     
 # Crear el directorio de subida si no existe
 os.makedirs(Config.UPLOAD_FOLDER, exist_ok=True)
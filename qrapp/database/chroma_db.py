@@ -1,28 +1,347 @@
 import chromadb
+import copy
 import uuid
 import os
+import time
+import threading
+import hashlib
+import json
+import sqlite3
 import numpy as np
+from io import BytesIO
 from PIL import Image  # Used to open and process images
 from chromadb.config import Settings
-from chromadb.utils.embedding_functions import OpenCLIPEmbeddingFunction
-from chromadb.utils.data_loaders import ImageLoader
+from config import Config
+from database.embedding_service import create_embedding_function
+from database.embedding_batcher import EmbeddingBatcher
+from database.query_cache import LRUCache, normalize_query
+from database.metadata_index import MetadataIndex, file_fingerprint
+from database.keyword_index import KeywordIndex, looks_like_code
+from database.compact_index import CompactIndex, COMPACT_KEY, COMPACT_SPACE_KEY
+from database.result_format import columnar_results, result_rows
+from database.image_prep import PreparedImageLoader, prepare_image
+from services.metrics import metrics
+
+# Result fields that search callers can project with `include`
+SEARCH_INCLUDE = ("documents", "metadatas", "distances")
+_INCLUDE_KEYS = {"documents": "document", "metadatas": "metadata", "distances": "distance"}
+# Candidates fetched per requested result when re-ranking with MMR
+MMR_FETCH_FACTOR = 3
+# PDF page records repeat their parent's path and filename; listings and
+# sheets show the document once
+DOCUMENTS_ONLY = {"type": {"$nin": ["pdf_page", "pdf_page_text"]}}
+
+
+def _project(match, include):
+    if include is None:
+        return match
+    dropped = {_INCLUDE_KEYS[field] for field in SEARCH_INCLUDE if field not in include}
+    return {key: value for key, value in match.items() if key not in dropped}
+
 
 class ChromaDBUtility:
-    def __init__(self, db_dir="chromadb_data"):
+    def __init__(self, db_dir="chromadb_data", embedding_function=None, batch_wait=None, batch_max=32,
+                 embedding_cache_size=1024, result_cache_size=512, metadata_index_path=None,
+                 keyword_index_path=None, compact_index_dir=None, compact_oversample=4,
+                 collection_name="planos_multimodal", hnsw=None, image_min_side=224, image_workers=4):
         """
         Initialize ChromaDB with a multi-modal collection.
+        Neither the client nor the model is loaded until first use.
+        `hnsw` holds the HNSW settings (space, ef_construction, ef_search,
+        max_neighbors) used when the collection is created; see `rebuild_index`
+        for changing them on an existing collection.
+
+        Images (stored URIs and query images alike) are decoded at model size
+        (shortest side `image_min_side`), batches on `image_workers` threads.
+
+        With `batch_wait` (seconds), concurrent search queries are micro-batched
+        into shared forward passes of up to `batch_max` items.
+
+        Query embeddings (keyed by normalized text or image content hash) are
+        cached forever; formatted search results are cached until the next write.
+
+        With `metadata_index_path`, file metadata is mirrored into a local
+        SQLite index so id -> path lookups never touch the vector store.
+        With `keyword_index_path`, filenames, descriptions and document text are
+        also kept in an FTS5 index for keyword and hybrid search.
+
+        With `compact_index_dir`, the collection can be rebuilt compact (`flask
+        build-compact-index`): it then stores PCA-reduced vectors, and searches
+        re-rank `compact_oversample` times as many candidates with the exact
+        vectors kept on disk. See CompactIndex.
+        """
+        self.db_dir = os.path.abspath(db_dir)  # Ensure path is absolute
+        self.embedding_function = embedding_function or create_embedding_function()
+        self.data_loader = PreparedImageLoader(min_side=image_min_side, max_workers=image_workers)
+        self.query_batcher = None
+        if batch_wait:
+            self.query_batcher = EmbeddingBatcher(self.embedding_function, max_wait=batch_wait, max_batch=batch_max)
+
+        self.embedding_cache = LRUCache(embedding_cache_size)
+        self.result_cache = LRUCache(result_cache_size)
+        # Touched on every write so the other gunicorn workers drop their result caches too
+        self._version_path = os.path.join(self.db_dir, ".write_version")
+        self._seen_version = None
+        self._generation = 0
+        self.metadata_index = MetadataIndex(metadata_index_path) if metadata_index_path else None
+        self.compact_index = CompactIndex(compact_index_dir, compact_oversample) if compact_index_dir else None
+        self.keyword_index = None
+        if keyword_index_path:
+            try:
+                self.keyword_index = KeywordIndex(keyword_index_path)
+            except sqlite3.OperationalError as e:
+                print(f"[WARN] Keyword index disabled (SQLite without FTS5?): {e}")
+
+        self.collection_name = collection_name
+        self.hnsw = dict(hnsw or {})
+        # Names the live collection after a `rebuild_index` swap
+        self._active_path = os.path.join(self.db_dir, ".active_collection")
+        self._active_mtime = None
+        self._active_name = collection_name
+        self._space = self.hnsw.get("space", "l2")
+
+        self.client = None
+        self._collection = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def collection(self):
         """
-        db_dir = os.path.abspath(db_dir)  # Ensure path is absolute
-        self.client = chromadb.PersistentClient(path=db_dir)
+        Open the client and collection lazily and once per process, so a client
+        created before a gunicorn fork is never shared between workers.
+        Reopens the collection when another process swaps in a rebuilt one.
+        """
+        name = self._active_collection_name()
+        if self._collection is None or self._pid != os.getpid() or self._collection.name != name:
+            with self._lock:
+                if self._collection is None or self._pid != os.getpid() or self._collection.name != name:
+                    if self.client is None or self._pid != os.getpid():
+                        self.client = chromadb.PersistentClient(path=self.db_dir)
+                    self._collection = self._open_collection(name)
+                    # A compact collection searches L2 in PCA space but ranks in the space it was built for
+                    self._space = (self._collection.metadata or {}).get(COMPACT_SPACE_KEY) or \
+                        ((self._collection.configuration or {}).get("hnsw") or {}).get("space", "l2")
+                    self._pid = os.getpid()
+        return self._collection
 
-        embedding_function = OpenCLIPEmbeddingFunction()
-        data_loader = ImageLoader()
+    def _active_collection_name(self):
+        try:
+            mtime = os.stat(self._active_path).st_mtime_ns
+        except OSError:
+            return self.collection_name
+        if mtime != self._active_mtime:
+            with open(self._active_path) as f:
+                self._active_name = f.read().strip() or self.collection_name
+            self._active_mtime = mtime
+        return self._active_name
 
-        self.collection = self.client.get_or_create_collection(
-            name="planos_multimodal",
-            embedding_function=embedding_function,
-            data_loader=data_loader
+    def _open_collection(self, name, hnsw=None, metadata=None):
+        hnsw = dict(hnsw or self.hnsw)
+        collection = self.client.get_or_create_collection(
+            name=name,
+            embedding_function=self.embedding_function,
+            data_loader=self.data_loader,
+            configuration={"hnsw": hnsw} if hnsw else None,
+            metadata=metadata or None
         )
+        # ef_search is the one HNSW setting that can change in place
+        ef_search = hnsw.get("ef_search")
+        current = (collection.configuration or {}).get("hnsw") or {}
+        if ef_search and current.get("ef_search") not in (None, ef_search):
+            try:
+                collection.modify(configuration={"hnsw": {"ef_search": ef_search}})
+            except Exception as e:
+                print(f"[WARN] Could not set ef_search on {name}: {e}")
+        return collection
+
+    def _compact_state(self, collection=None):
+        if self.compact_index is None:
+            return None
+        return self.compact_index.state(collection or self.collection)
+
+    def _iter_records(self, source, batch_size, full=True):
+        """
+        Yield every record of `source` in batches. With `full`, the embeddings
+        of a compact `source` are its exact vectors instead of the reduced ones.
+        """
+        state = self._compact_state(source) if full else None
+        offset = 0
+        while True:
+            batch = source.get(
+                limit=batch_size, offset=offset, include=["embeddings", "documents", "metadatas", "uris"]
+            )
+            ids = batch.get("ids") or []
+            if not ids:
+                return
+            if state is not None:
+                exact = state[1].get_many(ids)
+                missing = [record_id for record_id in ids if record_id not in exact]
+                if missing:
+                    raise RuntimeError(f"No exact vectors for {len(missing)} records (e.g. {missing[0]})")
+                batch["embeddings"] = np.array([exact[record_id] for record_id in ids])
+            yield batch
+            offset += len(ids)
+
+    def rebuild_index(self, hnsw=None, batch_size=500, drop_old=False, compact_dims=None, sample_size=20000):
+        """
+        Copy every record (embeddings included, so no re-embedding) into a new
+        collection created with the `hnsw` settings, then atomically point all
+        processes at it. Searches keep using the old collection until the swap.
+
+        `compact_dims` > 0 makes the new collection compact (see CompactIndex)
+        with a projection fitted on the first `sample_size` vectors; 0 restores
+        full vectors; None keeps the source's form.
+        Returns (new collection name, records copied).
+        """
+        source = self.collection
+        hnsw = dict(self.hnsw, **(hnsw or {}))
+        hnsw.setdefault("space", self._space)
+        source_key = self.compact_index.key_of(source) if self.compact_index is not None else None
+        if compact_dims and self.compact_index is None:
+            raise RuntimeError("Compact collections need COMPACT_INDEX_DIR")
+
+        key, projection, vectors = None, None, None
+        if compact_dims:
+            sample = []
+            for batch in self._iter_records(source, batch_size):
+                sample.extend(batch["embeddings"])
+                if len(sample) >= sample_size:
+                    break
+            if not sample:
+                raise RuntimeError("The collection is empty; there is nothing to fit a projection on")
+            key, projection, vectors = self.compact_index.create(np.asarray(sample[:sample_size]), compact_dims)
+            del sample
+        elif compact_dims is None:
+            key = source_key
+
+        new_name = f"{self.collection_name}-{time.time_ns()}"
+        if key:
+            # The candidate search is L2 in PCA space; the re-rank uses the requested space
+            target = self._open_collection(
+                new_name, dict(hnsw, space="l2"), {COMPACT_KEY: key, COMPACT_SPACE_KEY: hnsw["space"]}
+            )
+        else:
+            target = self._open_collection(new_name, hnsw)
+
+        total = 0
+        try:
+            # With the same projection the reduced vectors are copied as they are
+            for batch in self._iter_records(source, batch_size, full=key != source_key):
+                embeddings = batch["embeddings"]
+                if projection is not None:
+                    vectors.put_many(batch["ids"], embeddings)
+                    embeddings = projection.project(embeddings)
+                target.add(
+                    ids=batch["ids"],
+                    embeddings=embeddings,
+                    documents=batch["documents"],
+                    metadatas=batch["metadatas"],
+                    uris=batch["uris"]
+                )
+                total += len(batch["ids"])
+            if target.count() != source.count():
+                raise RuntimeError("Collection changed during the rebuild; run it again with ingestion paused")
+        except Exception:
+            self.client.delete_collection(new_name)
+            if projection is not None:
+                self.compact_index.remove(key)
+            raise
+
+        tmp_path = self._active_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(new_name)
+        os.replace(tmp_path, self._active_path)
+        self.hnsw = hnsw
+        self._mark_write()
+        if drop_old:
+            self.client.delete_collection(source.name)
+            if source_key and source_key != key:
+                self.compact_index.remove(source_key)
+        return new_name, total
+
+    def _add(self, ids, embeddings, documents, metadatas, uris=None):
+        """
+        collection.add with full-size embeddings. A compact collection stores
+        them PCA-reduced, and the exact vectors go to its vector store first,
+        so every searchable record can be re-ranked.
+        """
+        collection = self.collection
+        state = self._compact_state(collection)
+        if state is not None:
+            projection, vectors = state
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+            vectors.put_many(ids, embeddings)
+            embeddings = projection.project(embeddings)
+        try:
+            collection.add(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas, uris=uris)
+        except Exception:
+            if state is not None:
+                state[1].delete_many(ids)
+            raise
+
+    @metrics.span("index.update")
+    def _mark_write(self, upserted=(), deleted=(), documents=None):
+        """
+        Invalidate cached search results after a write, in every process, and
+        mirror the written (id, metadata) records into the local indexes.
+        `documents` maps ids to their document text where it differs from the
+        description.
+        """
+        if self.metadata_index is not None:
+            try:
+                if upserted:
+                    self.metadata_index.upsert_many(upserted)
+                if deleted:
+                    self.metadata_index.delete_many(deleted)
+            except Exception as e:
+                print(f"[WARN] Could not update metadata index: {e}")
+        if self.keyword_index is not None:
+            documents = documents or {}
+            try:
+                if upserted:
+                    self.keyword_index.upsert_many(
+                        (record_id, metadata, documents.get(record_id)) for record_id, metadata in upserted
+                    )
+                if deleted:
+                    self.keyword_index.delete_many(deleted)
+            except Exception as e:
+                print(f"[WARN] Could not update keyword index: {e}")
+        if deleted:
+            # Upserts reach the exact vectors in _add; only freed rows are left to hand back
+            try:
+                state = self._compact_state()
+                if state is not None:
+                    state[1].delete_many(deleted)
+            except Exception as e:
+                print(f"[WARN] Could not update compact vectors: {e}")
+        self._generation += 1
+        self.result_cache.clear()
+        try:
+            with open(self._version_path, "a"):
+                pass
+            os.utime(self._version_path, ns=(time.time_ns(), time.time_ns()))
+        except OSError as e:
+            print(f"[WARN] Could not update write version: {e}")
+
+    def _check_write_version(self):
+        try:
+            version = os.stat(self._version_path).st_mtime_ns
+        except OSError:
+            version = 0
+        if version != self._seen_version:
+            self._seen_version = version
+            self._generation += 1
+            self.result_cache.clear()
+
+    def cache_stats(self):
+        """
+        Hit/miss counters for the query embedding and search result caches.
+        """
+        return {
+            "query_embeddings": self.embedding_cache.stats(),
+            "search_results": self.result_cache.stats()
+        }
 
     def add_text_document(self, text, metadata={}):
         """
@@ -31,11 +350,11 @@ class ChromaDBUtility:
         doc_id = str(uuid.uuid4())
         if "description" not in metadata:
             metadata["description"] = text
-        self.collection.add(
-            ids=[doc_id],
-            documents=[text],
-            metadatas=[metadata]
-        )
+        with metrics.span("embed"):
+            embeddings = self.embedding_function([text])
+        with metrics.span("vector.add"):
+            self._add(ids=[doc_id], embeddings=embeddings, documents=[text], metadatas=[metadata])
+        self._mark_write(upserted=[(doc_id, metadata)], documents={doc_id: text})
         return doc_id
 
     def add_image(self, image_path, description="", metadata={}):
@@ -49,17 +368,15 @@ class ChromaDBUtility:
             metadata["path"] = os.path.relpath(metadata["path"], os.getcwd())
 
         img_id = str(uuid.uuid4())
-        self.collection.add(
-            ids=[img_id],
-            uris=[image_path],
-            documents=[description],
-            metadatas=[metadata]
-        )
+        embeddings = self.embedding_function(self.data_loader(uris=[image_path]))
+        self._add(ids=[img_id], embeddings=embeddings, documents=[description], metadatas=[metadata],
+                  uris=[image_path])
+        self._mark_write(upserted=[(img_id, metadata)])
         return img_id
 
     def add_image_with_text(self, image_path, description="", metadata={}):
         """
-        Two-step image + optional text embedding.
+        Image embedding, with the description (or file name) stored as its document.
         """
         if not os.path.exists(image_path):
             raise FileNotFoundError(f"Image not found: {image_path}")
@@ -70,117 +387,709 @@ class ChromaDBUtility:
             metadata["description"] = description or os.path.basename(image_path)
 
         record_id = str(uuid.uuid4())
-        self.collection.add(
-            ids=[record_id],
-            documents=[metadata["description"]],
-            metadatas=[metadata]
-        )
-        self.collection.update(
-            ids=[record_id],
-            uris=[image_path]
-        )
+        # The record is searched by its image; the description is kept as its document
+        embeddings = self.embedding_function(self.data_loader(uris=[image_path]))
+        self._add(ids=[record_id], embeddings=embeddings, documents=[metadata["description"]],
+                  metadatas=[metadata], uris=[image_path])
+        self._mark_write(upserted=[(record_id, metadata)])
         return record_id
 
-    def search_by_text(self, query_text, n_results=5):
+    def find_duplicate(self, sha256):
+        """
+        Return the id of an image already stored with this content hash, or None.
+        """
+        if self.metadata_index is None or not sha256:
+            return None
+        try:
+            return self.metadata_index.find_by_sha256(sha256)
+        except Exception as e:
+            print(f"[WARN] Hash index lookup failed: {e}")
+            return None
+
+    def add_image_reference(self, source_id, metadata={}):
+        """
+        Add a record for a duplicate upload that reuses the embedding (and the
+        stored file) of `source_id`, skipping the model entirely. If the source's
+        file is gone from disk, the record keeps `metadata["path"]` instead.
+        Returns (record id, stored path). Raises KeyError when `source_id` no
+        longer exists (a stale hash index entry, which is dropped).
         """
-        Full-text embedding search.
+        # A compact collection stores reduced vectors; the exact one is copied instead
+        state = self._compact_state()
+        include = ["documents", "metadatas"] if state is not None else ["embeddings", "documents", "metadatas"]
+        source = self.collection.get(ids=[source_id], include=include)
+        if not source.get("ids"):
+            if self.metadata_index is not None:
+                try:
+                    self.metadata_index.delete_many([source_id])
+                except Exception as e:
+                    print(f"[WARN] Metadata index update failed: {e}")
+            raise KeyError(f"File not found: {source_id}")
+
+        source_metadata = source["metadatas"][0] or {}
+        metadata = dict(metadata)
+        source_path = source_metadata.get("path")
+        if not metadata.get("path") or (source_path and os.path.exists(os.path.join(os.getcwd(), source_path))):
+            metadata["path"] = source_path
+            # Same bytes, but size/mtime describe the new copy: let the index stat the source's file
+            metadata.pop("size", None)
+            metadata.pop("mtime", None)
+        metadata.setdefault("type", source_metadata.get("type", "image"))
+        if "description" not in metadata:
+            metadata["description"] = source["documents"][0] or ""
+
+        if state is not None:
+            embedding = state[1].get_many([source_id]).get(source_id)
+            if embedding is None:
+                raise KeyError(f"No exact vector for {source_id}")
+        else:
+            embedding = source["embeddings"][0]
+
+        record_id = str(uuid.uuid4())
+        self._add(ids=[record_id], embeddings=[embedding], documents=[metadata["description"]],
+                  metadatas=[metadata])
+        self._mark_write(upserted=[(record_id, metadata)])
+        return record_id, metadata["path"]
+
+    def add_images_bulk(self, items, batch_size=32):
         """
-        results = self.collection.query(
-            query_texts=[query_text],
-            n_results=n_results,
-            include=["metadatas", "documents", "distances"]
+        Bulk image + text ingestion.
+
+        `items` is a list of dicts with "path" and optional "description" and
+        "metadata" keys. Images are verified first, then embedded and stored in
+        batches of `batch_size` with a single forward pass and a single
+        `collection.add` per batch; a batch that fails is retried one image at a
+        time so only the bad file fails. Returns one result per item, in input order,
+        with either an "id" or an "error" (plus "invalid" when the image itself
+        failed verification).
+        """
+        results = [{"path": item.get("path")} for item in items]
+        pending = []
+        stored = []
+
+        for i, item in enumerate(items):
+            image_path = item.get("path")
+            try:
+                if not image_path or not os.path.exists(image_path):
+                    raise FileNotFoundError(f"Image not found: {image_path}")
+                with metrics.span("image.verify"), Image.open(image_path) as img:
+                    img.verify()
+            except Exception as e:
+                results[i]["error"] = str(e)
+                results[i]["invalid"] = True
+                continue
+
+            metadata = dict(item.get("metadata") or {})
+            if "path" in metadata and os.path.isabs(metadata["path"]):
+                metadata["path"] = os.path.relpath(metadata["path"], os.getcwd())
+            if "description" not in metadata:
+                metadata["description"] = item.get("description") or os.path.basename(image_path)
+            pending.append((i, image_path, metadata))
+
+        def ingest(batch):
+            ids = [str(uuid.uuid4()) for _ in batch]
+            uris = [image_path for _, image_path, _ in batch]
+            metadatas = [metadata for _, _, metadata in batch]
+            try:
+                with metrics.span("image.decode"):
+                    images = self.data_loader(uris=uris)
+                with metrics.span("embed"):
+                    embeddings = self.embedding_function(images)
+                with metrics.span("vector.add"):
+                    self._add(
+                        ids=ids,
+                        embeddings=embeddings,
+                        documents=[metadata["description"] for metadata in metadatas],
+                        uris=uris,
+                        metadatas=metadatas
+                    )
+            except Exception as e:
+                if len(batch) > 1:
+                    # Don't let one bad file fail the rest of its batch
+                    print(f"[WARN] Failed to ingest batch, retrying its {len(batch)} images one by one: {e}")
+                    for entry in batch:
+                        ingest([entry])
+                    return
+                print(f"[ERROR] Failed to ingest {uris[0]}: {e}")
+                results[batch[0][0]]["error"] = str(e)
+                return
+            for (i, _, metadata), record_id in zip(batch, ids):
+                results[i]["id"] = record_id
+                stored.append((record_id, metadata))
+
+        batch_size = max(1, int(batch_size))
+        for start in range(0, len(pending), batch_size):
+            ingest(pending[start:start + batch_size])
+
+        if stored:
+            self._mark_write(upserted=stored)
+        return results
+
+    @metrics.span("embed.query")
+    def _embed_queries(self, items):
+        """
+        Embed query texts/images, through the micro-batching queue when enabled.
+        """
+        if self.query_batcher is not None:
+            return self.query_batcher.embed(items)
+        return self.embedding_function(items)
+
+    def _query_embedding(self, key, load_item):
+        """
+        Return the cached embedding for `key`, embedding `load_item()` on a miss.
+        """
+        embedding = self.embedding_cache.get(key)
+        if embedding is None:
+            embedding = self._embed_queries([load_item()])[0]
+            self.embedding_cache.put(key, embedding)
+        return embedding
+
+    def _query(self, query_embeddings, n_results=5, where=None, where_document=None, max_distance=None,
+               include=None, ef_search=None, mmr_lambda=None, columnar=False):
+        """
+        One collection.query for one or more query embeddings, with the filters
+        pushed down into Chroma. Returns one formatted result per query: a list
+        of match dicts, or a dict of columns with `columnar`.
+
+        Chroma searches the HNSW graph with ef = max(ef_search, n_results), so a
+        per-request `ef_search` above the collection's is applied by asking for
+        that many results and keeping the first `n_results`. With `mmr_lambda`,
+        MMR_FETCH_FACTOR times as many candidates are fetched (with their
+        embeddings) and re-ranked for diversity.
+        """
+        include = list(include or SEARCH_INCLUDE)
+        fetch = max(n_results, ef_search or 0)
+        query_include = include if max_distance is None or "distances" in include else include + ["distances"]
+        if mmr_lambda is not None:
+            fetch = max(fetch, n_results * MMR_FETCH_FACTOR)
+            query_include = query_include + ["embeddings"]
+        with metrics.span("vector.query"):
+            collection = self.collection
+            if self._compact_state(collection) is not None:
+                results = self.compact_index.query(
+                    collection, query_embeddings, fetch, where=where or None,
+                    where_document=where_document or None, with_embeddings=mmr_lambda is not None,
+                    space=self._space
+                )
+            else:
+                results = collection.query(
+                    query_embeddings=query_embeddings,
+                    n_results=fetch,
+                    where=where or None,
+                    where_document=where_document or None,
+                    include=query_include
+                )
+        with metrics.span("results.format"):
+            return [
+                self._format_results(
+                    results, index, include, max_distance, n_results,
+                    query_embedding=query_embeddings[index], mmr_lambda=mmr_lambda, columnar=columnar
+                )
+                for index in range(len(query_embeddings))
+            ]
+
+    @staticmethod
+    def _options_key(n_results, where=None, where_document=None, max_distance=None, include=None, ef_search=None,
+                     mmr_lambda=None, columnar=False):
+        return (
+            n_results,
+            ef_search,
+            mmr_lambda,
+            columnar,
+            json.dumps(where, sort_keys=True) if where else None,
+            json.dumps(where_document, sort_keys=True) if where_document else None,
+            max_distance,
+            tuple(include or SEARCH_INCLUDE)
         )
-        return self._format_results(results)
 
-    def search_by_image(self, image_path, n_results=5):
+    def _cached_search(self, query_key, load_item, options):
+        self._check_write_version()
+        result_key = (query_key, self._options_key(**options))
+        cached = self.result_cache.get(result_key)
+        if cached is not None:
+            # Callers (jsonify, hybrid fusion) may modify what they get; the cache keeps its own copy
+            return copy.deepcopy(cached)
+
+        generation = self._generation
+        formatted = self._query([self._query_embedding(query_key, load_item)], **options)[0]
+        # Don't cache results that a concurrent write may already have made stale
+        if generation == self._generation:
+            self.result_cache.put(result_key, copy.deepcopy(formatted))
+        return formatted
+
+    def search_many(self, query_texts, n_results=5, where=None, where_document=None, max_distance=None,
+                    include=None, ef_search=None, mmr_lambda=None, columnar=False):
+        """
+        Vector search for many texts at once: uncached queries are embedded in
+        one forward pass and answered by a single collection.query.
+        Returns one result list per query, in order.
+        """
+        options = dict(n_results=n_results, where=where, where_document=where_document,
+                       max_distance=max_distance, include=include, ef_search=ef_search,
+                       mmr_lambda=mmr_lambda, columnar=columnar)
+        options_key = self._options_key(**options)
+        self._check_write_version()
+        generation = self._generation
+
+        normalized = [normalize_query(text) for text in query_texts]
+        results = [copy.deepcopy(self.result_cache.get((("text", text), options_key))) for text in normalized]
+        missing = [i for i, cached in enumerate(results) if cached is None]
+        if not missing:
+            return results
+
+        embeddings = {}
+        for i in missing:
+            embedding = self.embedding_cache.get(("text", normalized[i]))
+            if embedding is not None:
+                embeddings[normalized[i]] = embedding
+        to_embed = list(dict.fromkeys(normalized[i] for i in missing if normalized[i] not in embeddings))
+        if to_embed:
+            for text, embedding in zip(to_embed, self._embed_queries(to_embed)):
+                self.embedding_cache.put(("text", text), embedding)
+                embeddings[text] = embedding
+
+        queried = self._query([embeddings[normalized[i]] for i in missing], **options)
+        for i, formatted in zip(missing, queried):
+            results[i] = formatted
+            if generation == self._generation:
+                self.result_cache.put((("text", normalized[i]), options_key), copy.deepcopy(formatted))
+        return results
+
+    def add_pdf(self, pdf_path, pages, description="", metadata={}, batch_size=8):
+        """
+        Index a PDF as a parent record plus, for every page, an image record
+        (the rasterized page) and a text record (the extracted page text).
+
+        `pages` yields (page_number, RGB array, text) and is consumed in batches
+        of `batch_size`, so memory stays bounded for long plan sets. Page records
+        carry "parent_id", "page" and the parent's "path", so search hits point
+        at the exact page while QR/download serve the parent PDF.
+        """
+        if not os.path.exists(pdf_path):
+            raise FileNotFoundError(f"PDF not found: {pdf_path}")
+
+        metadata = dict(metadata)
+        if "path" in metadata and os.path.isabs(metadata["path"]):
+            metadata["path"] = os.path.relpath(metadata["path"], os.getcwd())
+        metadata.setdefault("path", os.path.relpath(pdf_path, os.getcwd()))
+        metadata.setdefault("type", "pdf")
+        if "description" not in metadata:
+            metadata["description"] = description or os.path.basename(pdf_path)
+        filename = metadata.get("filename", os.path.basename(pdf_path))
+        if self.metadata_index is not None and not metadata.get("sha256"):
+            metadata["size"], metadata["mtime"], metadata["sha256"] = file_fingerprint(pdf_path)
+
+        parent_id = str(uuid.uuid4())
+        stored = []
+        documents = {}
+        buffer = []
+
+        def flush():
+            if not buffer:
+                return
+            with metrics.span("embed"):
+                embeddings = self.embedding_function([item for _, item, _, _ in buffer])
+            with metrics.span("vector.add"):
+                self._add(
+                    ids=[record_id for record_id, _, _, _ in buffer],
+                    embeddings=embeddings,
+                    documents=[document for _, _, document, _ in buffer],
+                    metadatas=[page_metadata for _, _, _, page_metadata in buffer]
+                )
+            stored.extend((record_id, page_metadata) for record_id, _, _, page_metadata in buffer)
+            documents.update((record_id, document) for record_id, _, document, _ in buffer)
+            buffer.clear()
+
+        page_count = 0
+        try:
+            for page_number, image, text in pages:
+                page_count = max(page_count, page_number)
+                page_metadata = {
+                    "parent_id": parent_id,
+                    "page": page_number,
+                    "filename": filename,
+                    "path": metadata["path"],
+                    "description": f"{metadata['description']} (p. {page_number})",
+                    # Spares the metadata index a hash of the whole PDF for every batch of pages
+                    **{key: metadata[key] for key in ("size", "mtime", "sha256") if key in metadata}
+                }
+                if image is not None:
+                    buffer.append((f"{parent_id}:p{page_number}", image, text or page_metadata["description"],
+                                   dict(page_metadata, type="pdf_page")))
+                if text:
+                    buffer.append((f"{parent_id}:p{page_number}:text", text, text,
+                                   dict(page_metadata, type="pdf_page_text")))
+                if len(buffer) >= batch_size:
+                    flush()
+            flush()
+
+            metadata["pages"] = page_count
+            self._add(
+                ids=[parent_id],
+                embeddings=self.embedding_function([metadata["description"]]),
+                documents=[metadata["description"]],
+                metadatas=[metadata]
+            )
+        except Exception:
+            # Don't leave pages without a parent behind
+            if stored:
+                self.collection.delete(ids=[record_id for record_id, _ in stored])
+            raise
+
+        stored.append((parent_id, metadata))
+        self._mark_write(upserted=stored, documents=documents)
+        return parent_id
+
+    def search_by_text(self, query_text, n_results=5, mode="vector", where=None, where_document=None,
+                       max_distance=None, include=None, ef_search=None, mmr_lambda=None, columnar=False):
+        """
+        Text search. `mode` is "vector" (embedding similarity), "keyword"
+        (FTS5 over filename, description and document text) or "hybrid"
+        (both, merged with reciprocal-rank fusion).
+
+        `where`/`where_document` are Chroma filters applied inside the query,
+        `max_distance` drops weaker vector matches, `include` projects the
+        returned fields (any of "documents", "metadatas", "distances") and
+        `ef_search` raises the HNSW search breadth for this query only.
+
+        Vector mode only: `mmr_lambda` re-ranks for diversity (1.0 = pure
+        relevance) and `columnar` returns columns instead of match dicts.
+        """
+        options = dict(n_results=n_results, where=where, where_document=where_document,
+                       max_distance=max_distance, include=include, ef_search=ef_search)
+        if mode != "vector" and (mmr_lambda is not None or columnar):
+            raise ValueError("mmr_lambda and columnar only apply to vector search")
+        if mode == "keyword":
+            return self.search_keyword(query_text, **options)
+        if mode == "hybrid":
+            return self.search_hybrid(query_text, **options)
+        if mode != "vector":
+            raise ValueError(f"Unknown search mode: {mode}")
+        options.update(mmr_lambda=mmr_lambda, columnar=columnar)
+        normalized = normalize_query(query_text)
+        return self._cached_search(("text", normalized), lambda: normalized, options)
+
+    def _filter_ids(self, ids, where=None, where_document=None):
+        """
+        Keep the ids (in order) that pass the Chroma filters.
+        """
+        if not ids or not (where or where_document):
+            return ids
+        passing = set(self.collection.get(
+            ids=ids, where=where or None, where_document=where_document or None, include=[]
+        ).get("ids") or [])
+        return [item_id for item_id in ids if item_id in passing]
+
+    def search_keyword(self, query_text, n_results=5, filename_phrase=False, where=None, where_document=None,
+                       max_distance=None, include=None, ef_search=None):
+        """
+        Keyword search on the FTS5 index. Matches have no distance, so
+        `max_distance` and `ef_search` do not apply; filters are checked
+        against Chroma.
+        """
+        if self.keyword_index is None:
+            return []
+        fetch = n_results * 4 if where or where_document else n_results
+        with metrics.span("keyword.search"):
+            hits = self.keyword_index.search(query_text, limit=fetch, filename_phrase=filename_phrase)
+        allowed = set(self._filter_ids([hit[0] for hit in hits], where, where_document))
+        matches = [
+            {"id": item_id, "document": document, "metadata": metadata, "distance": None}
+            for item_id, document, metadata in hits if item_id in allowed
+        ][:n_results]
+        return [_project(match, include) for match in matches]
+
+    def search_hybrid(self, query_text, n_results=5, rrf_k=60, where=None, where_document=None,
+                      max_distance=None, include=None, ef_search=None):
+        """
+        Keyword and vector search merged with reciprocal-rank fusion
+        (score = sum of 1 / (rrf_k + rank)).
+
+        A code-like query (e.g. "AP-TEC-04") whose tokens appear in order in a
+        filename is answered from the keyword index alone, without the model.
+        """
+        filters = dict(where=where, where_document=where_document)
+        if looks_like_code(query_text):
+            exact = self.search_keyword(query_text, n_results, filename_phrase=True, **filters)
+            if exact:
+                for match in exact:
+                    match["score"] = None
+                    match["exact"] = True
+                return [_project(match, include) for match in exact]
+
+        fetch = n_results * 2
+        fused = {}
+        for results in (self.search_keyword(query_text, fetch, **filters),
+                        self.search_by_text(query_text, fetch, max_distance=max_distance, ef_search=ef_search,
+                                            **filters)):
+            for rank, match in enumerate(results, start=1):
+                entry = fused.setdefault(match["id"], dict(match, score=0.0))
+                entry["score"] += 1.0 / (rrf_k + rank)
+                if entry["distance"] is None:
+                    entry["distance"] = match["distance"]
+        ranked = sorted(fused.values(), key=lambda match: match["score"], reverse=True)[:n_results]
+        return [_project(match, include) for match in ranked]
+
+    def search_by_image(self, image_path, n_results=5, where=None, where_document=None, max_distance=None,
+                        include=None, ef_search=None, mmr_lambda=None, columnar=False):
         """
         Image similarity search (using image file as input).
+        Keyed by a hash of the file bytes, so a repeated photo skips the model.
         """
         if not os.path.exists(image_path):
             raise FileNotFoundError(f"Image not found: {image_path}")
 
-        with Image.open(image_path) as img:
-            img_array = np.array(img.convert('RGB'))
+        with open(image_path, "rb") as f:
+            return self.search_by_image_bytes(
+                f.read(), n_results, where, where_document, max_distance, include, ef_search, mmr_lambda, columnar
+            )
 
-        results = self.collection.query(
-            query_images=[img_array],
-            n_results=n_results,
-            include=["metadatas", "documents", "distances"]
-        )
-        return self._format_results(results)
+    def search_by_image_bytes(self, content, n_results=5, where=None, where_document=None, max_distance=None,
+                              include=None, ef_search=None, mmr_lambda=None, columnar=False):
+        """
+        Image similarity search from encoded image bytes held in memory.
+        """
+        def load_image():
+            with metrics.span("image.decode"):
+                return prepare_image(BytesIO(content), self.data_loader.min_side)
 
-    def search_by_uri(self, uri, n_results=5):
+        options = dict(n_results=n_results, where=where, where_document=where_document,
+                       max_distance=max_distance, include=include, ef_search=ef_search,
+                       mmr_lambda=mmr_lambda, columnar=columnar)
+        return self._cached_search(("image", hashlib.sha256(content).hexdigest()), load_image, options)
+
+    def search_by_uri(self, uri, n_results=5, where=None, where_document=None, max_distance=None, include=None,
+                      ef_search=None, mmr_lambda=None, columnar=False):
         """
         Search for similar items using an external URI.
         """
-        results = self.collection.query(
-            query_uris=[uri],
-            n_results=n_results,
-            include=["metadatas", "documents", "distances"]
-        )
-        return self._format_results(results)
+        return self._query(
+            self._embed_queries(self.data_loader([uri])),
+            n_results=n_results, where=where, where_document=where_document,
+            max_distance=max_distance, include=include, ef_search=ef_search,
+            mmr_lambda=mmr_lambda, columnar=columnar
+        )[0]
 
-    def _format_results(self, results):
+    def _format_results(self, results, index=0, include=SEARCH_INCLUDE, max_distance=None, n_results=None,
+                        query_embedding=None, mmr_lambda=None, columnar=False):
         """
-        Helper to format search results.
+        Helper to format search results of the `index`-th query, keeping only
+        the `include`d fields and matches within `max_distance`. The work is
+        done on columns; rows are built at the end unless `columnar`.
         """
-        matches = []
-        if results.get("ids"):
-            for i, item_id in enumerate(results["ids"][0]):
-                doc = results["documents"][0][i] if "documents" in results and results["documents"] else ""
-                metadata = results["metadatas"][0][i] if "metadatas" in results and results["metadatas"] else {}
-                distance = results["distances"][0][i] if "distances" in results and results["distances"] else None
-                matches.append({
-                    "id": item_id,
-                    "document": doc,
-                    "metadata": metadata,
-                    "distance": distance
-                })
-        return matches
+        columns = columnar_results(
+            results, index, include, max_distance, n_results,
+            space=self._space, query_embedding=query_embedding, mmr_lambda=mmr_lambda
+        )
+        return columns if columnar else result_rows(columns)
 
-    def get_all_files(self):
+    def list_files(self, limit=50, offset=0, file_type=None, filename=None):
         """
-        Retrieve all stored files from ChromaDB.
+        One page of stored files, fetching only metadata (no embeddings or
+        documents). Optional exact-match filters on type and filename are
+        pushed down into Chroma. Fetches one extra record to know if there is
+        a next page without counting the whole collection.
         """
-        results = self.collection.peek()
+        filters = []
+        if file_type:
+            filters.append({"type": file_type})
+        else:
+            # PDF pages are listed through their parent document
+            filters.append(DOCUMENTS_ONLY)
+        if filename:
+            filters.append({"filename": filename})
+        where = None
+        if len(filters) == 1:
+            where = filters[0]
+        elif filters:
+            where = {"$and": filters}
+
+        results = self.collection.get(where=where, limit=limit + 1, offset=offset, include=["metadatas"])
+        ids = results.get("ids") or []
+        metadatas = results.get("metadatas") or [{}] * len(ids)
+
         files = []
-        if results and 'ids' in results and results['ids']:
-            for i, file_id in enumerate(results['ids']):
-                metadata = results['metadatas'][i] if 'metadatas' in results and results['metadatas'] else {}
-                files.append({
-                    "id": file_id,
-                    "filename": metadata.get('filename', 'Unknown'),
-                    "path": metadata.get('path', 'No Path Available')
-                })
-        return files
+        for file_id, metadata in zip(ids[:limit], metadatas[:limit]):
+            metadata = metadata or {}
+            files.append({
+                "id": file_id,
+                "filename": metadata.get('filename', 'Unknown'),
+                "path": metadata.get('path', 'No Path Available'),
+                "type": metadata.get('type', 'unknown')
+            })
+        return {
+            "files": files,
+            "limit": limit,
+            "offset": offset,
+            "next_offset": offset + limit if len(ids) > limit else None,
+            "prev_offset": max(0, offset - limit) if offset > 0 else None
+        }
 
     def get_file_metadata(self, file_id):
         """
-        Fetch metadata for a given file ID.
+        Fetch metadata for a given file ID, from the local metadata index when
+        available (falling back to, and backfilling from, the collection).
         """
+        if self.metadata_index is not None:
+            try:
+                metadata = self.metadata_index.get(file_id)
+                if metadata is not None:
+                    return metadata
+            except Exception as e:
+                print(f"[WARN] Metadata index lookup failed: {e}")
         try:
-            result = self.collection.get(ids=[file_id])
+            result = self.collection.get(ids=[file_id], include=["metadatas"])
             if result and "metadatas" in result and result["metadatas"]:
-                return result["metadatas"][0]
+                metadata = result["metadatas"][0]
+                if self.metadata_index is not None:
+                    self.metadata_index.upsert(file_id, metadata)
+                    return self.metadata_index.get(file_id) or metadata
+                return metadata
         except Exception as e:
             print(f"[ERROR] Failed to fetch metadata: {e}")
         return None
 
+    def get_files_metadata(self, file_ids=None, where=None, limit=None):
+        """
+        Fetch metadata for many files in a single collection.get, at most
+        `limit` of them. Returns a list of (id, metadata), in `file_ids` order
+        when ids are given.
+        """
+        result = self.collection.get(ids=file_ids, where=where, limit=limit, include=["metadatas"])
+        metadata_by_id = dict(zip(result.get("ids") or [], result.get("metadatas") or []))
+        order = file_ids if file_ids is not None else result.get("ids") or []
+        return [(file_id, metadata_by_id[file_id]) for file_id in order if file_id in metadata_by_id]
+
     def delete_file(self, file_id):
         """
         Delete a file from ChromaDB and disk (if applicable).
+        Deleting a PDF (or one of its pages) removes the document and all its pages.
+        """
+        self.delete_files(file_ids=[file_id])
+
+    def delete_files(self, file_ids=None, where=None, batch_size=500):
+        """
+        Delete many files, by id list and/or Chroma metadata filter, with one
+        collection.get and one collection.delete per batch of `batch_size`.
+        PDFs are deleted with all their pages (a page id deletes its PDF), and
+        a stored file is unlinked once no remaining record points at it.
+
+        Records are deleted before files, so an interrupted run leaves at worst
+        an unreferenced file on disk, which `flask gc` removes.
+        Returns {"deleted": records deleted, "files_removed": files unlinked}.
         """
-        metadata = self.get_file_metadata(file_id)
-        if metadata and "path" in metadata:
+        batch_size = max(1, int(batch_size))
+        totals = {"deleted": 0, "files_removed": 0}
+
+        def delete_batch(batch):
+            ids = batch.get("ids") or []
+            metadatas = batch.get("metadatas") or [None] * len(ids)
+            deleted = set(ids)
+            paths = set()
+            parents = set()
+            for record_id, metadata in zip(ids, metadatas):
+                metadata = metadata or {}
+                if metadata.get("path"):
+                    paths.add(metadata["path"])
+                if metadata.get("parent_id"):
+                    parents.add(metadata["parent_id"])
+                elif metadata.get("type") == "pdf":
+                    parents.add(record_id)
+            if parents:
+                # The PDF records and every page of them
+                family = self.collection.get(
+                    where={"parent_id": {"$in": sorted(parents)}}, include=[]
+                ).get("ids") or []
+                deleted.update(family)
+                deleted.update(self.collection.get(ids=sorted(parents), include=[]).get("ids") or [])
+            deleted = sorted(deleted)
+            if not deleted:
+                return
+            with metrics.span("vector.delete"):
+                self.collection.delete(ids=deleted)
+            self._mark_write(deleted=deleted)
+            totals["deleted"] += len(deleted)
+            totals["files_removed"] += self._remove_unreferenced(paths)
+
+        if file_ids:
+            file_ids = list(dict.fromkeys(file_ids))
+            for start in range(0, len(file_ids), batch_size):
+                chunk = file_ids[start:start + batch_size]
+                batch = self.collection.get(ids=chunk, where=where or None, include=["metadatas"])
+                delete_batch(batch)
+                # Ids already gone from the collection may still linger in the local indexes
+                missing = set(chunk) - set(batch.get("ids") or [])
+                if missing and not where:
+                    self._mark_write(deleted=sorted(missing))
+        elif where:
+            # Matching records disappear as they are deleted, so always read the first page
+            while True:
+                batch = self.collection.get(where=where, limit=batch_size, include=["metadatas"])
+                if not batch.get("ids"):
+                    break
+                before = totals["deleted"]
+                delete_batch(batch)
+                if totals["deleted"] == before:
+                    break
+        return totals
+
+    def referenced_paths(self, paths, use_index=True):
+        """
+        The subset of `paths` (as stored in metadata) that some record points
+        at, from the metadata index or, without `use_index`, from the collection.
+        """
+        paths = list(paths)
+        if not paths:
+            return set()
+        if use_index and self.metadata_index is not None:
             try:
-                full_path = os.path.join(os.getcwd(), metadata["path"])
+                return {path for path in paths if self.metadata_index.count_path(path) > 0}
+            except Exception as e:
+                print(f"[WARN] Metadata index lookup failed: {e}")
+        result = self.collection.get(where={"path": {"$in": paths}}, include=["metadatas"])
+        return {(metadata or {}).get("path") for metadata in result.get("metadatas") or []} & set(paths)
+
+    def _remove_unreferenced(self, paths):
+        # Deduplicated uploads share their bytes: only unlink the last reference.
+        # The index is only a pre-filter; it may lag, so the collection has the last word.
+        removed = 0
+        candidates = set(paths) - self.referenced_paths(paths)
+        for path in candidates - self.referenced_paths(candidates, use_index=False):
+            try:
+                full_path = os.path.join(os.getcwd(), path)
                 if os.path.exists(full_path):
                     os.remove(full_path)
+                    removed += 1
             except Exception as e:
                 print(f"[WARN] Could not delete file from disk: {e}")
-
-        self.collection.delete(ids=[file_id])
+                continue
+            shard = os.path.dirname(full_path)
+            if os.path.basename(shard) == os.path.basename(full_path)[:2]:
+                try:
+                    os.rmdir(shard)  # content-addressed shard, if now empty
+                except OSError:
+                    pass
+        return removed
 
 
 # Initialize ChromaDB Utility
-chroma_db = ChromaDBUtility()
+chroma_db = ChromaDBUtility(
+    db_dir=Config.CHROMA_DB_DIR,
+    batch_wait=Config.EMBEDDING_BATCH_WAIT_MS / 1000 if Config.EMBEDDING_BATCHING else None,
+    batch_max=Config.EMBEDDING_BATCH_MAX,
+    embedding_cache_size=Config.QUERY_EMBEDDING_CACHE_SIZE,
+    result_cache_size=Config.SEARCH_RESULT_CACHE_SIZE,
+    metadata_index_path=Config.METADATA_INDEX_PATH,
+    keyword_index_path=Config.KEYWORD_INDEX_PATH,
+    compact_index_dir=Config.COMPACT_INDEX_DIR,
+    compact_oversample=Config.COMPACT_OVERSAMPLE,
+    collection_name=Config.CHROMA_COLLECTION,
+    hnsw={
+        "space": Config.HNSW_SPACE,
+        "ef_construction": Config.HNSW_EF_CONSTRUCTION,
+        "ef_search": Config.HNSW_EF_SEARCH,
+        "max_neighbors": Config.HNSW_M
+    },
+    image_min_side=Config.EMBEDDING_IMAGE_MIN_SIDE,
+    image_workers=Config.IMAGE_DECODE_WORKERS
+)
@@ -0,0 +1,323 @@
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+import numpy as np
+
+# Collection metadata of a compact collection: the directory holding its
+# projection and exact vectors, and the distance space used to re-rank
+COMPACT_KEY = "compact_index"
+COMPACT_SPACE_KEY = "compact_space"
+
+
+def exact_distances(vectors, query, space="l2"):
+    """
+    Distances from `query` to each row of `vectors`, defined like Chroma's:
+    squared L2, 1 - inner product ("ip") or 1 - cosine similarity ("cosine").
+    """
+    if space == "ip":
+        return 1.0 - vectors @ query
+    if space == "cosine":
+        norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+        norms[norms == 0] = 1.0
+        return 1.0 - (vectors @ query) / norms
+    return np.sum((vectors - query) ** 2, axis=1)
+
+
+class PCAProjection:
+    """
+    Linear projection of full embeddings onto their first `dims` principal
+    components, fitted on a sample of stored vectors with numpy's SVD.
+    """
+
+    def __init__(self, mean, components):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)
+
+    @property
+    def dims(self):
+        return self.components.shape[0]
+
+    @classmethod
+    def fit(cls, vectors, dims):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        dims = min(dims, *vectors.shape)
+        mean = vectors.mean(axis=0)
+        _, _, vt = np.linalg.svd(vectors - mean, full_matrices=False)
+        return cls(mean, vt[:dims])
+
+    def project(self, vectors):
+        return (np.asarray(vectors, dtype=np.float32) - self.mean) @ self.components.T
+
+    def save(self, path):
+        np.savez(path, mean=self.mean, components=self.components)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["mean"], data["components"])
+
+
+class ExactVectorStore:
+    """
+    Full-precision vectors in a flat float32 file, read back row by row for
+    re-ranking. An SQLite table maps ids to rows and hands out rows, so several
+    processes can write safely. A replaced record keeps its row, and rows of
+    deleted records are reused by the next inserts, so the file never grows
+    past the largest number of records stored at once.
+    """
+
+    def __init__(self, index_dir, dims):
+        self.dims = dims
+        self.data_path = os.path.join(index_dir, "exact.f32")
+        self.db_path = os.path.join(index_dir, "vectors.db")
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS vectors (id TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS free_rows (row INTEGER PRIMARY KEY)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def _connect(self):
+        # One connection per thread and per process (connections must not cross a fork)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _rows_of(conn, ids):
+        rows = {}
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ", ".join("?" for _ in chunk)
+            rows.update(conn.execute(f"SELECT id, row FROM vectors WHERE id IN ({placeholders})", chunk).fetchall())
+        return rows
+
+    def put_many(self, ids, vectors):
+        ids = list(ids)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(ids), self.dims)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self._rows_of(conn, ids)
+            new_ids = [record_id for record_id in dict.fromkeys(ids) if record_id not in rows]
+            if new_ids:
+                free = [row for (row,) in conn.execute(
+                    "SELECT row FROM free_rows ORDER BY row LIMIT ?", (len(new_ids),)
+                )]
+                conn.executemany("DELETE FROM free_rows WHERE row = ?", [(row,) for row in free])
+                end = conn.execute("SELECT value FROM meta WHERE key = 'rows'").fetchone()
+                end = end[0] if end else 0
+                appended = len(new_ids) - len(free)
+                free += range(end, end + appended)
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rows', ?)", (end + appended,))
+                rows.update(zip(new_ids, free))
+                conn.executemany("INSERT INTO vectors (id, row) VALUES (?, ?)", list(zip(new_ids, free)))
+            # Write before committing so no reader sees a row that isn't there yet
+            row_bytes = self.dims * 4
+            fd = os.open(self.data_path, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                for record_id, vector in zip(ids, vectors):
+                    os.pwrite(fd, vector.tobytes(), rows[record_id] * row_bytes)
+            finally:
+                os.close(fd)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_many(self, ids):
+        """
+        Return {id: vector} for the ids that are stored.
+        """
+        if not ids or not os.path.exists(self.data_path):
+            return {}
+        rows = self._rows_of(self._connect(), list(ids))
+        row_bytes = self.dims * 4
+        vectors = {}
+        with open(self.data_path, "rb") as f:
+            fd = f.fileno()
+            for record_id, row in rows.items():
+                vectors[record_id] = np.frombuffer(os.pread(fd, row_bytes, row * row_bytes), dtype=np.float32)
+        return vectors
+
+    def iter_all(self, batch_size=10000):
+        """
+        Yield (ids, vectors matrix) for every stored record, `batch_size` at a time.
+        """
+        if not os.path.exists(self.data_path):
+            return
+        data = np.memmap(self.data_path, dtype=np.float32, mode="r").reshape(-1, self.dims)
+        cursor = self._connect().execute("SELECT id, row FROM vectors ORDER BY row")
+        while True:
+            chunk = cursor.fetchmany(batch_size)
+            if not chunk:
+                return
+            yield [record_id for record_id, _ in chunk], np.array(data[[row for _, row in chunk]])
+
+    def delete_many(self, ids):
+        ids = list(ids)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self._rows_of(conn, ids)
+            conn.executemany("DELETE FROM vectors WHERE id = ?", [(record_id,) for record_id in rows])
+            conn.executemany("INSERT OR IGNORE INTO free_rows (row) VALUES (?)", [(row,) for row in rows.values()])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+
+
+class CompactIndex:
+    """
+    Compact vector storage. A compact collection (made by `rebuild_index`
+    with `compact_dims`, i.e. `flask build-compact-index`) holds every record
+    with its embedding PCA-reduced, so its HNSW index, the only one a process
+    loads, is several times smaller. The full-precision vectors live in an
+    ExactVectorStore on disk and are only read to re-rank search candidates.
+
+    The candidate search is L2 in PCA space; the exact re-rank uses the
+    space the collection was built for (its "compact_space" metadata), so
+    distances, scores and `max_distance` mean the same as with full vectors.
+    Each compact collection names its own artifacts directory under
+    `index_dir` (its "compact_index" metadata), so a `rebuild_index` swap
+    carries the compact state over.
+    """
+
+    def __init__(self, index_dir, oversample=4):
+        self.index_dir = os.path.abspath(index_dir)
+        self.oversample = oversample
+        self._states = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_of(collection):
+        return (collection.metadata or {}).get(COMPACT_KEY)
+
+    def state(self, collection):
+        """
+        (projection, exact vector store) of a compact collection, or None for
+        a collection that holds full vectors.
+        """
+        key = self.key_of(collection)
+        if not key:
+            return None
+        state = self._states.get(key)
+        if state is None:
+            with self._lock:
+                state = self._states.get(key)
+                if state is None:
+                    directory = os.path.join(self.index_dir, key)
+                    projection = PCAProjection.load(os.path.join(directory, "projection.npz"))
+                    state = (projection, ExactVectorStore(directory, projection.components.shape[1]))
+                    self._states[key] = state
+        return state
+
+    def create(self, sample, dims):
+        """
+        Fit a projection on `sample` and create an empty artifacts directory
+        for it. Returns (key, projection, exact vector store).
+        """
+        projection = PCAProjection.fit(sample, dims)
+        key = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+        directory = os.path.join(self.index_dir, key)
+        os.makedirs(directory)
+        projection.save(os.path.join(directory, "projection.npz"))
+        vectors = ExactVectorStore(directory, projection.components.shape[1])
+        with self._lock:
+            self._states[key] = (projection, vectors)
+        return key, projection, vectors
+
+    def remove(self, key):
+        with self._lock:
+            self._states.pop(key, None)
+        shutil.rmtree(os.path.join(self.index_dir, key), ignore_errors=True)
+
+    def query(self, collection, query_embeddings, n_results, where=None, where_document=None, with_embeddings=False,
+              space="l2"):
+        """
+        Same contract as collection.query on a compact collection: candidates
+        come from its reduced vectors, distances (in `space`, like Chroma's)
+        from the exact vectors, which are also returned as "embeddings" with
+        `with_embeddings`.
+        """
+        projection, vectors = self.state(collection)
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        candidates = collection.query(
+            query_embeddings=projection.project(query_embeddings),
+            n_results=n_results * self.oversample,
+            where=where,
+            where_document=where_document,
+            include=["documents", "metadatas"]
+        )
+        results = {"ids": [], "documents": [], "metadatas": [], "distances": [], "embeddings": []}
+        for i, query in enumerate(query_embeddings):
+            ids = candidates["ids"][i]
+            exact = vectors.get_many(ids)
+            found = [j for j, record_id in enumerate(ids) if record_id in exact]
+            distances = exact_distances(np.array([exact[ids[j]] for j in found]).reshape(len(found), -1), query, space)
+            scored = sorted(zip(distances.tolist(), found))[:n_results]
+            results["ids"].append([ids[j] for _, j in scored])
+            results["documents"].append([candidates["documents"][i][j] for _, j in scored])
+            results["metadatas"].append([candidates["metadatas"][i][j] for _, j in scored])
+            results["distances"].append([distance for distance, _ in scored])
+            results["embeddings"].append([exact[ids[j]] for _, j in scored])
+        if not with_embeddings:
+            results["embeddings"] = None
+        return results
+
+
+def recall_report(collection, compact_index, queries=100, k=10, space="l2"):
+    """
+    Compare compact search on a compact `collection` with exact brute-force
+    search over its full-precision vectors, using `queries` stored vectors as
+    queries: recall@k, and the mean/p95 latency of each, in milliseconds.
+    """
+    state = compact_index.state(collection)
+    if state is None:
+        return None
+    _, vectors = state
+    ids = [record_id for batch_ids, _ in vectors.iter_all() for record_id in batch_ids]
+    if not ids:
+        return None
+    rng = np.random.default_rng(0)
+    picks = rng.choice(len(ids), size=min(queries, len(ids)), replace=False)
+    report = {"exact_ms": [], "compact_ms": [], "recall": []}
+    for pick in picks:
+        query = vectors.get_many([ids[pick]])[ids[pick]]
+
+        start = time.perf_counter()
+        best = []
+        for batch_ids, batch in vectors.iter_all():
+            distances = exact_distances(batch, query, space)
+            nearest = np.argsort(distances)[:k]
+            best = sorted(best + [(float(distances[j]), batch_ids[j]) for j in nearest])[:k]
+        exact = [record_id for _, record_id in best]
+        report["exact_ms"].append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        compact = compact_index.query(collection, [query], k, space=space)["ids"][0]
+        report["compact_ms"].append((time.perf_counter() - start) * 1000)
+
+        report["recall"].append(len(set(exact) & set(compact)) / max(1, len(exact)))
+
+    return {
+        "queries": len(picks),
+        "k": k,
+        "recall_at_k": float(np.mean(report["recall"])),
+        "exact_ms_mean": float(np.mean(report["exact_ms"])),
+        "exact_ms_p95": float(np.percentile(report["exact_ms"], 95)),
+        "compact_ms_mean": float(np.mean(report["compact_ms"])),
+        "compact_ms_p95": float(np.percentile(report["compact_ms"], 95))
+    }
@@ -0,0 +1,95 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class EmbeddingBatcher:
+    """
+    Dynamic micro-batching in front of an embedding function.
+
+    Concurrent callers enqueue their items; a dispatcher thread collects them
+    for at most `max_wait` seconds (or until `max_batch` items are waiting),
+    runs a single forward pass for the whole batch and hands each caller its
+    own embedding back. Callers wait at most `timeout` seconds.
+    """
+
+    def __init__(self, embedding_function, max_wait=0.005, max_batch=32, timeout=60):
+        self.embedding_function = embedding_function
+        self.max_wait = max_wait
+        self.max_batch = max(1, max_batch)
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None
+        self.batches = 0
+        self.items = 0
+
+    def _ensure_dispatcher(self):
+        # Threads don't survive a fork, so start one per process
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                    threading.Thread(target=self._dispatch_loop, daemon=True).start()
+                    self._pid = os.getpid()
+
+    def embed(self, items):
+        """
+        Embed a list of documents and/or images, blocking until done.
+        """
+        if not items:
+            return []
+        self._ensure_dispatcher()
+        futures = []
+        for item in items:
+            future = Future()
+            self._queue.put((item, future))
+            futures.append(future)
+        deadline = time.monotonic() + self.timeout
+        # Raises TimeoutError rather than blocking a request thread forever
+        return [future.result(timeout=max(0, deadline - time.monotonic())) for future in futures]
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, batch):
+        try:
+            embeddings = list(self.embedding_function([item for item, _ in batch]))
+            if len(embeddings) != len(batch):
+                # Can't tell which item was skipped, so no embedding can be trusted
+                raise RuntimeError(f"Got {len(embeddings)} embeddings for {len(batch)} items")
+        except Exception as e:
+            if len(batch) > 1:
+                # Don't let one caller's bad item fail everyone else's
+                for entry in batch:
+                    self._run([entry])
+                return
+            batch[0][1].set_exception(e)
+            return
+        self.batches += 1
+        self.items += len(batch)
+        for (_, future), embedding in zip(batch, embeddings):
+            future.set_result(embedding)
+
+    def _dispatch_loop(self):
+        while True:
+            batch = self._collect()
+            try:
+                self._run(batch)
+            except Exception as e:
+                # Keep the dispatcher alive; nobody may be left waiting
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
@@ -0,0 +1,259 @@
+import hashlib
+import os
+import threading
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+from chromadb.api.types import EmbeddingFunction, is_document, is_image
+from chromadb.utils.embedding_functions import OpenCLIPEmbeddingFunction
+
+from config import Config
+from database.embedding_batcher import EmbeddingBatcher
+
+
+class LazyOpenCLIPEmbeddingFunction(OpenCLIPEmbeddingFunction):
+    """
+    OpenCLIP embedding function that only loads the model on first use.
+
+    Keeps the "open_clip" name and config so existing collections accept it,
+    while routes that never embed (login, token access) never load the model.
+    """
+
+    def __init__(self, model_name="ViT-B-32", checkpoint="laion2b_s34b_b79k", device="cpu"):
+        self.model_name = model_name
+        self.checkpoint = checkpoint
+        self.device = device
+        self._loaded = False
+        self._load_lock = threading.Lock()
+
+    @property
+    def is_loaded(self):
+        return self._loaded
+
+    def warm_up(self):
+        """
+        Load the model weights now. Called before the gunicorn fork (--preload)
+        so every worker shares one copy-on-write copy. No forward pass is run
+        here: starting torch's thread pool before a fork can deadlock the workers.
+        """
+        if self._loaded:
+            return
+        with self._load_lock:
+            if not self._loaded:
+                OpenCLIPEmbeddingFunction.__init__(self, self.model_name, self.checkpoint, self.device)
+                self._loaded = True
+
+    def __call__(self, input):
+        """
+        Embed documents and images with one forward pass per modality, instead
+        of the item-by-item loop in OpenCLIPEmbeddingFunction. Returns one
+        embedding per item; raises ValueError on anything else.
+        """
+        images = [(i, item) for i, item in enumerate(input) if is_image(item)]
+        texts = [(i, item) for i, item in enumerate(input) if not is_image(item) and is_document(item)]
+        if len(images) + len(texts) != len(input):
+            raise ValueError("Items must be documents (str) or images (numpy arrays)")
+        self.warm_up()
+        embeddings = [None] * len(input)
+
+        with self._torch.no_grad():
+            if images:
+                batch = self._torch.stack([
+                    self._preprocess(self._PILImage.fromarray(image)) for _, image in images
+                ]).to(self.device)
+                self._store(embeddings, images, self._model.encode_image(batch))
+            if texts:
+                tokens = self._tokenizer([text for _, text in texts]).to(self.device)
+                self._store(embeddings, texts, self._model.encode_text(tokens))
+
+        return embeddings
+
+    @staticmethod
+    def _store(embeddings, items, features):
+        features /= features.norm(dim=-1, keepdim=True)
+        for (i, _), vector in zip(items, features.cpu().numpy()):
+            embeddings[i] = np.asarray(vector, dtype=np.float32)
+
+    @staticmethod
+    def build_from_config(config):
+        # Chroma calls this while validating the collection config; stay lazy there too
+        return LazyOpenCLIPEmbeddingFunction(
+            model_name=config.get("model_name"),
+            checkpoint=config.get("checkpoint"),
+            device=config.get("device")
+        )
+
+
+class RemoteEmbeddingFunction(LazyOpenCLIPEmbeddingFunction):
+    """
+    Embedding function that delegates to a single embedding server process
+    over a Unix socket, so web workers never hold the model themselves.
+    """
+
+    def __init__(self, socket_path, authkey, model_name="ViT-B-32", checkpoint="laion2b_s34b_b79k", device="cpu"):
+        super().__init__(model_name, checkpoint, device)
+        _require_authkey(authkey)
+        self.socket_path = socket_path
+        self.authkey = authkey
+        self._local = threading.local()
+
+    def _connection(self):
+        # One connection per thread and per process
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = Client(self.socket_path, family="AF_UNIX", authkey=self.authkey)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def warm_up(self):
+        self._connection()
+
+    def __call__(self, input):
+        conn = self._connection()
+        try:
+            conn.send(list(input))
+            result = conn.recv()
+        except (EOFError, OSError):
+            # Server restarted: drop the stale connection and retry once
+            self._local.conn = None
+            conn = self._connection()
+            conn.send(list(input))
+            result = conn.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class StubEmbeddingFunction(EmbeddingFunction):
+    """
+    Deterministic stand-in for the model: every text or image maps to a fixed
+    unit vector seeded from a hash of its content. For benchmarks and tests
+    that measure the vector store and the web stack without OpenCLIP.
+    """
+
+    is_loaded = True
+
+    def __init__(self, dims=512):
+        self.dims = dims
+
+    def warm_up(self):
+        pass
+
+    def __call__(self, input):
+        embeddings = []
+        for item in input:
+            content = item.encode() if isinstance(item, str) else np.ascontiguousarray(item).tobytes()
+            seed = int.from_bytes(hashlib.sha256(content).digest()[:8], "little")
+            vector = np.random.default_rng(seed).standard_normal(self.dims).astype(np.float32)
+            embeddings.append(vector / np.linalg.norm(vector))
+        return embeddings
+
+    @staticmethod
+    def name():
+        return "stub"
+
+    def get_config(self):
+        return {"dims": self.dims}
+
+    @staticmethod
+    def build_from_config(config):
+        return StubEmbeddingFunction(dims=config.get("dims", 512))
+
+
+def _require_authkey(authkey):
+    # The socket carries pickles: a guessable key would let any local user run
+    # code in the model process, so there is no fallback to SECRET_KEY
+    if not authkey:
+        raise ValueError("EMBEDDING_MODE=remote requires EMBEDDING_AUTHKEY to be set")
+
+
+def _private_socket_dir(socket_path):
+    """
+    Create the socket's directory with mode 0700 and refuse to listen in one
+    that other users can enter or that belongs to someone else.
+    """
+    directory = os.path.dirname(os.path.abspath(socket_path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.stat(directory)
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise RuntimeError(
+            f"Embedding socket directory {directory} must be owned by this user "
+            f"with mode 0700 (is {oct(st.st_mode & 0o777)})"
+        )
+    return directory
+
+
+def create_embedding_function(config=Config):
+    """
+    Build the embedding function selected by `EMBEDDING_MODE` ("local",
+    "remote" or "stub", the deterministic model-free stand-in).
+    """
+    kwargs = {
+        "model_name": config.OPENCLIP_MODEL,
+        "checkpoint": config.OPENCLIP_CHECKPOINT,
+        "device": config.EMBEDDING_DEVICE
+    }
+    if config.EMBEDDING_MODE == "remote":
+        return RemoteEmbeddingFunction(config.EMBEDDING_SOCKET, config.EMBEDDING_AUTHKEY, **kwargs)
+    if config.EMBEDDING_MODE == "local":
+        return LazyOpenCLIPEmbeddingFunction(**kwargs)
+    if config.EMBEDDING_MODE == "stub":
+        return StubEmbeddingFunction(dims=config.EMBEDDING_STUB_DIMS)
+    raise ValueError(f"Unknown embedding mode: {config.EMBEDDING_MODE}")
+
+
+def _handle_connection(conn, batcher):
+    with conn:
+        while True:
+            try:
+                items = conn.recv()
+            except EOFError:
+                return
+            try:
+                result = batcher.embed(items)
+            except Exception as e:
+                result = e
+            conn.send(result)
+
+
+def serve(config=Config):
+    """
+    Run the embedding server: load the model once and answer embedding
+    requests from web workers on `EMBEDDING_SOCKET`.
+    """
+    _require_authkey(config.EMBEDDING_AUTHKEY)
+    _private_socket_dir(config.EMBEDDING_SOCKET)
+    embedding_function = LazyOpenCLIPEmbeddingFunction(
+        model_name=config.OPENCLIP_MODEL,
+        checkpoint=config.OPENCLIP_CHECKPOINT,
+        device=config.EMBEDDING_DEVICE
+    )
+    embedding_function.warm_up()
+
+    if os.path.exists(config.EMBEDDING_SOCKET):
+        os.remove(config.EMBEDDING_SOCKET)
+    # Requests from all web workers are micro-batched into shared forward passes
+    batcher = EmbeddingBatcher(
+        embedding_function,
+        max_wait=config.EMBEDDING_BATCH_WAIT_MS / 1000,
+        max_batch=config.EMBEDDING_BATCH_MAX
+    )
+    with Listener(config.EMBEDDING_SOCKET, family="AF_UNIX", authkey=config.EMBEDDING_AUTHKEY) as listener:
+        os.chmod(config.EMBEDDING_SOCKET, 0o600)
+        print(f"Embedding server listening on {config.EMBEDDING_SOCKET}")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                print(f"[WARN] Rejected embedding client: {e}")
+                continue
+            threading.Thread(
+                target=_handle_connection,
+                args=(conn, batcher),
+                daemon=True
+            ).start()
+
+
+if __name__ == "__main__":
+    serve()
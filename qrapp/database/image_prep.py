@@ -0,0 +1,83 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+from chromadb.utils.data_loaders import ImageLoader
+
+# CLIP resizes the shortest side to 224 px before its center crop
+DEFAULT_MIN_SIDE = 224
+# Modes Image.reduce() works on directly
+REDUCE_MODES = {"L", "LA", "RGB", "RGBA", "RGBa", "La", "CMYK", "I", "F"}
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers):
+    # Threads don't survive a fork: one pool per process
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-prep")
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def prepare_image(source, min_side=DEFAULT_MIN_SIDE):
+    """
+    Decode an image (path or file object) to a model-sized RGB array whose
+    shortest side is `min_side`, without ever converting it to RGB at full
+    resolution:
+
+    - JPEG uses draft mode, decoding at 1/2, 1/4 or 1/8 scale from the DCT.
+    - Other formats (PNG scans and plans) are reduced by an integer factor in
+      their native mode (e.g. grayscale), then converted to RGB at the small size.
+    """
+    with Image.open(source) as img:
+        width, height = img.size
+        short = min(width, height)
+        if short > min_side:
+            # Integer arithmetic: the shortest side is exactly `min_side`, the other rounds up
+            target = (-(-width * min_side // short), -(-height * min_side // short))
+        else:
+            target = (width, height)
+
+        if img.format == "JPEG":
+            img.draft("RGB", target)
+        else:
+            factor = short // min_side
+            if factor > 1:
+                if img.mode not in REDUCE_MODES:
+                    # Palette/bilevel images: expand to the smallest mode reduce() accepts
+                    img = img.convert("L" if img.mode == "1" else "RGB")
+                img = img.reduce(factor)
+
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        if img.size != target:
+            img = img.resize(target, Image.BICUBIC)
+        return np.asarray(img)
+
+
+class PreparedImageLoader(ImageLoader):
+    """
+    Chroma data loader that decodes URIs through `prepare_image`. Batches run
+    on a shared thread pool (PIL releases the GIL while decoding) instead of
+    a new pool per call; single images are decoded inline.
+    """
+
+    def __init__(self, min_side=DEFAULT_MIN_SIDE, max_workers=4):
+        super().__init__(max_workers=max_workers)
+        self.min_side = min_side
+
+    def _load_image(self, uri):
+        return prepare_image(uri, self.min_side) if uri is not None else None
+
+    def __call__(self, uris):
+        uris = list(uris)
+        if len(uris) <= 1 or self._max_workers <= 1:
+            return [self._load_image(uri) for uri in uris]
+        return list(_get_pool(self._max_workers).map(self._load_image, uris))
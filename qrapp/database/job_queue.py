@@ -0,0 +1,205 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"  # failed at least once, waiting for a retry
+DEAD = "dead"      # out of attempts (dead letter)
+
+
+class JobQueue:
+    """
+    Persistent job queue in a WAL-mode SQLite file, shared by the web workers
+    (which enqueue) and the ingestion worker processes (which claim jobs).
+
+    Claimed jobs carry a lease; if a worker dies mid-job the lease expires
+    and the job becomes claimable again. Failed jobs are retried with
+    exponential backoff and moved to the dead-letter state after
+    `max_attempts`. Done jobs are kept `retention_seconds` for status
+    polling, then removed by `prune`.
+    """
+
+    def __init__(self, db_path, max_attempts=3, lease_seconds=600, retry_delay=10, retention_seconds=86400):
+        self.db_path = os.path.abspath(db_path)
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.retry_delay = retry_delay
+        self.retention_seconds = retention_seconds
+        self._local = threading.local()
+        self._init_schema()
+
+    def _connect(self):
+        # One connection per thread and per process (connections must not cross a fork)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_schema(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = self._connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                available_at REAL NOT NULL,
+                locked_until REAL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs (status, available_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, updated_at)")
+
+    def enqueue(self, kind, payload):
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        self._connect().execute(
+            "INSERT INTO jobs (id, kind, payload, status, created_at, updated_at, available_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, kind, json.dumps(payload), QUEUED, now, now, now)
+        )
+        return job_id
+
+    def claim(self, limit=1):
+        """
+        Atomically lease up to `limit` runnable jobs, oldest first. Includes
+        running jobs whose lease has expired (their worker died).
+        """
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE "
+                "(status IN (?, ?) AND available_at <= ?) OR (status = ? AND locked_until < ?) "
+                "ORDER BY available_at LIMIT ?",
+                (QUEUED, FAILED, now, RUNNING, now, limit)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, locked_until = ?, updated_at = ? WHERE id = ?",
+                [(RUNNING, now + self.lease_seconds, now, row["id"]) for row in rows]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return [
+            {"id": row["id"], "kind": row["kind"], "payload": json.loads(row["payload"]), "attempts": row["attempts"] + 1}
+            for row in rows
+        ]
+
+    def renew(self, jobs):
+        """
+        Extend the lease of claimed jobs by another `lease_seconds`. A job whose
+        lease already ran out and was claimed again (its attempts moved on) is
+        left alone. Returns the ids still held.
+        """
+        now = time.time()
+        conn = self._connect()
+        held = []
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for job in jobs:
+                cursor = conn.execute(
+                    "UPDATE jobs SET locked_until = ?, updated_at = ? WHERE id = ? AND status = ? AND attempts = ?",
+                    (now + self.lease_seconds, now, job["id"], RUNNING, job["attempts"])
+                )
+                if cursor.rowcount:
+                    held.append(job["id"])
+        return held
+
+    def complete(self, job, result=None):
+        """
+        Mark a claimed job done. Like `renew`, this only applies while the job
+        is still held: returns False (and changes nothing) once its lease ran
+        out and another worker claimed it.
+        """
+        cursor = self._connect().execute(
+            "UPDATE jobs SET status = ?, result = ?, error = NULL, locked_until = NULL, updated_at = ? "
+            "WHERE id = ? AND status = ? AND attempts = ?",
+            (DONE, json.dumps(result), time.time(), job["id"], RUNNING, job["attempts"])
+        )
+        return cursor.rowcount > 0
+
+    def fail(self, job, error, retry=True):
+        """
+        Record a failure of a claimed job: schedule a retry with exponential
+        backoff, or move the job to the dead-letter state when out of attempts
+        (or `retry=False`). Returns the new status, or None when the job is no
+        longer held (see `complete`).
+        """
+        now = time.time()
+        attempts = job["attempts"]
+        status = FAILED if retry and attempts < self.max_attempts else DEAD
+        cursor = self._connect().execute(
+            "UPDATE jobs SET status = ?, error = ?, locked_until = NULL, available_at = ?, updated_at = ? "
+            "WHERE id = ? AND status = ? AND attempts = ?",
+            (status, str(error), now + self.retry_delay * 2 ** (attempts - 1), now, job["id"], RUNNING, attempts)
+        )
+        return status if cursor.rowcount else None
+
+    def get(self, job_id):
+        row = self._connect().execute(
+            "SELECT id, kind, status, attempts, result, error, created_at, updated_at FROM jobs WHERE id = ?",
+            (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def requeue_dead(self):
+        """
+        Give every dead-lettered job a fresh set of attempts. Returns how many.
+        """
+        now = time.time()
+        cursor = self._connect().execute(
+            "UPDATE jobs SET status = ?, attempts = 0, available_at = ?, updated_at = ? WHERE status = ?",
+            (QUEUED, now, now, DEAD)
+        )
+        return cursor.rowcount
+
+    def pending_paths(self):
+        """
+        Paths of the files of every job not yet done (including dead letters,
+        which can still be requeued).
+        """
+        # Listing the other states (not "!= done") lets the status index skip the done jobs
+        rows = self._connect().execute(
+            "SELECT DISTINCT json_extract(payload, '$.path') FROM jobs WHERE status IN (?, ?, ?, ?)",
+            (QUEUED, RUNNING, FAILED, DEAD)
+        ).fetchall()
+        return {row[0] for row in rows if row[0]}
+
+    def prune(self):
+        """
+        Delete jobs done more than `retention_seconds` ago. Returns how many.
+        """
+        cursor = self._connect().execute(
+            "DELETE FROM jobs WHERE status = ? AND updated_at < ?", (DONE, time.time() - self.retention_seconds)
+        )
+        return cursor.rowcount
+
+    def counts(self):
+        """
+        Number of jobs per status (queue depth, running, dead letters...).
+        """
+        rows = self._connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {row[0]: row[1] for row in rows}
@@ -0,0 +1,204 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+
+# PDF page rasters share their text with the pdf_page_text record; index it once
+SKIP_TYPES = {"pdf_page"}
+
+
+def query_tokens(text):
+    return re.findall(r"\w+", (text or "").lower())
+
+
+def looks_like_code(text):
+    """
+    True for single-token identifiers with a digit, e.g. "AP-TEC-04" or
+    "plano_12.png": the kind of query that is a lookup, not a description.
+    """
+    text = (text or "").strip()
+    return bool(re.fullmatch(r"[\w.\-/]+", text)) and any(ch.isdigit() for ch in text)
+
+
+class KeywordIndex:
+    """
+    SQLite FTS5 inverted index over filename, description and document text,
+    kept in sync by ChromaDBUtility's write methods. Answers exact filename
+    and code lookups that a CLIP embedding ranks poorly.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = os.path.abspath(db_path)
+        self._local = threading.local()
+        self._init_schema()
+
+    def _connect(self):
+        # One connection per thread and per process (connections must not cross a fork)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _create_table(conn, table):
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                rowid INTEGER PRIMARY KEY,
+                id TEXT UNIQUE NOT NULL,
+                filename TEXT,
+                description TEXT,
+                document TEXT,
+                metadata TEXT NOT NULL
+            )
+        """)
+
+    def _init_schema(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = self._connect()
+        self._create_table(conn, "documents")
+        # External-content FTS table: the text lives once, in `documents`
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+                filename, description, document,
+                content='documents', content_rowid='rowid',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS documents_ai AFTER INSERT ON documents BEGIN
+                INSERT INTO documents_fts (rowid, filename, description, document)
+                VALUES (new.rowid, new.filename, new.description, new.document);
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS documents_ad AFTER DELETE ON documents BEGIN
+                INSERT INTO documents_fts (documents_fts, rowid, filename, description, document)
+                VALUES ('delete', old.rowid, old.filename, old.description, old.document);
+            END
+        """)
+
+    def upsert_many(self, records, table="documents"):
+        """
+        Index (id, metadata, document) triples in a single transaction.
+        """
+        rows = []
+        for file_id, metadata, document in records:
+            metadata = metadata or {}
+            if metadata.get("type") in SKIP_TYPES:
+                continue
+            description = metadata.get("description")
+            rows.append((
+                file_id, metadata.get("filename"), description,
+                document if document != description else None, json.dumps(metadata)
+            ))
+        if not rows:
+            return
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(f"DELETE FROM {table} WHERE id = ?", [(row[0],) for row in rows])
+            conn.executemany(
+                f"INSERT INTO {table} (id, filename, description, document, metadata) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+
+    def delete_many(self, file_ids):
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany("DELETE FROM documents WHERE id = ?", [(file_id,) for file_id in file_ids])
+
+    def search(self, query, limit=10, filename_phrase=False):
+        """
+        Return up to `limit` (id, document, metadata) matches, best first.
+
+        By default every query token must appear somewhere; with
+        `filename_phrase` the tokens must appear, in order, in the filename.
+        """
+        tokens = query_tokens(query)
+        if not tokens:
+            return []
+        if filename_phrase:
+            match = 'filename : "' + " ".join(tokens) + '"'
+        else:
+            match = " ".join(f'"{token}"' for token in tokens)
+        rows = self._connect().execute(
+            "SELECT d.id, COALESCE(d.document, d.description), d.metadata FROM documents_fts "
+            "JOIN documents d ON d.rowid = documents_fts.rowid "
+            "WHERE documents_fts MATCH ? ORDER BY bm25(documents_fts, 10.0, 5.0, 1.0) LIMIT ?",
+            (match, limit)
+        ).fetchall()
+        return [(row[0], row[1] or "", json.loads(row[2])) for row in rows]
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def _drop_staging(self, conn):
+        conn.execute("DROP TRIGGER IF EXISTS documents_rebuild_ai")
+        conn.execute("DROP TRIGGER IF EXISTS documents_rebuild_ad")
+        conn.execute("DROP TABLE IF EXISTS documents_rebuild")
+        conn.execute("DROP TABLE IF EXISTS documents_changed")
+
+    def rebuild(self, collection, batch_size=500):
+        """
+        Repopulate the index from a Chroma collection, streaming it in batches
+        into a staging table that replaces the live rows in a single
+        transaction, so searches never see a partial or empty index.
+        Ids written to the live index meanwhile are logged by triggers and
+        copied over the staged rows before the swap, so no write is lost.
+        Returns the number of records read.
+        """
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._drop_staging(conn)
+            self._create_table(conn, "documents_rebuild")
+            conn.execute("CREATE TABLE documents_changed (id TEXT PRIMARY KEY)")
+            conn.execute("""
+                CREATE TRIGGER documents_rebuild_ai AFTER INSERT ON documents BEGIN
+                    INSERT OR IGNORE INTO documents_changed (id) VALUES (new.id);
+                END
+            """)
+            conn.execute("""
+                CREATE TRIGGER documents_rebuild_ad AFTER DELETE ON documents BEGIN
+                    INSERT OR IGNORE INTO documents_changed (id) VALUES (old.id);
+                END
+            """)
+        try:
+            total = 0
+            offset = 0
+            while True:
+                batch = collection.get(limit=batch_size, offset=offset, include=["metadatas", "documents"])
+                ids = batch.get("ids") or []
+                if not ids:
+                    break
+                self.upsert_many(zip(
+                    ids, batch.get("metadatas") or [None] * len(ids), batch.get("documents") or [None] * len(ids)
+                ), table="documents_rebuild")
+                total += len(ids)
+                offset += len(ids)
+            columns = "id, filename, description, document, metadata"
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                # The live index is newer for every id written since the rebuild began
+                conn.execute("DELETE FROM documents_rebuild WHERE id IN (SELECT id FROM documents_changed)")
+                conn.execute(
+                    f"INSERT INTO documents_rebuild ({columns}) SELECT {columns} FROM documents "
+                    "WHERE id IN (SELECT id FROM documents_changed)"
+                )
+                conn.execute("DROP TRIGGER documents_rebuild_ai")
+                conn.execute("DROP TRIGGER documents_rebuild_ad")
+                conn.execute("DELETE FROM documents")
+                conn.execute(f"INSERT INTO documents ({columns}) SELECT {columns} FROM documents_rebuild")
+                self._drop_staging(conn)
+        except Exception:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                self._drop_staging(conn)
+            raise
+        return total
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+
+def file_fingerprint(path, chunk_size=1024 * 1024):
+    """
+    Return (size, mtime, sha256 hex) of a file, hashing it in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+        stat = os.fstat(f.fileno())
+    return stat.st_size, stat.st_mtime, digest.hexdigest()
+
+
+class MetadataIndex:
+    """
+    Local SQLite index of file records: id -> (path, filename, type, size,
+    mtime, sha256, full metadata). Kept in sync by ChromaDBUtility's write
+    methods so serving a file never needs a round-trip into the vector store.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = os.path.abspath(db_path)
+        self._local = threading.local()
+        self._init_schema()
+
+    def _connect(self):
+        # One connection per thread and per process (connections must not cross a fork)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _create_table(conn, table):
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                id TEXT PRIMARY KEY,
+                path TEXT,
+                filename TEXT,
+                type TEXT,
+                size INTEGER,
+                mtime REAL,
+                sha256 TEXT,
+                metadata TEXT NOT NULL
+            )
+        """)
+
+    def _init_schema(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = self._connect()
+        self._create_table(conn, "files")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_files_sha256 ON files (sha256)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_files_path ON files (path)")
+
+    @staticmethod
+    def _row(file_id, metadata, fingerprints):
+        metadata = metadata or {}
+        path = metadata.get("path")
+        size, mtime, sha256 = metadata.get("size"), metadata.get("mtime"), metadata.get("sha256")
+        if path and (size is None or mtime is None or not sha256):
+            # Records sharing a file (PDF pages) look at it once per batch. An upload
+            # was hashed while it was stored (sha256 given): it is only stat'ed.
+            key = (path, bool(sha256))
+            if key not in fingerprints:
+                full_path = path if os.path.isabs(path) else os.path.join(os.getcwd(), path)
+                try:
+                    if sha256:
+                        stat = os.stat(full_path)
+                        fingerprints[key] = (stat.st_size, stat.st_mtime, None)
+                    else:
+                        fingerprints[key] = file_fingerprint(full_path)
+                except OSError:
+                    fingerprints[key] = (None, None, None)
+            size, mtime, file_sha256 = fingerprints[key]
+            sha256 = sha256 or file_sha256
+        return (
+            file_id, path, metadata.get("filename"), metadata.get("type"),
+            size, mtime, sha256, json.dumps(metadata)
+        )
+
+    def upsert_many(self, records, table="files"):
+        """
+        Insert or replace (id, metadata) pairs in a single transaction. The
+        size, mtime and sha256 come from the metadata when it has them; the
+        file is only hashed when the sha256 is missing.
+        """
+        fingerprints = {}
+        rows = [self._row(file_id, metadata, fingerprints) for file_id, metadata in records]
+        if not rows:
+            return
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {table} (id, path, filename, type, size, mtime, sha256, metadata) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+
+    def upsert(self, file_id, metadata):
+        self.upsert_many([(file_id, metadata)])
+
+    def delete_many(self, file_ids):
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany("DELETE FROM files WHERE id = ?", [(file_id,) for file_id in file_ids])
+
+    def get(self, file_id):
+        """
+        Return the stored metadata plus size, mtime and sha256, or None.
+        """
+        row = self._connect().execute(
+            "SELECT metadata, size, mtime, sha256 FROM files WHERE id = ?", (file_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        metadata = json.loads(row[0])
+        metadata.update({"size": row[1], "mtime": row[2], "sha256": row[3]})
+        return metadata
+
+    def find_by_sha256(self, sha256, types=("image",)):
+        """
+        Return the id of an existing record of one of `types` whose file has
+        this content hash, or None.
+        """
+        placeholders = ", ".join("?" for _ in types)
+        row = self._connect().execute(
+            f"SELECT id FROM files WHERE sha256 = ? AND type IN ({placeholders}) LIMIT 1",
+            (sha256, *types)
+        ).fetchone()
+        return row[0] if row else None
+
+    def count_path(self, path):
+        """
+        Number of records pointing at `path` (its reference count).
+        """
+        return self._connect().execute("SELECT COUNT(*) FROM files WHERE path = ?", (path,)).fetchone()[0]
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def _drop_staging(self, conn):
+        conn.execute("DROP TRIGGER IF EXISTS files_rebuild_ai")
+        conn.execute("DROP TRIGGER IF EXISTS files_rebuild_ad")
+        conn.execute("DROP TABLE IF EXISTS files_rebuild")
+        conn.execute("DROP TABLE IF EXISTS files_changed")
+
+    def rebuild(self, collection, batch_size=500):
+        """
+        Repopulate the index from a Chroma collection, streaming it in batches
+        into a staging table that replaces the live rows in a single
+        transaction, so readers never see a partial or empty index.
+        Ids written to the live index meanwhile are logged by triggers and
+        copied over the staged rows before the swap, so no write is lost.
+        Returns the number of records indexed.
+        """
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._drop_staging(conn)
+            self._create_table(conn, "files_rebuild")
+            conn.execute("CREATE TABLE files_changed (id TEXT PRIMARY KEY)")
+            conn.execute("""
+                CREATE TRIGGER files_rebuild_ai AFTER INSERT ON files BEGIN
+                    INSERT OR IGNORE INTO files_changed (id) VALUES (new.id);
+                END
+            """)
+            conn.execute("""
+                CREATE TRIGGER files_rebuild_ad AFTER DELETE ON files BEGIN
+                    INSERT OR IGNORE INTO files_changed (id) VALUES (old.id);
+                END
+            """)
+        try:
+            total = 0
+            offset = 0
+            while True:
+                batch = collection.get(limit=batch_size, offset=offset, include=["metadatas"])
+                ids = batch.get("ids") or []
+                if not ids:
+                    break
+                self.upsert_many(zip(ids, batch.get("metadatas") or [None] * len(ids)), table="files_rebuild")
+                total += len(ids)
+                offset += len(ids)
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                # The live index is newer for every id written since the rebuild began
+                conn.execute("DELETE FROM files_rebuild WHERE id IN (SELECT id FROM files_changed)")
+                conn.execute(
+                    "INSERT INTO files_rebuild SELECT * FROM files WHERE id IN (SELECT id FROM files_changed)"
+                )
+                conn.execute("DROP TRIGGER files_rebuild_ai")
+                conn.execute("DROP TRIGGER files_rebuild_ad")
+                conn.execute("DELETE FROM files")
+                conn.execute("INSERT INTO files SELECT * FROM files_rebuild")
+                self._drop_staging(conn)
+        except Exception:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                self._drop_staging(conn)
+            raise
+        return total
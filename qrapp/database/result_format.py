@@ -0,0 +1,101 @@
+import numpy as np
+
+
+def distance_to_score(distances, space="l2"):
+    """
+    Map distances to "higher is better" scores for the collection's space:
+    1 - d for cosine, -d for inner product and 1 / (1 + d) for (squared) L2.
+    """
+    if space == "cosine":
+        return 1.0 - distances
+    if space == "ip":
+        return -distances
+    return 1.0 / (1.0 + distances)
+
+
+def _unit(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def mmr_order(query_embedding, embeddings, k, mmr_lambda=0.5):
+    """
+    Maximal marginal relevance: greedily pick `k` of `embeddings`, trading
+    cosine similarity to the query (weight `mmr_lambda`) against similarity
+    to the picks so far. Returns the picked row indices, in order.
+    """
+    docs = _unit(np.asarray(embeddings, dtype=np.float32))
+    if len(docs) == 0:
+        return np.array([], dtype=int)
+    query = _unit(np.asarray(query_embedding, dtype=np.float32))
+    relevance = docs @ query
+    similarity = docs @ docs.T
+
+    picked = [int(np.argmax(relevance))]
+    redundancy = similarity[picked[0]].copy()
+    available = np.ones(len(docs), dtype=bool)
+    available[picked[0]] = False
+    for _ in range(1, min(k, len(docs))):
+        scores = np.where(available, mmr_lambda * relevance - (1.0 - mmr_lambda) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        picked.append(best)
+        available[best] = False
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return np.array(picked)
+
+
+def columnar_results(results, index=0, include=("documents", "metadatas", "distances"), max_distance=None,
+                     n_results=None, space="l2", query_embedding=None, mmr_lambda=None):
+    """
+    Turn the `index`-th query of a Chroma query result into columns:
+    {"ids": [...], "distances": array, "scores": array, "documents": [...],
+    "metadatas": [...]}, with only the `include`d columns.
+
+    The threshold cut and the MMR re-ranking (when `mmr_lambda` is set and
+    the results carry embeddings) run on whole arrays.
+    """
+    ids = (results.get("ids") or [[]])[index] if results.get("ids") else []
+    distances = results.get("distances")
+    distances = np.asarray(distances[index], dtype=np.float32) if distances else None
+
+    order = np.arange(len(ids))
+    if max_distance is not None and distances is not None:
+        order = order[distances <= max_distance]
+    embeddings = results.get("embeddings")
+    if mmr_lambda is not None and embeddings is not None and query_embedding is not None and len(order):
+        candidates = np.asarray(embeddings[index], dtype=np.float32)[order]
+        order = order[mmr_order(query_embedding, candidates, n_results or len(order), mmr_lambda)]
+    elif n_results is not None:
+        order = order[:n_results]
+
+    columns = {"ids": [ids[i] for i in order]}
+    if "distances" in include:
+        columns["distances"] = distances[order] if distances is not None else None
+        columns["scores"] = distance_to_score(distances[order], space) if distances is not None else None
+    for field in ("documents", "metadatas"):
+        if field in include:
+            values = results.get(field)
+            columns[field] = [values[index][i] for i in order] if values else None
+    return columns
+
+
+def result_rows(columns):
+    """
+    The row-per-match shape the API has always returned:
+    [{"id", "document", "metadata", "distance"}, ...] (fields as included).
+    """
+    ids = columns["ids"]
+    fields = []
+    if "documents" in columns:
+        fields.append(("document", columns["documents"] or [""] * len(ids)))
+    if "metadatas" in columns:
+        fields.append(("metadata", columns["metadatas"] or [{}] * len(ids)))
+    if "distances" in columns:
+        distances = columns["distances"]
+        fields.append(("distance", distances.tolist() if distances is not None else [None] * len(ids)))
+    names = [name for name, _ in fields]
+    return [
+        dict(zip(["id", *names], values))
+        for values in zip(ids, *(column for _, column in fields))
+    ]
@@ -0,0 +1,277 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class TokenStore:
+    """
+    Base interface for QR access tokens.
+
+    A token maps to a file id, optionally expires at a unix timestamp and can
+    be limited to a number of uses. Implementations must be safe to share
+    between threads.
+    """
+
+    def create(self, file_id, ttl=None, max_uses=None):
+        """
+        Mint a new token for `file_id` and return it.
+        """
+        raise NotImplementedError
+
+    def create_many(self, file_ids, ttl=None, max_uses=None):
+        """
+        Mint one token per file id and return them in the same order.
+        """
+        return [self.create(file_id, ttl=ttl, max_uses=max_uses) for file_id in file_ids]
+
+    def resolve(self, token):
+        """
+        Return the file id for a valid token (consuming one use), or None.
+        """
+        raise NotImplementedError
+
+    def find_active(self, file_id, min_remaining=0):
+        """
+        Return (token, expires_at) for an unlimited-use token of `file_id` that
+        is still valid for at least `min_remaining` seconds, or None.
+        """
+        raise NotImplementedError
+
+    def evict_expired(self):
+        """
+        Remove expired and exhausted tokens. Returns the number removed.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _expiry(ttl):
+        return time.time() + ttl if ttl else None
+
+
+class MemoryTokenStore(TokenStore):
+    """
+    Process-local token store. Only suitable for a single worker (tests, dev server).
+    """
+
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def create(self, file_id, ttl=None, max_uses=None):
+        token = str(uuid.uuid4())
+        with self._lock:
+            self._tokens[token] = [file_id, self._expiry(ttl), max_uses, 0]
+        return token
+
+    def resolve(self, token):
+        with self._lock:
+            entry = self._tokens.get(token)
+            if entry is None:
+                return None
+            file_id, expires_at, max_uses, uses = entry
+            if (expires_at is not None and expires_at <= time.time()) or \
+                    (max_uses is not None and uses >= max_uses):
+                del self._tokens[token]
+                return None
+            entry[3] += 1
+            return file_id
+
+    def find_active(self, file_id, min_remaining=0):
+        deadline = time.time() + min_remaining
+        with self._lock:
+            best = None
+            for token, (entry_file_id, expires_at, max_uses, _) in self._tokens.items():
+                if entry_file_id != file_id or max_uses is not None:
+                    continue
+                if expires_at is None:
+                    return token, None
+                if expires_at > deadline and (best is None or expires_at > best[1]):
+                    best = (token, expires_at)
+            return best
+
+    def evict_expired(self):
+        now = time.time()
+        with self._lock:
+            stale = [
+                token for token, (_, expires_at, max_uses, uses) in self._tokens.items()
+                if (expires_at is not None and expires_at <= now) or
+                   (max_uses is not None and uses >= max_uses)
+            ]
+            for token in stale:
+                del self._tokens[token]
+        return len(stale)
+
+
+class SQLiteTokenStore(TokenStore):
+    """
+    Token store backed by a SQLite file in WAL mode, shared by every gunicorn
+    worker and persistent across restarts.
+
+    Unlimited-use tokens are also kept in a small in-memory LRU so repeated
+    scans of the same code resolve without touching SQLite. Tokens with a use
+    limit always go through the database so the count is exact across workers.
+    """
+
+    def __init__(self, db_path, cache_size=1024, evict_interval=300):
+        self.db_path = os.path.abspath(db_path)
+        self.cache_size = cache_size
+        self.evict_interval = evict_interval
+        self._local = threading.local()
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._last_eviction = 0.0
+        self._init_schema()
+
+    def _connect(self):
+        # One connection per thread and per process (connections must not cross a fork)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_schema(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = self._connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS qr_tokens (
+                token TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                expires_at REAL,
+                max_uses INTEGER,
+                uses INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_qr_tokens_expires_at ON qr_tokens (expires_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_qr_tokens_file_id ON qr_tokens (file_id)")
+
+    def _cache_get(self, token):
+        with self._cache_lock:
+            entry = self._cache.get(token)
+            if entry is None:
+                return None
+            file_id, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._cache[token]
+                return None
+            self._cache.move_to_end(token)
+            return file_id
+
+    def _cache_put(self, token, file_id, expires_at):
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[token] = (file_id, expires_at)
+            self._cache.move_to_end(token)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _maybe_evict(self):
+        now = time.time()
+        if now - self._last_eviction >= self.evict_interval:
+            self._last_eviction = now
+            try:
+                self.evict_expired()
+            except sqlite3.OperationalError as e:
+                print(f"[WARN] Token eviction skipped: {e}")
+
+    def create(self, file_id, ttl=None, max_uses=None):
+        self._maybe_evict()
+        token = str(uuid.uuid4())
+        expires_at = self._expiry(ttl)
+        self._connect().execute(
+            "INSERT INTO qr_tokens (token, file_id, created_at, expires_at, max_uses) VALUES (?, ?, ?, ?, ?)",
+            (token, file_id, time.time(), expires_at, max_uses)
+        )
+        if max_uses is None:
+            self._cache_put(token, file_id, expires_at)
+        return token
+
+    def create_many(self, file_ids, ttl=None, max_uses=None):
+        self._maybe_evict()
+        now = time.time()
+        expires_at = self._expiry(ttl)
+        rows = [(str(uuid.uuid4()), file_id, now, expires_at, max_uses) for file_id in file_ids]
+        conn = self._connect()
+        # Single transaction instead of one commit per token
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT INTO qr_tokens (token, file_id, created_at, expires_at, max_uses) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+        if max_uses is None:
+            for token, file_id, _, _, _ in rows:
+                self._cache_put(token, file_id, expires_at)
+        return [row[0] for row in rows]
+
+    def resolve(self, token):
+        file_id = self._cache_get(token)
+        if file_id is not None:
+            return file_id
+
+        now = time.time()
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT file_id, expires_at, max_uses FROM qr_tokens "
+            "WHERE token = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (token, now)
+        ).fetchone()
+        if row is None:
+            return None
+
+        file_id, expires_at, max_uses = row
+        if max_uses is None:
+            self._cache_put(token, file_id, expires_at)
+            return file_id
+
+        # Atomic use-count increment so concurrent workers can't overspend a token
+        cursor = conn.execute(
+            "UPDATE qr_tokens SET uses = uses + 1 WHERE token = ? AND uses < max_uses",
+            (token,)
+        )
+        return file_id if cursor.rowcount == 1 else None
+
+    def find_active(self, file_id, min_remaining=0):
+        row = self._connect().execute(
+            "SELECT token, expires_at FROM qr_tokens "
+            "WHERE file_id = ? AND max_uses IS NULL AND (expires_at IS NULL OR expires_at > ?) "
+            "ORDER BY expires_at IS NULL DESC, expires_at DESC LIMIT 1",
+            (file_id, time.time() + min_remaining)
+        ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def evict_expired(self):
+        cursor = self._connect().execute(
+            "DELETE FROM qr_tokens WHERE (expires_at IS NOT NULL AND expires_at <= ?) "
+            "OR (max_uses IS NOT NULL AND uses >= max_uses)",
+            (time.time(),)
+        )
+        now = time.time()
+        with self._cache_lock:
+            for token in [t for t, (_, exp) in self._cache.items() if exp is not None and exp <= now]:
+                del self._cache[token]
+        return cursor.rowcount
+
+
+def create_token_store(config):
+    """
+    Build the token store selected by `TOKEN_STORE` in the Flask config.
+    """
+    backend = config.get("TOKEN_STORE", "sqlite")
+    if backend == "memory":
+        return MemoryTokenStore()
+    if backend == "sqlite":
+        return SQLiteTokenStore(
+            config["TOKEN_DB_PATH"],
+            cache_size=config.get("TOKEN_CACHE_SIZE", 1024),
+            evict_interval=config.get("TOKEN_EVICT_INTERVAL", 300)
+        )
+    raise ValueError(f"Unknown token store backend: {backend}")
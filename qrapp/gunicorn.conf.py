@@ -0,0 +1,12 @@
+# Loaded by gunicorn from the working directory (see the Dockerfile's CMD)
+from config import Config
+from services.metrics import Metrics
+
+
+def on_starting(server):
+    # Runs once in the master, with or without --preload: drop the metric
+    # snapshots of the previous run's workers. Clearing them at import time
+    # instead would make every worker booting without --preload delete the
+    # snapshots of the workers that started before it.
+    if Config.METRICS_ENABLED:
+        Metrics(Config.METRICS_DIR).clear_snapshots()
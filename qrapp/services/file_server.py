@@ -0,0 +1,90 @@
+import mimetypes
+import os
+
+from flask import current_app, make_response, request, send_file
+
+from services.metrics import metrics
+
+
+def resolve_stored_path(metadata):
+    """
+    Absolute path of a stored file from its metadata, or None if it has no path.
+    """
+    if not metadata or not metadata.get("path"):
+        return None
+    return os.path.join(os.getcwd(), metadata["path"])
+
+
+def _strong_etag(metadata, stat):
+    # The indexed sha256 is only trusted while size and mtime still match the file on disk
+    if metadata.get("sha256") and metadata.get("size") == stat.st_size \
+            and metadata.get("mtime") == stat.st_mtime:
+        return metadata["sha256"]
+    return None
+
+
+@metrics.span("file.serve")
+def serve_stored_file(metadata, as_attachment=False):
+    """
+    Send a stored upload with conditional GET (ETag / Last-Modified -> 304)
+    and byte-range (206) support.
+
+    With FILE_SERVE_MODE = "x-sendfile" or "x-accel", only headers are sent and
+    the front proxy streams the bytes, so the worker is released immediately.
+    Returns a (body, status) tuple when the file can't be served.
+    """
+    full_path = resolve_stored_path(metadata)
+    if full_path is None:
+        return "File not found", 404
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        return "File not found on disk", 404
+
+    config = current_app.config
+    mode = config.get("FILE_SERVE_MODE", "flask")
+    etag = _strong_etag(metadata, stat)
+    max_age = config.get("FILE_CACHE_MAX_AGE", 0)
+    download_name = metadata.get("filename") or os.path.basename(full_path)
+
+    if mode == "x-accel":
+        return _accel_redirect(full_path, stat, etag, max_age, download_name, as_attachment)
+
+    # In "x-sendfile" mode Config sets USE_X_SENDFILE and Flask emits the header itself
+    response = send_file(
+        full_path,
+        as_attachment=as_attachment,
+        download_name=download_name,
+        conditional=True,
+        etag=etag if etag else True,
+        last_modified=stat.st_mtime,
+        max_age=max_age
+    )
+    response.headers["Accept-Ranges"] = "bytes"
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+
+def _accel_redirect(full_path, stat, etag, max_age, download_name, as_attachment):
+    config = current_app.config
+    upload_folder = os.path.abspath(config["UPLOAD_FOLDER"])
+    relative = os.path.relpath(full_path, upload_folder)
+    if relative.startswith(os.pardir):
+        return "File not found", 404
+
+    etag = etag or f"{stat.st_mtime}-{stat.st_size}"
+    response = make_response("")
+    response.set_etag(etag)
+    response.last_modified = stat.st_mtime
+    response.cache_control.max_age = max_age
+    response.cache_control.private = True
+    if request.if_none_match.contains(etag):
+        response.status_code = 304
+        return response
+
+    response.headers["X-Accel-Redirect"] = config.get("X_ACCEL_PREFIX", "/protected_uploads/") + relative
+    response.mimetype = mimetypes.guess_type(download_name)[0] or "application/octet-stream"
+    if as_attachment:
+        response.headers.set("Content-Disposition", "attachment", filename=download_name)
+    return response
@@ -0,0 +1,134 @@
+import multiprocessing
+import os
+import time
+
+from database.job_queue import DEAD
+from services.pdf_ingest import iter_pdf_pages
+
+PRUNE_INTERVAL = 3600  # seconds
+
+
+def _renewing(pages, job_queue, job):
+    # Renew the lease every third of its length while a long PDF is rasterized and embedded
+    interval = job_queue.lease_seconds / 3
+    renew_at = time.monotonic() + interval
+    for page in pages:
+        if time.monotonic() >= renew_at:
+            job_queue.renew([job])
+            renew_at = time.monotonic() + interval
+        yield page
+
+
+def _process_pdf(job_queue, chroma_db, job, batch_size, pdf_options):
+    payload = job["payload"]
+    # The jobs before this one may have used up most of the batch's lease
+    if not job_queue.renew([job]):
+        print(f"[WARN] Lease of job {job['id']} expired and it was claimed again; skipping")
+        return
+    try:
+        doc_id = chroma_db.add_pdf(
+            payload["path"],
+            _renewing(iter_pdf_pages(payload["path"], **(pdf_options or {})), job_queue, job),
+            description=payload.get("description", ""),
+            metadata=payload.get("metadata") or {},
+            batch_size=batch_size
+        )
+    except Exception as e:
+        if job_queue.fail(job, str(e)) == DEAD:
+            print(f"[ERROR] Job {job['id']} moved to dead letter: {e}")
+        return
+    if not job_queue.complete(job, {"document_id": doc_id}):
+        print(f"[WARN] Lease of job {job['id']} expired before it finished; another worker owns it now")
+
+
+def process_batch(job_queue, chroma_db, batch_size=32, on_stored=None, pdf_options=None):
+    """
+    Claim up to `batch_size` queued jobs and ingest them: images with one
+    `add_images_bulk` call, PDFs one document at a time. Leases are renewed
+    before each PDF (and during it) and before the images, so a slow batch
+    is never claimed again by another worker. Returns the number of jobs
+    handled.
+    """
+    jobs = job_queue.claim(limit=batch_size)
+    if not jobs:
+        return 0
+
+    image_jobs = []
+    for job in jobs:
+        if job["kind"] == "image":
+            image_jobs.append(job)
+        elif job["kind"] == "pdf":
+            _process_pdf(job_queue, chroma_db, job, batch_size, pdf_options)
+        else:
+            job_queue.fail(job, f"Unknown job kind: {job['kind']}", retry=False)
+
+    if image_jobs:
+        held = set(job_queue.renew(image_jobs))
+        image_jobs = [job for job in image_jobs if job["id"] in held]
+    results = chroma_db.add_images_bulk([job["payload"] for job in image_jobs], batch_size=batch_size)
+    for job, result in zip(image_jobs, results):
+        if "id" in result:
+            if not job_queue.complete(job, {"image_id": result["id"]}):
+                print(f"[WARN] Lease of job {job['id']} expired before it finished; another worker owns it now")
+            if on_stored is not None:
+                try:
+                    on_stored(result["id"])
+                except Exception as e:
+                    print(f"[WARN] Post-ingest hook failed for {result['id']}: {e}")
+        else:
+            # A corrupt image will not get better on retry
+            status = job_queue.fail(job, result.get("error", "Unknown error"), retry=not result.get("invalid"))
+            if status == DEAD:
+                print(f"[ERROR] Job {job['id']} moved to dead letter: {result.get('error')}")
+    return len(jobs)
+
+
+def run_worker(job_queue, chroma_db, batch_size=32, poll_interval=1.0, on_stored=None, pdf_options=None):
+    """
+    Process jobs forever, sleeping `poll_interval` seconds when the queue is
+    empty. Idle workers prune old done jobs, at most every PRUNE_INTERVAL.
+    """
+    print(f"Ingest worker {os.getpid()} started")
+    prune_at = 0
+    while True:
+        try:
+            handled = process_batch(job_queue, chroma_db, batch_size, on_stored, pdf_options)
+        except Exception as e:
+            print(f"[ERROR] Ingest worker {os.getpid()}: {e}")
+            handled = 0
+        if not handled:
+            if time.monotonic() >= prune_at:
+                prune_at = time.monotonic() + PRUNE_INTERVAL
+                try:
+                    job_queue.prune()
+                except Exception as e:
+                    print(f"[WARN] Could not prune done jobs: {e}")
+            time.sleep(poll_interval)
+
+
+def run_workers(processes, job_queue, chroma_db, batch_size=32, poll_interval=1.0, on_stored=None,
+                pdf_options=None):
+    """
+    Run `processes` worker processes and wait for them. The model should be
+    loaded before calling this so the workers share it copy-on-write.
+    """
+    if processes <= 1:
+        run_worker(job_queue, chroma_db, batch_size, poll_interval, on_stored, pdf_options)
+        return
+
+    workers = [
+        multiprocessing.Process(
+            target=run_worker,
+            # Not daemonic: joined below, and stopped explicitly on Ctrl-C
+            args=(job_queue, chroma_db, batch_size, poll_interval, on_stored, pdf_options)
+        )
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
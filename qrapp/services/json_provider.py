@@ -0,0 +1,88 @@
+import decimal
+
+import numpy as np
+from flask.json.provider import DefaultJSONProvider
+
+from services.metrics import metrics
+
+try:
+    import orjson
+except ImportError:  # optional: falls back to the standard library encoder
+    orjson = None
+
+
+def _default(o):
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    if isinstance(o, np.generic):
+        return o.item()
+    if isinstance(o, decimal.Decimal):
+        return str(o)
+    if isinstance(o, (set, frozenset)):
+        return list(o)
+    if hasattr(o, "__html__"):
+        return str(o.__html__())
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class NumpyJSONProvider(DefaultJSONProvider):
+    """
+    Flask's encoder plus NumPy arrays and scalars (columnar search results).
+    """
+
+    @staticmethod
+    def default(o):
+        try:
+            return _default(o)
+        except TypeError:
+            return DefaultJSONProvider.default(o)
+
+    def response(self, *args, **kwargs):
+        with metrics.span("json.serialize"):
+            return super().response(*args, **kwargs)
+
+
+class OrjsonProvider(NumpyJSONProvider):
+    """
+    orjson-backed `jsonify`: serializes NumPy arrays natively and writes the
+    response body as bytes, without an intermediate str.
+
+    Keys keep their insertion order unless `sort_keys` is set (per call or on
+    the provider). `indent=2` maps to OPT_INDENT_2; other formatting arguments
+    orjson has no equivalent for fall back to the standard library encoder.
+    """
+
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS if orjson else 0
+    sort_keys = False
+
+    def _option(self, sort_keys, indent):
+        option = self.option
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs):
+        sort_keys = kwargs.pop("sort_keys", self.sort_keys)
+        indent = kwargs.pop("indent", None)
+        if kwargs or indent not in (None, 0, 2):
+            return super().dumps(obj, sort_keys=sort_keys, indent=indent, **kwargs)
+        return orjson.dumps(obj, default=_default, option=self._option(sort_keys, indent)).decode()
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        # Same pretty-printing rule as Flask's provider: indented in debug mode unless compact
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        with metrics.span("json.serialize"):
+            body = orjson.dumps(obj, default=_default, option=self._option(self.sort_keys, indent))
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def create_json_provider(app):
+    return OrjsonProvider(app) if orjson is not None else NumpyJSONProvider(app)
@@ -0,0 +1,290 @@
+import atexit
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import ContextDecorator
+
+# Histogram bounds in seconds, from 1 ms to 30 s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+STAGE_METRIC = "qrapp_stage_seconds"
+
+_local = threading.local()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + (list(extra.items()) if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in items) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Span(ContextDecorator):
+    def __init__(self, registry, stage):
+        self.registry = registry
+        self.stage = stage
+
+    def _recreate_cm(self):
+        # A fresh timer per decorated call, so the decorator is thread-safe
+        return _Span(self.registry, self.stage)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.registry.observe(STAGE_METRIC, elapsed, stage=self.stage)
+        trace = getattr(_local, "trace", None)
+        if trace is not None:
+            trace.append((self.stage, elapsed))
+        return False
+
+
+class Metrics:
+    """
+    In-process histograms and counters, shared across gunicorn workers through
+    per-process JSON snapshots.
+
+    Each process keeps its own cumulative values and a background thread writes
+    them to <snapshot_dir>/<pid>.json every `flush_interval` seconds. `collect`
+    sums every snapshot plus the live values of the calling process, so any
+    worker can answer a scrape for all of them. Snapshots of exited workers are
+    kept, which keeps the totals monotonic; the previous run's are cleared by
+    gunicorn's on_starting hook (gunicorn.conf.py).
+    """
+
+    def __init__(self, snapshot_dir=None, flush_interval=5.0, buckets=DEFAULT_BUCKETS, enabled=True):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._collectors = []
+        self._help = {}
+        self._pid = os.getpid()
+        self._dirty = False
+        self._flusher_pid = None
+        self.configure(snapshot_dir, flush_interval, enabled)
+        atexit.register(self._flush_at_exit)
+
+    def configure(self, snapshot_dir=None, flush_interval=5.0, enabled=True):
+        self.snapshot_dir = os.path.abspath(snapshot_dir) if snapshot_dir else None
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        if self.snapshot_dir:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def add_collector(self, collector):
+        """
+        Register a callable returning (name, labels dict, value) counters owned
+        by this process (e.g. cache hit counters); they are snapshotted and
+        summed across workers like the rest.
+        """
+        self._collectors.append(collector)
+
+    def _check_fork(self):
+        # A forked worker starts from zero instead of re-counting the master's values
+        if self._pid != os.getpid():
+            self._histograms = {}
+            self._counters = {}
+            self._pid = os.getpid()
+            self._dirty = False
+        if self.snapshot_dir and self._flusher_pid != self._pid:
+            self._flusher_pid = self._pid
+            threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True).start()
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._check_fork()
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+            self._dirty = True
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_fork()
+            self._counters[key] = self._counters.get(key, 0) + amount
+            self._dirty = True
+
+    def span(self, stage):
+        """
+        Time a stage, as a context manager or a decorator. Recorded in the
+        `qrapp_stage_seconds` histogram and in the current trace, if any.
+        """
+        return _Span(self, stage)
+
+    @staticmethod
+    def begin_trace():
+        """
+        Start collecting the (stage, seconds) spans of this thread.
+        """
+        _local.trace = []
+
+    @staticmethod
+    def end_trace():
+        trace = getattr(_local, "trace", None)
+        _local.trace = None
+        return trace or []
+
+    def snapshot(self):
+        """
+        This process's values as a JSON-serializable dict.
+        """
+        with self._lock:
+            self._check_fork()
+            histograms = [
+                [name, dict(labels), list(entry[0]), entry[1], entry[2]]
+                for (name, labels), entry in self._histograms.items()
+            ]
+            counters = [[name, dict(labels), value] for (name, labels), value in self._counters.items()]
+        for collector in self._collectors:
+            try:
+                counters.extend([name, dict(labels), value] for name, labels, value in collector())
+            except Exception as e:
+                print(f"[WARN] Metrics collector failed: {e}")
+        return {"pid": self._pid, "buckets": list(self.buckets), "histograms": histograms, "counters": counters}
+
+    def flush(self):
+        if not self.snapshot_dir:
+            return
+        self._dirty = False
+        data = json.dumps(self.snapshot())
+        tmp_path = None
+        try:
+            # Write-then-rename so a scrape never reads a partial snapshot
+            fd, tmp_path = tempfile.mkstemp(dir=self.snapshot_dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+            os.replace(tmp_path, os.path.join(self.snapshot_dir, f"{os.getpid()}.json"))
+        except OSError as e:
+            print(f"[WARN] Could not write metrics snapshot: {e}")
+            if tmp_path:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+
+    def _flush_loop(self):
+        pid = os.getpid()
+        while self._flusher_pid == pid:
+            time.sleep(self.flush_interval)
+            if self._dirty or self._collectors:
+                self.flush()
+
+    def _flush_at_exit(self):
+        if self.snapshot_dir and self._flusher_pid == os.getpid() and os.path.isdir(self.snapshot_dir):
+            self.flush()
+
+    def clear_snapshots(self):
+        """
+        Delete every worker snapshot; call once per server start, in the master.
+        """
+        if not self.snapshot_dir:
+            return
+        for name in os.listdir(self.snapshot_dir):
+            if name.endswith(".json"):
+                try:
+                    os.unlink(os.path.join(self.snapshot_dir, name))
+                except OSError:
+                    pass
+
+    def collect(self):
+        """
+        Sum of the live values of this process and the snapshots of all others.
+        """
+        snapshots = [self.snapshot()]
+        if self.snapshot_dir:
+            own = f"{os.getpid()}.json"
+            for name in os.listdir(self.snapshot_dir):
+                if not name.endswith(".json") or name == own:
+                    continue
+                try:
+                    with open(os.path.join(self.snapshot_dir, name)) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+
+        histograms = {}
+        counters = {}
+        for snapshot in snapshots:
+            if tuple(snapshot["buckets"]) != self.buckets:
+                continue
+            for name, labels, counts, total, count in snapshot["histograms"]:
+                key = (name, tuple(sorted(labels.items())))
+                entry = histograms.setdefault(key, [[0] * len(counts), 0.0, 0])
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+                entry[2] += count
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(sorted(labels.items())))
+                counters[key] = counters.get(key, 0) + value
+        return histograms, counters
+
+    def render(self, gauges=(), collected=None):
+        """
+        Prometheus text exposition of the collected histograms and counters
+        (`collected`, as returned by `collect`, or collected now), plus
+        `gauges`: (name, labels dict, value) read at scrape time.
+        """
+        histograms, counters = collected or self.collect()
+        lines = []
+
+        def header(name, kind):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        seen = None
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            if name != seen:
+                header(name, "histogram")
+                seen = name
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(labels, {'le': _format_value(bound)})} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+        for (name, labels), value in sorted(counters.items()):
+            if name != seen:
+                header(name, "counter")
+                seen = name
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        for name, labels, value in sorted(gauges, key=lambda gauge: gauge[0]):
+            if name != seen:
+                header(name, "gauge")
+                seen = name
+            lines.append(f"{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# Configured by the app; spans are recorded from any module through this instance
+metrics = Metrics()
@@ -0,0 +1,52 @@
+import numpy as np
+from pdf2image import convert_from_path
+from PyPDF2 import PdfReader
+
+# Cap on stored page text; CLIP only reads the first 77 tokens anyway
+MAX_PAGE_TEXT = 4000
+
+
+def is_pdf(path):
+    with open(path, "rb") as f:
+        return f.read(5) == b"%PDF-"
+
+
+def render_pages(pdf_path, first_page, last_page, dpi=100, max_px=1024, workers=1):
+    """
+    Rasterize pages `first_page`..`last_page` (1-based, inclusive) to RGB
+    arrays. The range is split across `workers` pdftoppm processes, each
+    parsing the PDF once, so no Python process is forked. `max_px` bounds the
+    longest edge regardless of the sheet size, which keeps large plan sheets small.
+    """
+    images = convert_from_path(
+        pdf_path, dpi=dpi, first_page=first_page, last_page=last_page, size=max_px,
+        thread_count=max(1, workers)
+    )
+    return [np.array(image.convert("RGB")) for image in images]
+
+
+def _page_text(reader, pdf_path, page_number):
+    try:
+        text = reader.pages[page_number - 1].extract_text() or ""
+    except Exception as e:
+        print(f"[WARN] Could not extract text from page {page_number} of {pdf_path}: {e}")
+        text = ""
+    return " ".join(text.split())[:MAX_PAGE_TEXT]
+
+
+def iter_pdf_pages(pdf_path, dpi=100, max_px=1024, workers=1, window=8):
+    """
+    Yield (page_number, RGB array, text) for every page, in order.
+
+    Pages are rasterized `window` at a time, so at most `window` rasters are
+    alive at once whatever the page count. The document is parsed once for
+    its text, not once per page.
+    """
+    reader = PdfReader(pdf_path)
+    total = len(reader.pages)
+    for start in range(1, total + 1, window):
+        last = min(start + window - 1, total)
+        images = render_pages(pdf_path, start, last, dpi, max_px, workers)
+        for offset, page_number in enumerate(range(start, last + 1)):
+            image = images[offset] if offset < len(images) else None
+            yield page_number, image, _page_text(reader, pdf_path, page_number)
@@ -0,0 +1,106 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SlowRequestProfiler:
+    """
+    Sampling profiler for slow requests.
+
+    One background thread per process samples the stacks of the threads
+    between `start` and `stop` every `interval` seconds. When a request turns
+    out slower than `threshold` seconds its samples are written to `out_dir`
+    in collapsed-stack format (one "frame;frame;frame count" line per stack,
+    readable by flamegraph.pl and speedscope); the samples of faster requests
+    are dropped. Only the newest `max_files` profiles are kept.
+    """
+
+    def __init__(self, out_dir, threshold=1.0, interval=0.01, max_files=200):
+        self.out_dir = os.path.abspath(out_dir)
+        self.threshold = threshold
+        self.interval = interval
+        self.max_files = max_files
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._sampler_pid = None
+        os.makedirs(self.out_dir, exist_ok=True)
+
+    def _ensure_sampler(self):
+        # Threads don't survive a fork: one sampler per process
+        if self._sampler_pid != os.getpid():
+            self._sampler_pid = os.getpid()
+            threading.Thread(target=self._run, name="slow-request-profiler", daemon=True).start()
+
+    def start(self):
+        with self._lock:
+            self._ensure_sampler()
+            self._active[threading.get_ident()] = Counter()
+        self._wakeup.set()
+
+    def stop(self, elapsed, label):
+        """
+        Stop sampling the current thread; returns the profile path if the
+        request was slow enough to keep, else None.
+        """
+        with self._lock:
+            samples = self._active.pop(threading.get_ident(), None)
+        if not samples or elapsed < self.threshold:
+            return None
+
+        name = re.sub(r"[^A-Za-z0-9_.-]+", "_", label or "request")
+        path = os.path.join(
+            self.out_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{name}-{int(elapsed * 1000)}ms.folded"
+        )
+        try:
+            with open(path, "w") as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            self._prune()
+        except OSError as e:
+            print(f"[WARN] Could not write profile: {e}")
+            return None
+        return path
+
+    def _prune(self):
+        profiles = sorted(
+            (entry for entry in os.scandir(self.out_dir) if entry.name.endswith(".folded")),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in profiles[:max(0, len(profiles) - self.max_files)]:
+            try:
+                os.unlink(entry.path)
+            except OSError:
+                pass
+
+    def _run(self):
+        own = threading.get_ident()
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._wakeup.clear()
+                    idle = True
+                else:
+                    idle = False
+                    frames = sys._current_frames()
+                    for ident, samples in self._active.items():
+                        frame = frames.get(ident)
+                        if frame is not None and ident != own:
+                            samples[_collapse(frame)] += 1
+                    del frames
+            if idle:
+                self._wakeup.wait()
+            else:
+                time.sleep(self.interval)
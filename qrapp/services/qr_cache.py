@@ -0,0 +1,179 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import qrcode
+import qrcode.image.svg
+
+from services.metrics import metrics
+
+ERROR_CORRECTION_LEVELS = {
+    "L": qrcode.constants.ERROR_CORRECT_L,
+    "M": qrcode.constants.ERROR_CORRECT_M,
+    "Q": qrcode.constants.ERROR_CORRECT_Q,
+    "H": qrcode.constants.ERROR_CORRECT_H,
+}
+
+# Prefix of files still being written; they are neither counted nor evicted
+TMP_PREFIX = ".tmp-"
+
+MIMETYPES = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+}
+
+
+def render_qr(data, box_size=10, error_correction="M", fmt="png"):
+    """
+    Render `data` as a QR code and return the encoded image bytes.
+    """
+    qr = qrcode.QRCode(
+        error_correction=ERROR_CORRECTION_LEVELS[error_correction],
+        box_size=box_size,
+        border=4
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+
+    img_io = BytesIO()
+    if fmt == "svg":
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(img_io)
+    else:
+        qr.make_image().save(img_io, "PNG")
+    return img_io.getvalue()
+
+
+class QRCache:
+    """
+    Two-tier cache of rendered QR images keyed by (data, box size, error
+    correction, format): a bounded in-memory LRU, optionally backed by a
+    content-addressed directory on disk that survives restarts and is shared
+    between workers. Disk hits touch the file's mtime; when the directory grows
+    past `disk_quota_bytes` the least recently used files are deleted.
+    """
+
+    def __init__(self, max_items=512, disk_dir=None, disk_quota_bytes=256 * 1024 * 1024):
+        self.max_items = max_items
+        self.disk_dir = os.path.abspath(disk_dir) if disk_dir else None
+        self.disk_quota_bytes = disk_quota_bytes
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_usage = None
+        self.hits = 0
+        self.misses = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(data, box_size, error_correction, fmt):
+        raw = f"{data}|{box_size}|{error_correction}|{fmt}".encode("utf-8")
+        return hashlib.sha256(raw).hexdigest()
+
+    def _disk_path(self, key, fmt):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.{fmt}")
+
+    def _remember(self, key, content):
+        with self._lock:
+            self._items[key] = content
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def get(self, key, fmt):
+        with self._lock:
+            content = self._items.get(key)
+            if content is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return content
+
+        if self.disk_dir:
+            path = self._disk_path(key, fmt)
+            try:
+                with open(path, "rb") as f:
+                    content = f.read()
+                os.utime(path)
+            except OSError:
+                content = None
+            if content is not None:
+                self._remember(key, content)
+                with self._lock:
+                    self.hits += 1
+                return content
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, fmt, content):
+        if self.max_items > 0:
+            self._remember(key, content)
+        if self.disk_dir:
+            path = self._disk_path(key, fmt)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write-then-rename so other workers never read a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=TMP_PREFIX)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(content)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"[WARN] Could not write QR cache file: {e}")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                return
+            self._account(len(content))
+
+    def _scan(self):
+        entries = []
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                if name.startswith(TMP_PREFIX):
+                    continue
+                full_path = os.path.join(root, name)
+                try:
+                    stat = os.stat(full_path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, full_path))
+        return entries
+
+    def _account(self, added_bytes):
+        with self._lock:
+            if self._disk_usage is None:
+                self._disk_usage = sum(size for _, size, _ in self._scan())
+            else:
+                self._disk_usage += added_bytes
+            if self._disk_usage > self.disk_quota_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Rescan: other workers write to the same directory
+        entries = sorted(self._scan())
+        usage = sum(size for _, size, _ in entries)
+        target = self.disk_quota_bytes * 0.9
+        for _, size, full_path in entries:
+            if usage <= target:
+                break
+            try:
+                os.remove(full_path)
+                usage -= size
+            except OSError:
+                pass
+        self._disk_usage = usage
+
+    def get_or_render(self, data, box_size=10, error_correction="M", fmt="png"):
+        """
+        Return (key, image bytes), rendering and caching on a miss. The key is
+        a stable content hash suitable for use as an ETag.
+        """
+        key = self.make_key(data, box_size, error_correction, fmt)
+        content = self.get(key, fmt)
+        if content is None:
+            with metrics.span("qr.render"):
+                content = render_qr(data, box_size, error_correction, fmt)
+            self.put(key, fmt, content)
+        return key, content
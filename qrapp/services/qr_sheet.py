@@ -0,0 +1,119 @@
+import zlib
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFont
+
+from services.qr_cache import render_qr
+
+
+def render_many(urls, qr_cache, box_size=10, error_correction="M"):
+    """
+    Render PNG QR codes for every url, serving hits from `qr_cache` and
+    rendering the misses in this process. Returns bytes in input order.
+
+    Rendering stays in-process: forking a process pool from a web worker that
+    already runs torch/chroma threads can copy a held lock into the child.
+    """
+    contents = [None] * len(urls)
+    for i, url in enumerate(urls):
+        key = qr_cache.make_key(url, box_size, error_correction, "png")
+        contents[i] = qr_cache.get(key, "png")
+        if contents[i] is None:
+            contents[i] = render_qr(url, box_size, error_correction, "png")
+            qr_cache.put(key, "png", contents[i])
+    return contents
+
+
+def _fit_caption(draw, text, font, max_width):
+    if draw.textlength(text, font=font) <= max_width:
+        return text
+    while text and draw.textlength(text + "...", font=font) > max_width:
+        text = text[:-1]
+    return text + "..."
+
+
+def _pages(entries, per_page, columns, rows, cell_size, caption_height):
+    font = ImageFont.load_default()
+    for start in range(0, max(1, len(entries)), per_page):
+        chunk = entries[start:start + per_page]
+        page_rows = rows or -(-len(chunk) // columns)
+        page = Image.new("L", (columns * cell_size, max(1, page_rows) * (cell_size + caption_height)), "white")
+        draw = ImageDraw.Draw(page)
+
+        for n, (caption, content) in enumerate(chunk):
+            x = (n % columns) * cell_size
+            y = (n // columns) * (cell_size + caption_height)
+            with Image.open(BytesIO(content)) as qr_img:
+                qr_img = qr_img.convert("L").resize((cell_size, cell_size), Image.NEAREST)
+                page.paste(qr_img, (x, y))
+            text = _fit_caption(draw, caption, font, cell_size - 10)
+            text_width = draw.textlength(text, font=font)
+            draw.text((x + (cell_size - text_width) / 2, y + cell_size + 5), text, fill="black", font=font)
+        yield page
+
+
+def _pdf_stream(pages, page_count, dpi):
+    """
+    Write bilevel pages as a PDF, yielding each page's bytes as soon as it is
+    encoded. The page tree is known up front (objects 3k+3..3k+5 for page k),
+    so nothing is buffered but the current page and the xref offsets.
+    """
+    offsets = []
+    written = 0
+
+    def obj(number, body, stream=None):
+        nonlocal written
+        offsets.append(written)
+        chunk = b"%d 0 obj\n" % number + body
+        if stream is not None:
+            chunk += b"\nstream\n" + stream + b"\nendstream"
+        chunk += b"\nendobj\n"
+        written += len(chunk)
+        return chunk
+
+    header = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+    written = len(header)
+    kids = b" ".join(b"%d 0 R" % (3 + 3 * k) for k in range(page_count))
+    yield header + obj(1, b"<< /Type /Catalog /Pages 2 0 R >>") \
+        + obj(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, page_count))
+
+    for k, page in enumerate(pages):
+        page_obj, image_obj, contents_obj = 3 + 3 * k, 4 + 3 * k, 5 + 3 * k
+        width, height = page.size
+        points = (width * 72.0 / dpi, height * 72.0 / dpi)
+        # Mode "1" packs 8 pixels per byte with 1 = white, as DeviceGray expects
+        data = zlib.compress(page.convert("1", dither=Image.Dither.NONE).tobytes())
+        contents = b"q %.2f 0 0 %.2f 0 0 cm /Im0 Do Q" % points
+        yield obj(page_obj, b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] "
+                            b"/Resources << /XObject << /Im0 %d 0 R >> /ProcSet [/PDF /ImageB] >> "
+                            b"/Contents %d 0 R >>" % (*points, image_obj, contents_obj)) \
+            + obj(image_obj, b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceGray "
+                             b"/BitsPerComponent 1 /Filter /FlateDecode /Length %d >>" % (width, height, len(data)),
+                  data) \
+            + obj(contents_obj, b"<< /Length %d >>" % len(contents), contents)
+
+    xref = [b"xref\n0 %d\n0000000000 65535 f \n" % (len(offsets) + 1)]
+    xref += [b"%010d 00000 n \n" % offset for offset in offsets]
+    yield b"".join(xref) + b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(offsets) + 1, written)
+
+
+def build_sheet(entries, fmt="pdf", columns=4, rows=5, cell_size=300, caption_height=40, dpi=150):
+    """
+    Tile (caption, png bytes) entries into a sheet, returned as an iterator of
+    bytes chunks.
+
+    `fmt="pdf"` yields a multi-page PDF with `columns * rows` codes per page,
+    one page at a time, so only the page being drawn is held in memory;
+    `fmt="png"` yields a single tall PNG with every code.
+    """
+    if fmt == "pdf":
+        per_page = columns * rows
+        page_count = max(1, -(-len(entries) // per_page))
+        pages = _pages(entries, per_page, columns, rows, cell_size, caption_height)
+        return _pdf_stream(pages, page_count, dpi)
+
+    page = next(_pages(entries, max(1, len(entries)), columns, None, cell_size, caption_height))
+    output = BytesIO()
+    page.save(output, "PNG", optimize=False)
+    return iter([output.getvalue()])
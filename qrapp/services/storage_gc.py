@@ -0,0 +1,178 @@
+import os
+import tempfile
+import time
+
+
+def _batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _iter_files(root):
+    # os.walk lists one directory at a time, so memory doesn't grow with the tree
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+        for name in filenames:
+            if not name.startswith("."):
+                yield os.path.join(dirpath, name)
+
+
+class GarbageCollectionRefused(RuntimeError):
+    """
+    Raised instead of deleting anything when the store doesn't look like the
+    one the uploads belong to: an empty collection, or most records or files
+    orphaned (typically a wrong working directory or CHROMA_DB_DIR).
+    """
+
+
+def find_dangling_records(chroma_db, batch_size=500, base_dir=None):
+    """
+    Page through the collection and yield (id, path) for every record whose
+    stored file no longer exists. Relative paths are resolved against
+    `base_dir` (default: the working directory). Records without a path
+    (text documents) are never dangling.
+    """
+    base_dir = base_dir or os.getcwd()
+    offset = 0
+    while True:
+        batch = chroma_db.collection.get(limit=batch_size, offset=offset, include=["metadatas"])
+        ids = batch.get("ids") or []
+        if not ids:
+            break
+        exists = {}
+        for record_id, metadata in zip(ids, batch.get("metadatas") or [None] * len(ids)):
+            path = (metadata or {}).get("path")
+            if not path:
+                continue
+            if path not in exists:
+                exists[path] = os.path.exists(os.path.join(base_dir, path))
+            if not exists[path]:
+                yield record_id, path
+        offset += len(ids)
+
+
+def _scan_files(chroma_db, upload_folder, batch_size, min_age, protected, base_dir):
+    # Yields (absolute path, size, referenced) for every file old enough to be collected
+    protected = {os.path.abspath(path) for path in protected}
+    for batch in _batched(_iter_files(upload_folder), batch_size):
+        cutoff = time.time() - min_age
+        candidates = {}
+        for path in batch:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if stat.st_mtime > cutoff or path in protected:
+                continue
+            candidates[os.path.relpath(path, base_dir)] = (path, stat.st_size)
+        if not candidates:
+            continue
+        # Records store paths relative to the base directory, older ones may be absolute
+        referenced = chroma_db.referenced_paths(
+            list(candidates) + [path for path, _ in candidates.values()], use_index=False
+        )
+        for relative, (path, size) in candidates.items():
+            yield path, size, relative in referenced or path in referenced
+
+
+def find_orphan_files(chroma_db, upload_folder, batch_size=500, min_age=3600, protected=(), base_dir=None):
+    """
+    Walk `upload_folder` and yield (absolute path, size) for every file no
+    record points at, checking `batch_size` files per collection query.
+    Files modified in the last `min_age` seconds (uploads still being indexed)
+    and `protected` paths (files of pending ingestion jobs) are skipped.
+    """
+    upload_folder = os.path.abspath(upload_folder)
+    for path, size, referenced in _scan_files(chroma_db, upload_folder, batch_size, min_age, protected,
+                                              base_dir or os.getcwd()):
+        if not referenced:
+            yield path, size
+
+
+def _is_referenced(chroma_db, path, base_dir):
+    return bool(chroma_db.referenced_paths([os.path.relpath(path, base_dir), path], use_index=False))
+
+
+def collect_garbage(chroma_db, upload_folder, base_dir=None, dry_run=True, batch_size=500, min_age=3600,
+                    protected=(), report=None, max_ratio=0.5):
+    """
+    Reconcile the collection with the uploads directory, in bounded memory:
+
+    1. records whose file is gone are deleted (with `delete_files`, so a PDF
+       goes with all its pages);
+    2. files that no record points at are removed.
+
+    Stored paths are resolved against `base_dir` (default: the working
+    directory). Both passes run before anything is deleted; if the collection
+    is empty, or more than `max_ratio` of the records or files are orphans,
+    GarbageCollectionRefused is raised instead (pass max_ratio=None to skip
+    that check). With `dry_run` nothing is changed and the reason is returned
+    in stats["refused"].
+
+    `report(kind, item, detail)` is called for every orphan found:
+    ("record", id, path) or ("file", path, size). Returns the counts found
+    and removed.
+    """
+    base_dir = base_dir or os.getcwd()
+    upload_folder = os.path.abspath(upload_folder)
+    stats = {"records": chroma_db.collection.count(), "dangling_records": 0, "records_deleted": 0,
+             "files": 0, "orphan_files": 0, "orphan_bytes": 0, "files_removed": 0, "refused": None}
+
+    # Deleting while paging would shift the offsets: spool both lists to disk, delete afterwards
+    with tempfile.TemporaryFile("w+") as records, tempfile.TemporaryFile("w+") as files:
+        for record_id, path in find_dangling_records(chroma_db, batch_size, base_dir):
+            stats["dangling_records"] += 1
+            if report:
+                report("record", record_id, path)
+            records.write(record_id + "\n")
+        for path, size, referenced in _scan_files(chroma_db, upload_folder, batch_size, min_age, protected,
+                                                  base_dir):
+            stats["files"] += 1
+            if referenced:
+                continue
+            stats["orphan_files"] += 1
+            stats["orphan_bytes"] += size
+            if report:
+                report("file", path, size)
+            files.write(path + "\n")
+
+        if not stats["records"] and stats["files"]:
+            stats["refused"] = "the collection is empty"
+        elif max_ratio is not None and stats["dangling_records"] > stats["records"] * max_ratio:
+            stats["refused"] = f"{stats['dangling_records']} of {stats['records']} records have no file"
+        elif max_ratio is not None and stats["orphan_files"] > stats["files"] * max_ratio:
+            stats["refused"] = f"{stats['orphan_files']} of {stats['files']} files have no record"
+        if dry_run:
+            return stats
+        if stats["refused"]:
+            raise GarbageCollectionRefused(stats["refused"])
+
+        records.seek(0)
+        for ids in _batched((line.rstrip("\n") for line in records), batch_size):
+            stats["records_deleted"] += chroma_db.delete_files(file_ids=ids, batch_size=batch_size)["deleted"]
+
+        files.seek(0)
+        for line in files:
+            path = line.rstrip("\n")
+            # Re-check right before unlinking: an identical upload may have just reused the file
+            if _is_referenced(chroma_db, path, base_dir):
+                continue
+            try:
+                os.remove(path)
+                stats["files_removed"] += 1
+            except OSError as e:
+                print(f"[WARN] Could not delete {path}: {e}")
+                continue
+            directory = os.path.dirname(path)
+            if directory != upload_folder and os.path.basename(directory) == os.path.basename(path)[:2]:
+                try:
+                    os.rmdir(directory)  # content-addressed shard, if now empty
+                except OSError:
+                    pass
+    return stats
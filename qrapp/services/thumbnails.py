@@ -0,0 +1,130 @@
+import os
+import tempfile
+import threading
+
+from PIL import Image, ImageOps, features
+
+from database.metadata_index import file_fingerprint
+from services.metrics import metrics
+
+MIMETYPES = {
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+}
+
+
+class ThumbnailCache:
+    """
+    Content-addressed cache of downscaled previews.
+
+    Derivatives live at <cache_dir>/<sha[:2]>/<sha>_<size>.<fmt>, so identical
+    uploads share them and they never need invalidating. Each hit touches the
+    file's mtime; when the directory grows past `quota_bytes` the least
+    recently used derivatives are deleted.
+    """
+
+    def __init__(self, cache_dir, sizes, quota_bytes=512 * 1024 * 1024, fmt="webp", quality=80):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.sizes = sizes
+        self.quota_bytes = quota_bytes
+        self.fmt = fmt if fmt != "webp" or features.check("webp") else "jpeg"
+        self.quality = quality
+        self._lock = threading.Lock()
+        self._usage = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @property
+    def mimetype(self):
+        return MIMETYPES[self.fmt]
+
+    def _path(self, sha256, size_name):
+        return os.path.join(self.cache_dir, sha256[:2], f"{sha256}_{size_name}.{self.fmt}")
+
+    def get_or_create(self, source_path, size_name, sha256=None):
+        """
+        Return the path of the `size_name` preview of `source_path`, creating it
+        on first request.
+        """
+        if size_name not in self.sizes:
+            raise KeyError(size_name)
+        if not sha256:
+            sha256 = file_fingerprint(source_path)[2]
+
+        path = self._path(sha256, size_name)
+        try:
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+
+        self._render(source_path, path, self.sizes[size_name])
+        self._account(os.path.getsize(path))
+        return path
+
+    def pregenerate(self, source_path, sha256=None, size_names=None):
+        """
+        Create previews at upload time so the first page view doesn't pay for them.
+        """
+        sha256 = sha256 or file_fingerprint(source_path)[2]
+        for size_name in size_names or self.sizes:
+            try:
+                self.get_or_create(source_path, size_name, sha256)
+            except Exception as e:
+                print(f"[WARN] Could not create {size_name} preview for {source_path}: {e}")
+
+    @metrics.span("thumbnail.render")
+    def _render(self, source_path, path, max_px):
+        with Image.open(source_path) as img:
+            # JPEG draft mode decodes at 1/2, 1/4 or 1/8 scale straight from the DCT
+            img.draft("RGB", (max_px, max_px))
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((max_px, max_px), Image.LANCZOS, reducing_gap=3.0)
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGBA").convert("RGB") if self.fmt == "jpeg" else img.convert("RGBA")
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    img.save(f, self.fmt.upper(), quality=self.quality)
+                os.replace(tmp_path, path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+    def _scan(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                full_path = os.path.join(root, name)
+                try:
+                    stat = os.stat(full_path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, full_path))
+        return entries
+
+    def _account(self, added_bytes):
+        with self._lock:
+            if self._usage is None:
+                self._usage = sum(size for _, size, _ in self._scan())
+            else:
+                self._usage += added_bytes
+            if self._usage > self.quota_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Rescan: other workers write to the same directory
+        entries = sorted(self._scan())
+        usage = sum(size for _, size, _ in entries)
+        target = self.quota_bytes * 0.9
+        for _, size, full_path in entries:
+            if usage <= target:
+                break
+            try:
+                os.remove(full_path)
+                usage -= size
+            except OSError:
+                pass
+        self._usage = usage
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import tempfile
+from io import BytesIO
+
+from PIL import Image
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from services.metrics import metrics
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class UploadRejected(ValueError):
+    """
+    Raised when the first bytes of an upload show it is not an accepted file.
+    """
+
+
+def check_image_header(head):
+    """
+    Validate an image from its first bytes only (PIL parses just the header).
+    """
+    try:
+        with Image.open(BytesIO(head)) as img:
+            return img.format
+    except Exception as e:
+        raise UploadRejected(f"Not a supported image: {e}")
+
+
+def check_pdf_header(head):
+    if not head.startswith(b"%PDF-"):
+        raise UploadRejected("Not a PDF file")
+    return "PDF"
+
+
+def _iter_chunks(file_storage, validate=None):
+    first = True
+    for chunk in iter(lambda: file_storage.stream.read(CHUNK_SIZE), b""):
+        if first and validate is not None:
+            validate(chunk)
+        first = False
+        yield chunk
+    if first and validate is not None:
+        validate(b"")
+
+
+@metrics.span("upload.read")
+def read_upload(file_storage, max_bytes, validate=None):
+    """
+    Read a small upload (a search query image) into memory, without touching
+    the disk, rejecting it as soon as it grows past `max_bytes`.
+    """
+    buffer = BytesIO()
+    for chunk in _iter_chunks(file_storage, validate):
+        if buffer.tell() + len(chunk) > max_bytes:
+            raise RequestEntityTooLarge(f"File exceeds {max_bytes} bytes")
+        buffer.write(chunk)
+    return buffer.getvalue()
+
+
+def content_path(upload_folder, sha256, extension):
+    """
+    Content-addressed location of an upload: <upload_folder>/<sha[:2]>/<sha>.<ext>
+    """
+    name = f"{sha256}.{extension}" if extension else sha256
+    return os.path.join(upload_folder, sha256[:2], name)
+
+
+@metrics.span("upload.store")
+def store_upload(file_storage, upload_folder, extension, validate=None):
+    """
+    Stream an uploaded file to disk in chunks, hashing it on the way, and move
+    it to its content-addressed path. `validate` is called with the first
+    chunk, before anything is written, and may raise UploadRejected.
+
+    Returns (path, sha256, is_new). When identical bytes are already stored the
+    new copy is discarded and `is_new` is False, so the caller must not remove
+    `path` on a later validation failure.
+    """
+    os.makedirs(upload_folder, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=upload_folder, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in _iter_chunks(file_storage, validate):
+                digest.update(chunk)
+                out.write(chunk)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+    sha256 = digest.hexdigest()
+    path = content_path(upload_folder, sha256, extension)
+    if os.path.exists(path):
+        os.remove(tmp_path)
+        return path, sha256, False
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+    return path, sha256, True
+
+
+def stored_file_fields(path, sha256):
+    """
+    The "size", "mtime" and "sha256" metadata of a stored upload, so the
+    metadata index never has to hash it again.
+    """
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256}
+
+
+def discard_upload(path, is_new, chroma_db=None, base_dir=None):
+    """
+    Remove a stored upload after a failed validation, unless the bytes were
+    already there before this request. With `chroma_db`, the collection is
+    checked right before unlinking: a concurrent upload of the same bytes
+    (stored paths are relative to `base_dir`, default the working directory)
+    may have indexed the file in the meantime.
+    """
+    if not is_new or not os.path.exists(path):
+        return
+    if chroma_db is not None:
+        relative = os.path.relpath(path, base_dir or os.getcwd())
+        if chroma_db.referenced_paths([relative, os.path.abspath(path)], use_index=False):
+            return
+    os.remove(path)
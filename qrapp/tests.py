@@ -1,16 +1,70 @@
 import unittest
+import atexit
+import hashlib
+import json
 import os
+import shutil
+import tempfile
+import threading
+import numpy as np
 from PIL import Image
+
+# The app's on-disk stores live in a throwaway directory, never in the committed ones
+TEST_DIR = tempfile.mkdtemp(prefix="qrapp-tests-")
+atexit.register(shutil.rmtree, TEST_DIR, True)
+for name, path in [
+    ("CHROMA_DB_DIR", "chromadb_data"),
+    ("METADATA_INDEX_PATH", "metadata_index.db"),
+    ("KEYWORD_INDEX_PATH", "keyword_index.db"),
+    ("JOB_DB_PATH", "jobs.db"),
+    ("TOKEN_DB_PATH", "tokens.db"),
+    ("THUMBNAIL_DIR", "thumbnails"),
+    ("COMPACT_INDEX_DIR", "compact_index"),
+    ("METRICS_DIR", "metrics"),
+    ("PROFILE_DIR", "profiles")
+]:
+    os.environ[name] = os.path.join(TEST_DIR, path)
+# Deterministic hash vectors instead of the CLIP model, unless a run asks for it
+os.environ.setdefault("EMBEDDING_MODE", "stub")
+
 from app import app
+from services.uploads import content_path
+from services.pdf_ingest import iter_pdf_pages
+from database.token_store import SQLiteTokenStore
+from database.embedding_batcher import EmbeddingBatcher
+from database.job_queue import JobQueue
+from database.keyword_index import KeywordIndex
+from database.metadata_index import MetadataIndex
+from database.compact_index import ExactVectorStore
+from database.result_format import columnar_results, result_rows
+from database.image_prep import PreparedImageLoader, prepare_image
+from database.embedding_service import StubEmbeddingFunction, RemoteEmbeddingFunction, _private_socket_dir
+from services.metrics import Metrics
+from services.qr_cache import QRCache, TMP_PREFIX
+from auth.user_cache import AuthUser, UserCache
+from auth.models import password_needs_rehash
+from services.uploads import store_upload, discard_upload, check_image_header, UploadRejected
+from services.storage_gc import collect_garbage, GarbageCollectionRefused
+from database.chroma_db import ChromaDBUtility, chroma_db
+from werkzeug.datastructures import FileStorage
+from PyPDF2 import PdfReader
+from io import BytesIO
 
 class FlaskTestCase(unittest.TestCase):
     def setUp(self):
         self.app = app.test_client()
         self.app.testing = True
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.upload_folder = app.config['UPLOAD_FOLDER']
+        app.config['UPLOAD_FOLDER'] = os.path.join(self.tmpdir.name, 'uploads')
+
+    def tearDown(self):
+        app.config['UPLOAD_FOLDER'] = self.upload_folder
+        self.tmpdir.cleanup()
 
     def test_upload(self):
         # Create a valid PNG test image
-        test_image_path = 'uploads/test_image.png'
+        test_image_path = os.path.join(self.tmpdir.name, 'test_image.png')
         img = Image.new('RGB', (100, 100), color='red')
         img.save(test_image_path)
 
@@ -19,8 +73,704 @@ class FlaskTestCase(unittest.TestCase):
 
         self.assertEqual(response.status_code, 200)
 
-        # Cleanup
-        os.remove(test_image_path)
+    def _upload_image(self, name='served.png', color='green'):
+        path = os.path.join(self.tmpdir.name, name)
+        Image.new('RGB', (120, 90), color=color).save(path)
+        with open(path, 'rb') as f:
+            response = self.app.post('/upload_image', data={'file': f}, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 200)
+        with open(path, 'rb') as f:
+            return response.get_json()["image_id"], f.read()
+
+    def test_view_file_etag_and_range(self):
+        image_id, content = self._upload_image()
+        response = self.app.get(f'/view_file/{image_id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, content)
+        # The content hash recorded at upload is the (strong) ETag
+        etag = response.headers['ETag'].strip('"')
+        self.assertEqual(etag, hashlib.sha256(content).hexdigest())
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        response.close()
+
+        response = self.app.get(f'/view_file/{image_id}', headers={'If-None-Match': f'"{etag}"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        response.close()
+
+        response = self.app.get(f'/view_file/{image_id}', headers={'Range': 'bytes=0-9'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, content[:10])
+        self.assertEqual(response.headers['Content-Range'], f'bytes 0-9/{len(content)}')
+        response.close()
+
+        response = self.app.get(f'/download_file/{image_id}', headers={'Range': f'bytes={len(content) - 4}-'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, content[-4:])
+        self.assertTrue(response.headers['Content-Disposition'].startswith('attachment'))
+        response.close()
+
+        self.assertEqual(self.app.get('/view_file/no-such-id').status_code, 404)
+
+    def test_search_cache_is_invalidated_by_writes(self):
+        def search():
+            response = self.app.get('/search_text', query_string={'q': 'alzado norte', 'type': 'cache-test'})
+            self.assertEqual(response.status_code, 200)
+            return [match["id"] for match in response.get_json()]
+
+        first = chroma_db.add_text_document("alzado norte", {"type": "cache-test"})
+        try:
+            self.assertEqual(search(), [first])
+            hits = chroma_db.cache_stats()["search_results"]["hits"]
+            self.assertEqual(search(), [first])
+            self.assertEqual(chroma_db.cache_stats()["search_results"]["hits"], hits + 1)
+
+            # A result handed out is the caller's own: changing it doesn't reach the cache
+            results = chroma_db.search_by_text("alzado norte", where={"type": "cache-test"})
+            results[0]["metadata"]["type"] = "changed"
+            results.clear()
+            again = chroma_db.search_by_text("alzado norte", where={"type": "cache-test"})
+            self.assertEqual(again[0]["metadata"]["type"], "cache-test")
+
+            second = chroma_db.add_text_document("alzado sur", {"type": "cache-test"})
+            self.assertEqual(search(), [first, second])
+            chroma_db.delete_files(file_ids=[first])
+            self.assertEqual(search(), [second])
+        finally:
+            chroma_db.delete_files(where={"type": "cache-test"})
+
+    def test_search_filters_and_options(self):
+        ids = {
+            text: chroma_db.add_text_document(text, {"type": "filter-test", "floor": floor})
+            for text, floor in [("planta primera", 1), ("planta segunda", 2), ("cubierta", 3)]
+        }
+        try:
+            response = self.app.get('/search_text', query_string={
+                'q': 'planta primera', 'where': json.dumps({"floor": {"$gte": 2}}), 'type': 'filter-test'
+            })
+            self.assertEqual(sorted(m["id"] for m in response.get_json()), sorted([ids["cubierta"], ids["planta segunda"]]))
+
+            # An exact match has distance 0; max_distance drops the rest, include projects the fields
+            response = self.app.get('/search_text', query_string={
+                'q': 'planta primera', 'type': 'filter-test', 'max_distance': '0.01', 'include': 'distances'
+            })
+            self.assertEqual(response.get_json(), [{"id": ids["planta primera"], "distance": 0.0}])
+
+            response = self.app.post('/search_batch', json={
+                "queries": ["cubierta", "planta segunda"], "n_results": 1, "type": "filter-test",
+                "include": ["documents"]
+            })
+            self.assertEqual(response.get_json()["results"], [
+                [{"id": ids["cubierta"], "document": "cubierta"}],
+                [{"id": ids["planta segunda"], "document": "planta segunda"}]
+            ])
+        finally:
+            chroma_db.delete_files(where={"type": "filter-test"})
+
+    def test_invalid_search_options_are_rejected(self):
+        for body in [
+            {"n_results": None}, {"n_results": [5]}, {"n_results": 0}, {"include": {"documents": True}},
+            {"include": "embeddings"}, {"include": [1]}, {"max_distance": "near"}, {"where": [1]},
+            {"where": "{not json"}, {"mmr": 2}, {"ef_search": {}}
+        ]:
+            response = self.app.post('/search_batch', json=dict(body, queries=["planta"]))
+            self.assertEqual(response.status_code, 400, body)
+            self.assertEqual(response.get_json()["error"], "Invalid search options")
+        self.assertEqual(self.app.get('/search_text?q=planta&n_results=x').status_code, 400)
+
+    def test_upload_images(self):
+        # One valid PNG and one file that is not an image
+        test_image_path = os.path.join(self.tmpdir.name, 'test_bulk_image.png')
+        bad_file_path = os.path.join(self.tmpdir.name, 'test_bulk_bad.png')
+        Image.new('RGB', (100, 100), color='blue').save(test_image_path)
+        with open(bad_file_path, 'wb') as f:
+            f.write(b'not an image')
+
+        with open(test_image_path, 'rb') as good, open(bad_file_path, 'rb') as bad:
+            response = self.app.post('/upload_images', data={'files': [good, bad]}, content_type='multipart/form-data')
+
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()["results"]
+        self.assertEqual(len(results), 2)
+        self.assertIn("image_id", results[0])
+        self.assertIn("error", results[1])
+        # Nothing was stored for the rejected upload
+        bad_sha256 = hashlib.sha256(b'not an image').hexdigest()
+        self.assertFalse(os.path.exists(content_path(app.config['UPLOAD_FOLDER'], bad_sha256, 'png')))
+
+    def test_pdf_pages_serve_and_delete_through_parent(self):
+        pdf_path = os.path.join(self.tmpdir.name, 'plan.pdf')
+        Image.new('RGB', (60, 80), color='white').save(pdf_path)
+        with open(pdf_path, 'rb') as f:
+            pdf_bytes = f.read()
+        pages = [(1, np.zeros((8, 8, 3), dtype=np.uint8), "planta baja"), (2, None, "corte A-A")]
+        parent_id = chroma_db.add_pdf(pdf_path, iter(pages), metadata={"filename": "plan.pdf"})
+
+        records = chroma_db.collection.get(where={"parent_id": parent_id})["ids"]
+        self.assertEqual(sorted(records), [f"{parent_id}:p1", f"{parent_id}:p1:text", f"{parent_id}:p2:text"])
+        self.assertEqual(chroma_db.get_file_metadata(parent_id)["pages"], 2)
+
+        # A search hit on a page serves the parent PDF
+        response = self.app.get(f'/view_file/{parent_id}:p2:text')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, pdf_bytes)
+        response.close()
+
+        # Deleting one page deletes the document, every page and the stored file
+        chroma_db.delete_files(file_ids=[f"{parent_id}:p1"])
+        self.assertEqual(chroma_db.collection.get(ids=[parent_id] + records)["ids"], [])
+        self.assertFalse(os.path.exists(pdf_path))
+
+    @unittest.skipUnless(shutil.which("pdftoppm"), "poppler is not installed")
+    def test_iter_pdf_pages_renders_windows_in_order(self):
+        pdf_path = os.path.join(self.tmpdir.name, 'pages.pdf')
+        sheets = [Image.new('RGB', (200, 100), color=color) for color in ('red', 'green', 'blue')]
+        sheets[0].save(pdf_path, save_all=True, append_images=sheets[1:])
+        pages = list(iter_pdf_pages(pdf_path, dpi=72, max_px=50, workers=2, window=2))
+        self.assertEqual([page_number for page_number, _, _ in pages], [1, 2, 3])
+        self.assertEqual([max(image.shape[:2]) for _, image, _ in pages], [50, 50, 50])
+
+    def test_deletes_require_login(self):
+        chroma_db.collection.add(ids=["delete-guarded"], documents=["plan"], metadatas=[{"type": "document"}])
+        try:
+            self.assertEqual(self.app.post('/delete_file/delete-guarded').status_code, 302)
+            self.assertEqual(self.app.post('/delete_files', json={"file_ids": ["delete-guarded"]}).status_code, 302)
+            self.assertEqual(chroma_db.collection.get(ids=["delete-guarded"])["ids"], ["delete-guarded"])
+        finally:
+            chroma_db.collection.delete(ids=["delete-guarded"])
+
+    def test_qr_sheet_prints_one_code_per_document(self):
+        # A PDF record and its page records all carry the document's path and filename
+        ids = ["sheet-pdf", "sheet-p1", "sheet-p1-text", "sheet-p2", "sheet-p2-text"]
+        types = ["pdf", "pdf_page", "pdf_page_text", "pdf_page", "pdf_page_text"]
+        chroma_db.collection.add(
+            ids=ids,
+            documents=["plan"] * len(ids),
+            metadatas=[{"type": t, "filename": "sheet-plan.pdf", "path": "uploads/sheet-plan.pdf"} for t in types]
+        )
+        try:
+            response = self.app.post('/generate_qr_sheet', json={
+                "where": {"filename": "sheet-plan.pdf"}, "format": "png", "columns": 1
+            })
+            self.assertEqual(response.status_code, 200)
+            with Image.open(BytesIO(response.data)) as sheet:
+                self.assertEqual(sheet.height, 340)  # a single 300 px code plus its caption
+        finally:
+            chroma_db.collection.delete(ids=ids)
+
+    def test_qr_sheet_pdf_pages_and_cap(self):
+        ids = [f"sheet-doc-{i}" for i in range(3)]
+        chroma_db.collection.add(
+            ids=ids,
+            documents=["plan"] * len(ids),
+            metadatas=[{"type": "image", "filename": "sheet-doc.png", "path": f"uploads/{i}.png"} for i in ids]
+        )
+        max_files = app.config['QR_SHEET_MAX_FILES']
+        try:
+            response = self.app.post('/generate_qr_sheet', json={
+                "where": {"filename": "sheet-doc.png"}, "columns": 1, "rows": 2
+            })
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, "application/pdf")
+            self.assertEqual(len(PdfReader(BytesIO(response.data)).pages), 2)
+
+            app.config['QR_SHEET_MAX_FILES'] = 2
+            response = self.app.post('/generate_qr_sheet', json={"where": {"filename": "sheet-doc.png"}})
+            self.assertEqual(response.status_code, 400)
+        finally:
+            app.config['QR_SHEET_MAX_FILES'] = max_files
+            chroma_db.collection.delete(ids=ids)
+
+class TokenStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = SQLiteTokenStore(os.path.join(self.tmpdir.name, 'tokens.db'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_resolve_and_max_uses(self):
+        token = self.store.create('file-1', ttl=60, max_uses=2)
+        self.assertEqual(self.store.resolve(token), 'file-1')
+        self.assertEqual(self.store.resolve(token), 'file-1')
+        self.assertIsNone(self.store.resolve(token))
+        self.assertIsNone(self.store.resolve('missing'))
+
+    def test_shared_between_instances(self):
+        # A second store on the same file behaves like another gunicorn worker
+        token = self.store.create('file-2')
+        other = SQLiteTokenStore(self.store.db_path)
+        self.assertEqual(other.resolve(token), 'file-2')
+
+class EmbeddingBatcherTestCase(unittest.TestCase):
+    def test_concurrent_queries_share_batches(self):
+        batch_sizes = []
+
+        def embedding_function(items):
+            batch_sizes.append(len(items))
+            return [[float(len(item))] for item in items]
+
+        batcher = EmbeddingBatcher(embedding_function, max_wait=0.05, max_batch=8)
+        results = {}
+
+        def search(n):
+            results[n] = batcher.embed(["q" * n])
+
+        threads = [threading.Thread(target=search, args=(n,)) for n in range(1, 17)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results[5], [[5.0]])
+        self.assertEqual(sum(batch_sizes), 16)
+        self.assertLess(len(batch_sizes), 16)
+        self.assertTrue(all(size <= 8 for size in batch_sizes))
+
+    def test_bad_items_fail_alone_and_never_hang(self):
+        def embedding_function(items):
+            if any(not isinstance(item, str) for item in items):
+                raise ValueError("unsupported item")
+            return [[1.0] for item in items if item != "dropped"]
+
+        batcher = EmbeddingBatcher(embedding_function, max_wait=0.05, max_batch=8, timeout=5)
+        results = {}
+
+        def search(item):
+            try:
+                results[repr(item)] = batcher.embed([item])
+            except Exception as e:
+                results[repr(item)] = type(e)
+
+        threads = [threading.Thread(target=search, args=(item,)) for item in ("ok", 42, "dropped")]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results, {"'ok'": [[1.0]], "42": ValueError, "'dropped'": RuntimeError})
+
+class JobQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.queue = JobQueue(os.path.join(self.tmpdir.name, 'jobs.db'), max_attempts=2, retry_delay=0)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_retry_then_dead_letter(self):
+        job_id = self.queue.enqueue("image", {"path": "missing.png"})
+        job = self.queue.claim()[0]
+        self.assertEqual(self.queue.claim(), [])  # leased
+        self.assertEqual(self.queue.fail(job, "boom"), "failed")
+        job = self.queue.claim()[0]
+        self.assertEqual(job["attempts"], 2)
+        self.assertEqual(self.queue.fail(job, "boom"), "dead")
+        self.assertEqual(self.queue.get(job_id)["error"], "boom")
+        self.assertEqual(self.queue.requeue_dead(), 1)
+        self.assertEqual(self.queue.counts(), {"queued": 1})
+
+    def test_renew_only_while_held(self):
+        self.queue.enqueue("pdf", {"path": "big.pdf"})
+        self.queue.lease_seconds = 0
+        job = self.queue.claim()[0]
+        self.assertEqual(self.queue.renew([job]), [job["id"]])
+        # Once the lease ran out and another worker claimed the job, it is no longer ours
+        other = self.queue.claim()[0]
+        self.assertEqual(self.queue.renew([job]), [])
+        self.assertEqual(self.queue.renew([other]), [other["id"]])
+        # ...nor can the first worker finish or fail it
+        self.assertFalse(self.queue.complete(job, {"document_id": "stale"}))
+        self.assertIsNone(self.queue.fail(job, "late"))
+        self.assertTrue(self.queue.complete(other, {"document_id": "fresh"}))
+        self.assertEqual(self.queue.get(job["id"])["result"], {"document_id": "fresh"})
+
+    def test_prune_keeps_recent_and_unfinished_jobs(self):
+        for path in ("a.png", "b.png", "c.png"):
+            self.queue.enqueue("image", {"path": path})
+        first, second, _ = self.queue.claim(limit=3)
+        self.queue.complete(first)
+        self.queue.complete(second)
+        self.assertEqual(self.queue.prune(), 0)
+        self.queue.retention_seconds = -1
+        self.assertEqual(self.queue.prune(), 2)
+        self.assertEqual(self.queue.counts(), {"running": 1})
+        self.assertEqual(self.queue.pending_paths(), {"c.png"})
+
+class MetadataIndexTestCase(unittest.TestCase):
+    def test_known_sha256_is_not_recomputed_and_rebuild(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'plan.png')
+            with open(path, 'wb') as f:
+                f.write(b'plan bytes')
+            index = MetadataIndex(os.path.join(tmpdir, 'metadata.db'))
+            index.upsert_many([
+                ("a", {"type": "image", "path": path, "sha256": "known"}),
+                ("b", {"type": "image", "path": path})
+            ])
+            self.assertEqual(index.get("a")["sha256"], "known")  # only stat'ed
+            self.assertEqual(index.get("a")["size"], len(b'plan bytes'))
+            self.assertEqual(index.get("b")["sha256"], hashlib.sha256(b'plan bytes').hexdigest())
+
+            class Collection:
+                def get(self, limit, offset, include):
+                    ids = ["c"][offset:offset + limit]
+                    return {"ids": ids, "metadatas": [{"type": "pdf", "path": path}] * len(ids)}
+
+            self.assertEqual(index.rebuild(Collection(), batch_size=1), 1)
+            self.assertEqual(index.count(), 1)
+            self.assertIsNone(index.get("a"))
+            self.assertEqual(index.count_path(path), 1)
+
+    def test_rebuild_keeps_writes_made_while_it_runs(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index = MetadataIndex(os.path.join(tmpdir, 'metadata.db'))
+            index.upsert_many([("b", {"type": "text"})])
+
+            class Collection:
+                def get(self, limit, offset, include):
+                    ids = ["a", "b"][offset:offset + limit]
+                    if offset == 0:
+                        # Writes landing between the rebuild's read and its swap
+                        index.upsert_many([("new", {"type": "text"})])
+                        index.delete_many(["b"])
+                    return {"ids": ids, "metadatas": [{"type": "text"}] * len(ids)}
+
+            self.assertEqual(index.rebuild(Collection(), batch_size=2), 2)
+            self.assertEqual(index.count(), 2)
+            self.assertIsNotNone(index.get("new"))
+            self.assertIsNone(index.get("b"))
+            # The staged rows are upserted by id, like the live table
+            index.upsert_many([("a", {"type": "text", "filename": "a.txt"})])
+            self.assertEqual(index.count(), 2)
+
+class KeywordIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.index = KeywordIndex(os.path.join(self.tmpdir.name, 'keywords.db'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_code_lookup_and_delete(self):
+        self.index.upsert_many([
+            ("a", {"type": "image", "filename": "AP-TEC-04.png", "description": "AP-TEC-04.png"}, None),
+            ("b", {"type": "image", "filename": "AP-TEC-05.png", "description": "Planta t\u00e9cnica"}, None),
+            ("c", {"type": "pdf_page", "filename": "AP-TEC-04.pdf", "description": "p. 1"}, None),
+        ])
+        self.assertEqual([hit[0] for hit in self.index.search("ap-tec-04", filename_phrase=True)], ["a"])
+        self.assertEqual([hit[0] for hit in self.index.search("tecnica")], ["b"])
+        self.index.delete_many(["a"])
+        self.assertEqual(self.index.search("AP-TEC-04"), [])
+        self.assertEqual(self.index.count(), 1)
+
+    def test_rebuild_keeps_writes_made_while_it_runs(self):
+        self.index.upsert_many([
+            ("gone", {"filename": "old.png", "description": "old"}, None),
+            ("b", {"filename": "b.png", "description": "b"}, None),
+        ])
+        index = self.index
+
+        class Collection:
+            def get(self, limit, offset, include):
+                ids = ["a", "b"][offset:offset + limit]
+                if offset == 0:
+                    # Writes landing between the rebuild's read and its swap
+                    index.upsert_many([("new", {"filename": "AP-ARQ-01.png", "description": "new"}, None)])
+                    index.delete_many(["b"])
+                return {
+                    "ids": ids,
+                    "metadatas": [{"filename": f"{i}.png", "description": i} for i in ids],
+                    "documents": [None] * len(ids)
+                }
+
+        self.assertEqual(self.index.rebuild(Collection(), batch_size=2), 2)
+        self.assertEqual(sorted(hit[0] for hit in self.index.search("png", limit=10)), ["a", "new"])
+        self.assertEqual(self.index.search("old"), [])
+
+class ExactVectorStoreTestCase(unittest.TestCase):
+    def test_put_replace_and_delete(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = ExactVectorStore(tmpdir, dims=3)
+            store.put_many(["a", "b"], [[1, 2, 3], [4, 5, 6]])
+            store.put_many(["a"], [[7, 8, 9]])
+            vectors = store.get_many(["a", "b", "missing"])
+            self.assertEqual(vectors["a"].tolist(), [7.0, 8.0, 9.0])
+            self.assertEqual(vectors["b"].tolist(), [4.0, 5.0, 6.0])
+            store.delete_many(["b"])
+            self.assertEqual(list(store.get_many(["b"])), [])
+            # The freed row is reused instead of growing the file
+            store.put_many(["c"], [[1, 1, 1]])
+            self.assertEqual(os.path.getsize(store.data_path), 2 * 3 * 4)
+            self.assertEqual(store.count(), 2)
+
+    def test_compact_collection_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = ChromaDBUtility(
+                db_dir=os.path.join(tmpdir, "chroma"), embedding_function=StubEmbeddingFunction(dims=16),
+                compact_index_dir=os.path.join(tmpdir, "compact"), hnsw={"space": "cosine"}
+            )
+            words = ["planta", "corte", "alzado", "fachada", "detalle", "cubierta", "estructura", "cimentacion"]
+            ids = {word: db.add_text_document(word, {"type": "text"}) for word in words}
+            old_name = db.collection.name
+
+            name, total = db.rebuild_index(compact_dims=4, drop_old=True)
+            self.assertEqual(total, len(words))
+            # The compact collection replaces the full one rather than sitting beside it
+            self.assertEqual([c.name for c in db.client.list_collections()], [name])
+            self.assertNotEqual(name, old_name)
+            self.assertEqual(len(db.collection.get(ids=[ids["corte"]], include=["embeddings"])["embeddings"][0]), 4)
+            self.assertEqual(db.search_by_text("corte", n_results=1)[0]["id"], ids["corte"])
+            self.assertAlmostEqual(db.search_by_text("corte", n_results=1)[0]["distance"], 0.0, places=4)
+
+            new_id = db.add_text_document("seccion", {"type": "text"})
+            self.assertEqual(db.search_by_text("seccion", n_results=1)[0]["id"], new_id)
+            _, vectors = db._compact_state()
+            db.delete_files([ids["planta"]])
+            self.assertEqual(vectors.count(), len(words))
+
+            name, _ = db.rebuild_index(compact_dims=0, drop_old=True)
+            self.assertIsNone(db._compact_state())
+            self.assertEqual(len(db.collection.get(ids=[new_id], include=["embeddings"])["embeddings"][0]), 16)
+            self.assertEqual(db.search_by_text("seccion", n_results=1)[0]["id"], new_id)
+            self.assertEqual(os.listdir(os.path.join(tmpdir, "compact")), [])
+
+class ResultFormatTestCase(unittest.TestCase):
+    results = {
+        "ids": [["a", "b", "c"]],
+        "documents": [["A", "B", "C"]],
+        "metadatas": [[{}, {}, {}]],
+        "distances": [[0.1, 0.2, 0.9]],
+        "embeddings": [[[1.0, 0.0], [1.0, 0.01], [0.0, 1.0]]]
+    }
+
+    def test_rows_keep_the_legacy_shape(self):
+        rows = result_rows(columnar_results(self.results, max_distance=0.5))
+        self.assertEqual([row["id"] for row in rows], ["a", "b"])
+        self.assertEqual(list(rows[0]), ["id", "document", "metadata", "distance"])
+
+    def test_mmr_prefers_diverse_matches(self):
+        columns = columnar_results(self.results, n_results=2, query_embedding=[1.0, 0.0], mmr_lambda=0.3)
+        self.assertEqual(columns["ids"], ["a", "c"])
+
+    def test_json_provider_honours_dumps_options(self):
+        data = {"b": 1, "a": [0.5]}
+        self.assertEqual(list(app.json.loads(app.json.dumps(data, sort_keys=True))), ["a", "b"])
+        self.assertEqual(app.json.loads(app.json.dumps(data, indent=4)), data)
+        self.assertIn('\n  "b": 1', app.json.dumps(data, indent=2))
+
+class StubEmbeddingFunctionTestCase(unittest.TestCase):
+    def test_same_input_same_unit_vector(self):
+        ef = StubEmbeddingFunction(dims=16)
+        first, second, other = ef(["plano", "plano", "corte"])
+        self.assertEqual(first.tolist(), second.tolist())
+        self.assertNotEqual(first.tolist(), other.tolist())
+        self.assertAlmostEqual(float((first ** 2).sum()), 1.0, places=5)
+
+    def test_remote_mode_needs_authkey_and_private_socket_dir(self):
+        with self.assertRaises(ValueError):
+            RemoteEmbeddingFunction("/tmp/unused.sock", b"")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            private = _private_socket_dir(os.path.join(tmpdir, "run", "embeddings.sock"))
+            self.assertEqual(os.stat(private).st_mode & 0o777, 0o700)
+            os.chmod(private, 0o755)
+            with self.assertRaises(RuntimeError):
+                _private_socket_dir(os.path.join(private, "embeddings.sock"))
+
+class MetricsTestCase(unittest.TestCase):
+    def test_snapshots_are_summed_across_workers(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Another worker's snapshot
+            other = Metrics(tmpdir, flush_interval=3600)
+            with other.span("embed"):
+                pass
+            other.inc("qrapp_slow_requests_total", endpoint="search_text")
+            other.flush()
+            os.rename(os.path.join(tmpdir, f"{os.getpid()}.json"), os.path.join(tmpdir, "1.json"))
+
+            own = Metrics(tmpdir, flush_interval=3600)
+            own.observe("qrapp_stage_seconds", 0.002, stage="embed")
+            text = own.render([("qrapp_collection_records", {}, 3)])
+            self.assertIn('qrapp_stage_seconds_count{stage="embed"} 2', text)
+            self.assertIn('qrapp_stage_seconds_bucket{stage="embed",le="+Inf"} 2', text)
+            self.assertIn('qrapp_slow_requests_total{endpoint="search_text"} 1', text)
+            self.assertIn("qrapp_collection_records 3", text)
+
+class UserCacheTestCase(unittest.TestCase):
+    def test_invalidation_reaches_other_workers(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            version_path = os.path.join(tmpdir, "users_version")
+            cache = UserCache(ttl=60, version_path=version_path)
+            # A second cache on the same version file behaves like another gunicorn worker
+            other = UserCache(ttl=60, version_path=version_path)
+            loads = []
+
+            def load(user_id):
+                loads.append(user_id)
+                return AuthUser(user_id, "crew", False)
+
+            cache.get(1, load)
+            cache.get(1, load)
+            self.assertEqual(loads, [1])
+            other.invalidate()
+            cache.get(1, load)
+            self.assertEqual(loads, [1, 1])
+
+    def test_only_weaker_password_hashes_are_redone(self):
+        method = app.config['PASSWORD_HASH_METHOD']
+        app.config['PASSWORD_HASH_METHOD'] = "pbkdf2:sha256:1000"
+        try:
+            with app.app_context():
+                self.assertTrue(password_needs_rehash("pbkdf2:sha256:500$salt$hash"))
+                self.assertFalse(password_needs_rehash("pbkdf2:sha256:1000$salt$hash"))
+                self.assertFalse(password_needs_rehash("pbkdf2:sha256:2000$salt$hash"))
+                self.assertTrue(password_needs_rehash("scrypt:32768:8:1$salt$hash"))
+        finally:
+            app.config['PASSWORD_HASH_METHOD'] = method
+
+class QRCacheTestCase(unittest.TestCase):
+    def test_disk_tier_stays_within_quota(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = QRCache(max_items=0, disk_dir=tmpdir, disk_quota_bytes=1000)
+            keys = [cache.make_key(f"token-{n}", 10, "M", "png") for n in range(10)]
+            for n, key in enumerate(keys):
+                cache.put(key, "png", b"x" * 300)
+                os.utime(cache._disk_path(key, "png"), (n, n))  # distinct, increasing mtimes
+            usage = sum(os.path.getsize(os.path.join(root, name))
+                        for root, _, files in os.walk(tmpdir) for name in files)
+            self.assertLessEqual(usage, 1000)
+            self.assertIsNotNone(cache.get(keys[-1], "png"))
+            self.assertIsNone(cache.get(keys[0], "png"))
+
+    def test_files_being_written_are_left_alone(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = QRCache(max_items=0, disk_dir=tmpdir, disk_quota_bytes=1000)
+            # Another worker's write in progress, older than anything cached
+            os.makedirs(os.path.join(tmpdir, "ab"))
+            partial = os.path.join(tmpdir, "ab", TMP_PREFIX + "partial")
+            with open(partial, "wb") as f:
+                f.write(b"x" * 900)
+            os.utime(partial, (0, 0))
+            for n in range(5):
+                cache.put(cache.make_key(f"token-{n}", 10, "M", "png"), "png", b"x" * 300)
+            self.assertTrue(os.path.exists(partial))
+            self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+class PrepareImageTestCase(unittest.TestCase):
+    def _encoded(self, size, mode="RGB", fmt="PNG"):
+        buffer = BytesIO()
+        Image.new(mode, size).save(buffer, fmt)
+        buffer.seek(0)
+        return buffer
+
+    def test_shortest_side_is_model_size(self):
+        # Width rounds up, so the center crop always has 224 columns to take
+        self.assertEqual(prepare_image(self._encoded((1000, 600))).shape, (224, 374, 3))
+        self.assertEqual(prepare_image(self._encoded((1600, 1200), fmt="JPEG")).shape, (224, 299, 3))
+        self.assertEqual(prepare_image(self._encoded((300, 2000), mode="1")).shape, (1494, 224, 3))
+        self.assertEqual(prepare_image(self._encoded((900, 900), mode="P"), min_side=100).shape, (100, 100, 3))
+        # Small images are never upscaled
+        self.assertEqual(prepare_image(self._encoded((100, 50), mode="L")).shape, (50, 100, 3))
+
+    def test_loader_batches_keep_order(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = []
+            for n, size in enumerate([(800, 400), (400, 800), (300, 300)]):
+                paths.append(os.path.join(tmpdir, f"{n}.png"))
+                Image.new("RGB", size).save(paths[-1])
+            loader = PreparedImageLoader(min_side=112, max_workers=3)
+            shapes = [image.shape for image in loader(paths + [None])[:3]]
+            self.assertEqual(shapes, [(112, 224, 3), (224, 112, 3), (112, 112, 3)])
+            self.assertIsNone(loader([None])[0])
+
+class StoreUploadTestCase(unittest.TestCase):
+    def test_identical_content_is_stored_once(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            first = store_upload(FileStorage(BytesIO(b"same bytes"), "a.png"), tmpdir, "png")
+            second = store_upload(FileStorage(BytesIO(b"same bytes"), "b.png"), tmpdir, "png")
+            self.assertTrue(first[2])
+            self.assertFalse(second[2])
+            self.assertEqual(first[:2], second[:2])
+            self.assertTrue(first[0].endswith(f"{first[1][:2]}/{first[1]}.png"))
+            self.assertEqual(sorted(os.listdir(tmpdir)), [first[1][:2]])
+
+    def test_discard_keeps_a_file_indexed_meanwhile(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "plan.png")
+            with open(path, "wb") as f:
+                f.write(b"plan bytes")
+
+            class ChromaDB:
+                referenced = set()
+
+                def referenced_paths(self, paths, use_index=True):
+                    return self.referenced & set(paths)
+
+            db = ChromaDB()
+            # A concurrent upload of the same bytes indexed the file first
+            db.referenced = {"plan.png"}
+            discard_upload(path, True, db, base_dir=tmpdir)
+            self.assertTrue(os.path.exists(path))
+            db.referenced = set()
+            discard_upload(path, True, db, base_dir=tmpdir)
+            self.assertFalse(os.path.exists(path))
+
+    def test_rejected_header_writes_nothing(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with self.assertRaises(UploadRejected):
+                store_upload(FileStorage(BytesIO(b"not an image"), "a.png"), tmpdir, "png",
+                             validate=check_image_header)
+            self.assertEqual(os.listdir(tmpdir), [])
+
+class StorageGCTestCase(unittest.TestCase):
+    def test_dangling_records_and_orphan_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            uploads = os.path.join(tmpdir, "uploads")
+            os.makedirs(os.path.join(uploads, "ab"))
+            for name in ("kept.png", "ab/abc123.png"):
+                with open(os.path.join(uploads, name), "wb") as f:
+                    f.write(b"bytes")
+            stub = StubEmbeddingFunction(dims=8)
+            db = ChromaDBUtility(db_dir=os.path.join(tmpdir, "chroma"), embedding_function=stub)
+
+            # An empty collection (wrong store) must never make every upload an orphan
+            with self.assertRaises(GarbageCollectionRefused):
+                collect_garbage(db, uploads, base_dir=tmpdir, dry_run=False, min_age=0)
+            self.assertEqual(len(os.listdir(uploads)), 2)
+
+            db.collection.add(
+                ids=["kept", "dangling", "note"],
+                embeddings=stub(["a", "b", "c"]),
+                metadatas=[{"path": "uploads/kept.png"}, {"path": "uploads/gone.png"}, {"type": "document"}]
+            )
+            report = collect_garbage(db, uploads, base_dir=tmpdir, dry_run=True, batch_size=1, min_age=0)
+            self.assertEqual((report["dangling_records"], report["orphan_files"]), (1, 1))
+            self.assertIsNone(report["refused"])
+            self.assertEqual(db.collection.count(), 3)
+
+            report = collect_garbage(db, uploads, base_dir=tmpdir, dry_run=False, batch_size=1, min_age=0)
+            self.assertEqual((report["records_deleted"], report["files_removed"]), (1, 1))
+            self.assertEqual(sorted(db.collection.get()["ids"]), ["kept", "note"])
+            self.assertEqual(os.listdir(uploads), ["kept.png"])
+
+class BulkImageIngestTestCase(unittest.TestCase):
+    def test_one_bad_image_fails_alone(self):
+        class RejectsBlack(StubEmbeddingFunction):
+            def __call__(self, input):
+                if any(not item.any() for item in input):
+                    raise ValueError("black image")
+                return super().__call__(input)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = []
+            for name, color in [("red", "red"), ("black", "black"), ("blue", "blue")]:
+                paths.append(os.path.join(tmpdir, f"{name}.png"))
+                Image.new('RGB', (32, 32), color=color).save(paths[-1])
+            db = ChromaDBUtility(db_dir=os.path.join(tmpdir, "chroma"), embedding_function=RejectsBlack(dims=8))
+
+            results = db.add_images_bulk([{"path": path} for path in paths], batch_size=32)
+            self.assertEqual([("id" in r, "error" in r) for r in results], [(True, False), (False, True), (True, False)])
+            self.assertEqual(db.collection.count(), 2)
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,4 +1,12 @@
-from app import app
+from app import app, chroma_db
+from services.metrics import metrics
+
+# With `gunicorn --preload` this runs once in the master process, so every
+# worker shares the model weights copy-on-write instead of loading its own.
+if app.config['EMBEDDING_PRELOAD']:
+    chroma_db.embedding_function.warm_up()
 
 if __name__ == "__main__":
+    # Under gunicorn this is done by the on_starting hook in gunicorn.conf.py
+    metrics.clear_snapshots()
     app.run(host="0.0.0.0", port=5001)